@@ -1,17 +1,45 @@
+from dataclasses import astuple, dataclass
 from datetime import date, timedelta
-from typing import Dict, List, Optional
+from typing import Dict, Hashable, Iterator, List, Mapping, Optional, Union
 
 
+import numpy as np
 import pandas as pd
-from sqlalchemy import and_, union
+from sqlalchemy import Integer, String, and_, literal, select, type_coerce, union, union_all
 from sqlalchemy.orm import Session as SessionClass
 
-from src.scripts.data_warehouse.models.warehouse import Camps, Facts, Metrics, SessionLocal, Sites
+from src.scripts.data_warehouse.cache import (
+    GROUP_REGISTRY,
+    METADATA_CACHE,
+    QUERY_CACHE,
+    QUERY_FLIGHTS,
+    SHARED_QUERY_CACHE,
+    read_facts_version,
+)
+from src.scripts.data_warehouse.models.warehouse import Camps, Facts, SessionLocal, Sites
 from src.utils.logging import LOGGER
 
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+    LOGGER.warning("pyarrow is not installed. query_facts(result_format='arrow') is unavailable.")
 
-def query_facts(
-    session: SessionClass,
+
+# Column dtypes of the DataFrame returned by query_facts.
+FACT_DTYPES = {
+    "metric_id": "int64",
+    "group_name": "object",
+    "value": "float64",
+    "numerator": "float64",
+    "denominator": "float64",
+    "date": "datetime64[ns]",
+    "period_level": "int64",
+    "record_inserted_date": "datetime64[ns]",
+}
+
+
+def _fact_conditions(
     metric_id: Optional[int] = None,
     metric_ids: Optional[List[int]] = None,
     group_name: Optional[str] = None,
@@ -21,14 +49,17 @@ def query_facts(
     exact_date: Optional[date] = None,
     date_from: Optional[date] = None,
     date_to: Optional[date] = None,
-) -> pd.DataFrame:
-
+    session: Optional[SessionClass] = None,
+) -> list:
+    """
+    Translate the query_facts filter arguments into WHERE conditions; group
+    names are looked up in ``GROUP_REGISTRY`` (on *session* if it reloads).
+    """
     # Ensure at least one metric ID is provided
     if metric_id is None and (not metric_ids or len(metric_ids) == 0):
         raise ValueError(
             "At least one metric ID is required (metric_id or metric_ids).")
 
-    query = session.query(Facts)
     conditions = []
 
     # Single metric_id
@@ -39,13 +70,13 @@ def query_facts(
     if metric_ids:
         conditions.append(Facts.metric_id.in_(metric_ids))
 
-    # Single group_name
+    # Single group_name (facts stores the group's id; unknown names match nothing)
     if group_name is not None:
-        conditions.append(Facts.group_name == group_name)
+        conditions.append(Facts.group_id == GROUP_REGISTRY.id(group_name, session))
 
     # Multiple group_names
     if group_names:
-        conditions.append(Facts.group_name.in_(group_names))
+        conditions.append(Facts.group_id.in_(GROUP_REGISTRY.ids(group_names, session).tolist()))
 
     # Single period_level
     if period_level is not None:
@@ -68,21 +99,346 @@ def query_facts(
     LOGGER.info(
         f"Querying Facts with conditions: metric_id = [ {metric_id},  {metric_ids} ] \n group name = [ {group_name},  {group_names} ] \n period level = [ {period_level},  {period_levels} ] \n exact date = [ {exact_date} ] \n date from = [ {date_from} ] \n date to = [ {date_to} ] "
     )
+    return conditions
+
 
-    # Combine all conditions using AND logic
-    if conditions:
-        query = query.filter(and_(*conditions))
+def _fact_select_columns(columns: Optional[List[str]]) -> list:
+    """
+    Facts columns to SELECT. Date columns are fetched as their stored text
+    so they can be parsed in one vectorised pass instead of per row, and
+    ``group_name`` as the stored group id, decoded by :func:`_fact_arrays`.
+    """
+    names = columns or list(FACT_DTYPES)
+    unknown = [n for n in names if n not in FACT_DTYPES]
+    if unknown:
+        raise ValueError(f"Unknown facts column(s): {unknown}")
+    table_columns = Facts.__table__.columns
+    selected = []
+    for n in names:
+        if n == "group_name":
+            selected.append(table_columns["group_id"].label(n))
+        elif FACT_DTYPES[n].startswith("datetime"):
+            selected.append(type_coerce(table_columns[n], String).label(n))
+        else:
+            selected.append(table_columns[n])
+    return selected
+
+
+# Accepted values of query_facts(result_format=...).
+RESULT_FORMATS = ("pandas", "arrow", "numpy")
+
+
+def _fact_arrays(names: List[str], rows: list, session: Optional[SessionClass] = None) -> Dict[str, np.ndarray]:
+    """Turn fetched row tuples into one typed NumPy array per column (group ids decoded on *session*)."""
+    columns = list(zip(*rows)) if rows else [()] * len(names)
+    data = {}
+    for name, values in zip(names, columns):
+        dtype = FACT_DTYPES[name]
+        if name == "group_name":
+            data[name] = GROUP_REGISTRY.names(np.array(values, dtype=np.int64), session)
+        elif dtype.startswith("datetime"):
+            data[name] = pd.to_datetime(pd.Series(values, dtype=object), format="ISO8601").to_numpy(dtype=dtype)
+        elif dtype == "float64":
+            data[name] = np.array(values, dtype=float)  # None -> NaN
+        elif dtype == "int64":
+            data[name] = np.array(values, dtype=np.int64)
+        else:
+            data[name] = np.array(values, dtype=object)
+    return data
 
-    rows = query.all()
 
-    columns = [column.name for column in Facts.__table__.columns]
-    data = []
-    for row in rows:
-        data.append([getattr(row, col) for col in columns])
+def _format_facts(data: Dict[str, np.ndarray], result_format: str):
+    """
+    Package column arrays as the requested result format.
 
-    df = pd.DataFrame(data, columns=columns)
-    LOGGER.info(f"Query returned {len(df)} rows.")
-    return df
+    ``numpy`` returns the arrays as a dict with ``group_name`` dictionary
+    encoded: int32 codes under ``group_name`` and the distinct names under
+    ``group_name_dictionary``. ``arrow`` returns a ``pyarrow.Table`` whose
+    ``group_name`` is a dictionary column and whose dates are timestamp[ns].
+    """
+    if result_format == "pandas":
+        return pd.DataFrame(data, columns=list(data))
+
+    if "group_name" in data:
+        codes, dictionary = pd.factorize(data["group_name"])
+        data = {**data, "group_name": codes.astype(np.int32)}
+    if result_format == "numpy":
+        if "group_name" in data:
+            data["group_name_dictionary"] = np.asarray(dictionary, dtype=object)
+        return data
+
+    if pa is None:
+        raise ImportError("result_format='arrow' requires pyarrow.")
+    arrays = {
+        name: pa.DictionaryArray.from_arrays(pa.array(values), pa.array(dictionary, type=pa.string()))
+        if name == "group_name"
+        else pa.array(values)
+        for name, values in data.items()
+    }
+    return pa.table(arrays)
+
+
+def _table_arrays(table: "pa.Table") -> Dict[str, np.ndarray]:
+    """Inverse of ``_format_facts(data, "arrow")``: column arrays with group names decoded."""
+    data = {}
+    for name in table.column_names:
+        values = table.column(name).combine_chunks()
+        if pa.types.is_dictionary(values.type):
+            values = values.dictionary_decode()
+        data[name] = values.to_numpy(zero_copy_only=False)
+        if FACT_DTYPES[name] == "object":
+            data[name] = data[name].astype(object)
+    return data
+
+
+def _cached_facts(key: tuple) -> Optional[Dict[str, np.ndarray]]:
+    """
+    Column arrays cached under *key*: the in-process ``QUERY_CACHE`` first,
+    then the cross-process ``SHARED_QUERY_CACHE`` (promoted on a hit).
+    """
+    data = QUERY_CACHE.get(key)
+    if data is None and SHARED_QUERY_CACHE.enabled:
+        table = SHARED_QUERY_CACHE.get(key)
+        if table is not None:
+            data = _table_arrays(table)
+            QUERY_CACHE.put(key, data)
+    return data
+
+
+def _cache_facts(key: tuple, data: Dict[str, np.ndarray]) -> None:
+    QUERY_CACHE.put(key, data)
+    if SHARED_QUERY_CACHE.enabled:
+        SHARED_QUERY_CACHE.put(key, _format_facts(data, "arrow"))
+
+
+def _load_and_cache(key: tuple, load) -> Dict[str, np.ndarray]:
+    """Run a cache miss once per key: concurrent identical misses share it (see ``QUERY_FLIGHTS``)."""
+    # a flight that finished between our cache check and taking the lead filled it
+    data = _cached_facts(key)
+    if data is None:
+        data = load()
+        _cache_facts(key, data)
+    return data
+
+
+@dataclass(frozen=True)
+class FactQuery:
+    """One set of query_facts filters: a :func:`query_facts_many` spec and, normalised, a cache key."""
+
+    metric_id: Optional[int] = None
+    metric_ids: Optional[tuple] = None
+    group_name: Optional[str] = None
+    group_names: Optional[tuple] = None
+    period_level: Optional[int] = None
+    period_levels: Optional[tuple] = None
+    exact_date: Optional[date] = None
+    date_from: Optional[date] = None
+    date_to: Optional[date] = None
+
+    def __post_init__(self):
+        # lists are accepted for convenience but stored as tuples (hashable)
+        for name in ("metric_ids", "group_names", "period_levels"):
+            value = getattr(self, name)
+            if value is not None:
+                object.__setattr__(self, name, tuple(value))
+
+    def normalized(self) -> "FactQuery":
+        """
+        Equivalent query with canonical values, used as a result-cache key:
+        lists sorted and de-duplicated (empty = no filter), ids as int and
+        group names as str (groups are matched by their text natural key, so
+        1100 matches '1100').
+        """
+
+        def _canonical(values, cast):
+            return tuple(sorted({cast(v) for v in values})) if values else None
+
+        return FactQuery(
+            metric_id=None if self.metric_id is None else int(self.metric_id),
+            metric_ids=_canonical(self.metric_ids, int),
+            group_name=None if self.group_name is None else str(self.group_name),
+            group_names=_canonical(self.group_names, str),
+            period_level=None if self.period_level is None else int(self.period_level),
+            period_levels=_canonical(self.period_levels, int),
+            exact_date=self.exact_date,
+            date_from=self.date_from,
+            date_to=self.date_to,
+        )
+
+
+def query_facts(
+    session: SessionClass,
+    metric_id: Optional[int] = None,
+    metric_ids: Optional[List[int]] = None,
+    group_name: Optional[str] = None,
+    group_names: Optional[List[str]] = None,
+    period_level: Optional[int] = None,
+    period_levels: Optional[List[int]] = None,
+    exact_date: Optional[date] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    columns: Optional[List[str]] = None,
+    result_format: str = "pandas",
+    use_cache: bool = True,
+) -> Union[pd.DataFrame, "pa.Table", Dict[str, np.ndarray]]:
+    """
+    Fetch fact rows matching the filters as a DataFrame.
+
+    Runs a Core SELECT of only the requested ``columns`` (default: all facts
+    columns) on the session's connection, without building ORM objects, and
+    assembles the frame column-wise with fixed dtypes (see ``FACT_DTYPES``):
+    ``date`` is datetime64 and ``value`` float64.
+
+    ``result_format`` may also be ``"arrow"`` (a ``pyarrow.Table``) or
+    ``"numpy"`` (a dict of arrays), both with dictionary-encoded group names;
+    see :func:`_format_facts`.
+
+    Results are served from ``QUERY_CACHE`` when the same (normalised) query
+    already ran at the current database epoch and facts generation, or from
+    the shared Arrow cache of another process when ``MDA_SHARED_CACHE_DIR`` is
+    set (an ``arrow`` result is then the memory-mapped table itself).
+    Concurrent identical misses are coalesced by ``QUERY_FLIGHTS``: one caller
+    runs the query and the others wait for and share its result. Pass
+    ``use_cache=False`` to always run the query.
+    """
+    if result_format not in RESULT_FORMATS:
+        raise ValueError(f"result_format must be one of {RESULT_FORMATS}, got {result_format!r}")
+    version = read_facts_version(session)
+    GROUP_REGISTRY.validate(version[0])
+    conditions = _fact_conditions(
+        metric_id, metric_ids, group_name, group_names, period_level, period_levels, exact_date, date_from, date_to,
+        session=session,
+    )
+    selected = _fact_select_columns(columns)
+    names = [c.key for c in selected]
+
+    def _load() -> Dict[str, np.ndarray]:
+        rows = session.execute(select(*selected).where(and_(*conditions))).all()
+        LOGGER.info(f"Query returned {len(rows)} rows.")
+        return _fact_arrays(names, rows, session)
+
+    if not use_cache:
+        return _format_facts(_load(), result_format)
+    spec = FactQuery(
+        metric_id, metric_ids, group_name, group_names, period_level, period_levels, exact_date, date_from, date_to
+    )
+    key = (spec.normalized(), tuple(names), version)
+    if result_format == "arrow" and SHARED_QUERY_CACHE.enabled:
+        table = SHARED_QUERY_CACHE.get(key)
+        if table is not None:
+            return table
+    data = _cached_facts(key)
+    if data is None:
+        data, shared = QUERY_FLIGHTS.do(key, lambda: _load_and_cache(key, _load))
+        if shared:
+            data = {name: values.copy() for name, values in data.items()}
+    return _format_facts(data, result_format)
+
+
+def iter_query_facts(
+    session: SessionClass,
+    metric_id: Optional[int] = None,
+    metric_ids: Optional[List[int]] = None,
+    group_name: Optional[str] = None,
+    group_names: Optional[List[str]] = None,
+    period_level: Optional[int] = None,
+    period_levels: Optional[List[int]] = None,
+    exact_date: Optional[date] = None,
+    date_from: Optional[date] = None,
+    date_to: Optional[date] = None,
+    columns: Optional[List[str]] = None,
+    result_format: str = "pandas",
+    chunk_size: int = 100_000,
+) -> Iterator[Union[pd.DataFrame, "pa.Table", Dict[str, np.ndarray]]]:
+    """
+    Streaming variant of :func:`query_facts` for exports and full rebuilds.
+
+    Same filters, columns and result formats, but the rows are fetched from
+    a streaming cursor ``chunk_size`` at a time and yielded as one result per
+    chunk, so memory stays bounded by the chunk size whatever the number of
+    matching rows. Nothing is cached. The session's connection is busy until
+    the iterator is exhausted or closed. Empty results yield no chunks.
+    """
+    if result_format not in RESULT_FORMATS:
+        raise ValueError(f"result_format must be one of {RESULT_FORMATS}, got {result_format!r}")
+    if chunk_size < 1:
+        raise ValueError(f"chunk_size must be positive, got {chunk_size}")
+    GROUP_REGISTRY.validate(read_facts_version(session)[0])
+    conditions = _fact_conditions(
+        metric_id, metric_ids, group_name, group_names, period_level, period_levels, exact_date, date_from, date_to,
+        session=session,
+    )
+    selected = _fact_select_columns(columns)
+    names = [c.key for c in selected]
+
+    result = session.execute(select(*selected).where(and_(*conditions)), execution_options={"yield_per": chunk_size})
+    total = 0
+    try:
+        for rows in result.partitions():
+            total += len(rows)
+            yield _format_facts(_fact_arrays(names, rows, session), result_format)
+    finally:
+        result.close()
+        LOGGER.info(f"Streamed {total} rows in chunks of {chunk_size}.")
+
+
+# SQLite's default SQLITE_MAX_COMPOUND_SELECT: SELECTs per UNION ALL statement.
+MAX_COMPOUND_SELECT = 500
+
+
+def query_facts_many(
+    session: SessionClass,
+    specs: Mapping[Hashable, FactQuery],
+    columns: Optional[List[str]] = None,
+    use_cache: bool = True,
+) -> Dict[Hashable, pd.DataFrame]:
+    """
+    Run many query_facts filter sets in one round trip.
+
+    Each spec becomes one SELECT tagged with its position; the SELECTs are
+    combined with UNION ALL (in statements of at most ``MAX_COMPOUND_SELECT``)
+    and the rows are split back by tag. Returns a dict with the keys of
+    *specs*, each value being the DataFrame ``query_facts`` would return for
+    that spec (rows matching several specs appear in each). Specs already in
+    the result caches are served from them and left out of the SQL.
+    """
+    if not specs:
+        return {}
+    selected = _fact_select_columns(columns)
+    names = [c.key for c in selected]
+
+    results: Dict[Hashable, Dict[str, np.ndarray]] = {}
+    cache_keys: Dict[Hashable, tuple] = {}
+    version = read_facts_version(session)
+    GROUP_REGISTRY.validate(version[0])
+    if use_cache:
+        for key, spec in specs.items():
+            cache_keys[key] = (spec.normalized(), tuple(names), version)
+            cached = _cached_facts(cache_keys[key])
+            if cached is not None:
+                results[key] = cached
+    keys = [key for key in specs if key not in results]
+
+    rows = []
+    for start in range(0, len(keys), MAX_COMPOUND_SELECT):
+        selects = [
+            select(literal(i, Integer).label("spec"), *selected).where(
+                and_(*_fact_conditions(*astuple(specs[keys[i]]), session=session))
+            )
+            for i in range(start, min(start + MAX_COMPOUND_SELECT, len(keys)))
+        ]
+        stmt = selects[0] if len(selects) == 1 else union_all(*selects)
+        rows.extend(session.execute(stmt).all())
+    LOGGER.info(f"Batched query of {len(keys)} specs ({len(results)} cached) returned {len(rows)} rows.")
+
+    by_spec: Dict[int, list] = {i: [] for i in range(len(keys))}
+    for row in rows:
+        by_spec[row[0]].append(row[1:])
+    for i, key in enumerate(keys):
+        results[key] = _fact_arrays(names, by_spec[i], session)
+        if use_cache:
+            _cache_facts(cache_keys[key], results[key])
+    return {key: _format_facts(results[key], "pandas") for key in specs}
 
 
 def get_date_range_by_datekey(period_level: int, datekey: date) -> str:
@@ -150,6 +506,45 @@ def get_date_range_by_datekey(period_level: int, datekey: date) -> str:
     return f"{start_str} to {end_str}"
 
 
+# Months from a period's first month to its last month, per period level
+# (month_of_year is 0-based). Daily periods end on their start date.
+TIME_PERIOD_ENDS = {
+    1: lambda month_of_year: np.zeros_like(month_of_year),
+    2: lambda month_of_year: np.zeros_like(month_of_year),
+    3: lambda month_of_year: 2 - month_of_year % 3,
+    4: lambda month_of_year: 11 - month_of_year,
+}
+
+# Top-level buckets of convert_jargons, in precedence order, with their metric flag.
+JARGON_CATEGORIES = {"retail": "is_retail", "survey": "is_survey", "marketing": "is_marketing"}
+
+
+def date_range_labels(period_levels, dates) -> np.ndarray:
+    """
+    Array form of :func:`get_date_range_by_datekey`: the "YYYYMMDD to YYYYMMDD"
+    label of every (period_level, period start date) pair.
+    """
+    levels = np.asarray(period_levels, dtype=np.int64)
+    starts = pd.to_datetime(pd.Series(dates)).to_numpy().astype("datetime64[D]")
+    unsupported = ~np.isin(levels, list(TIME_PERIOD_ENDS))
+    if unsupported.any():
+        raise ValueError(f"Unsupported period level: {levels[unsupported][0]}")
+
+    # last day of the period = first day of the month after its last month, minus a day
+    months = starts.astype("datetime64[M]")
+    month_of_year = months.astype(np.int64) % 12  # 0 = January
+    last_month = months + np.select(
+        [levels == level for level in TIME_PERIOD_ENDS],
+        [end(month_of_year) for end in TIME_PERIOD_ENDS.values()],
+    )
+    ends = np.where(levels == 1, starts, (last_month + 1).astype("datetime64[D]") - 1)
+
+    def _compact(days: np.ndarray) -> np.ndarray:
+        return np.char.replace(np.datetime_as_string(days, unit="D"), "-", "")
+
+    return np.char.add(np.char.add(_compact(starts), " to "), _compact(ends)).astype(object)
+
+
 def convert_jargons(df: pd.DataFrame, session: SessionClass):
     """
     Transform a fact table into the nested dict structure:
@@ -158,122 +553,79 @@ def convert_jargons(df: pd.DataFrame, session: SessionClass):
     Notes
     -----
     * A metric can live in only one category; precedence is retail > survey > marketing.
-      (Adjust the precedence list if your schema allows overlaps.)
+      (Adjust the precedence in JARGON_CATEGORIES if your schema allows overlaps.)
     * Unknown / uncategorised metrics go into an "other" bucket so nothing is lost.
-    * Site and metric metadata are cached to minimise round-trips.
+    * Date ranges are labelled once per distinct (period_level, date), metric
+      categories come from one join against the cached metrics, and the leaves
+      are built per (metric, group) group rather than per row.
     """
     # ── Basic guards & setup ───────────────────────────────────────────────────────────
     df = df.drop(columns=["record_inserted_date", "id"], errors="ignore")
-    LOGGER.info(df)
+    LOGGER.debug(f"Converting {len(df)} fact rows")
 
     nested_result = {"result": {"retail": {}, "survey": {}, "marketing": {}, "other": {}}}
     if df.empty:
         LOGGER.error("Empty DataFrame")
         return nested_result
 
-    # ── Pre-compute the human-readable date_range ──────────────────────────────────────
-    df["date_range"] = df.apply(
-        lambda x: get_date_range_by_datekey(x["period_level"], x["date"]), axis=1
-    )
-    df = df.drop(columns=["date", "period_level"])
-
-    # ── Tiny caches to avoid repeated look-ups ─────────────────────────────────────────
-    metric_cache: dict[int, Any] = {}
-    site_cache: dict[str, Any] = {}
-
-    # ── Row-wise build of the nested structure ────────────────────────────────────────
-    for row in df.itertuples(index=False):
-        metric_id   = row.metric_id
-        group_name  = row.group_name
-        date_range  = row.date_range
-        value       = row.value
-
-        # ── Metric metadata & category -------------------------------------------------
-        if metric_id not in metric_cache:
-            metric_meta = getMetricByID(session=session, metric_id=metric_id)
-            metric_cache[metric_id] = metric_meta
-        else:
-            metric_meta = metric_cache[metric_id]
-
-        # Decide which top-level bucket the metric belongs to
-        if getattr(metric_meta, "is_retail", False):
-            category = "retail"
-        elif getattr(metric_meta, "is_survey", False):
-            category = "survey"
-        elif getattr(metric_meta, "is_marketing", False):
-            category = "marketing"
-        else:
-            category = "other"
+    # ── Human-readable date_range, computed per distinct period ───────────────────────
+    periods = df[["period_level", "date"]].drop_duplicates()
+    periods["date_range"] = date_range_labels(periods["period_level"], periods["date"])
+    df = df.merge(periods, on=["period_level", "date"], how="left", sort=False)
 
-        cat_dict = nested_result["result"][category]
-
-        # ── Initialise metric node if needed ------------------------------------------
+    # ── Metric metadata & category, one join against the metadata cache ──────────────
+    metrics = pd.DataFrame(
+        [(m.id, *(bool(getattr(m, flag)) for flag in JARGON_CATEGORIES.values())) for m in METADATA_CACHE.metrics()],
+        columns=["metric_id", *JARGON_CATEGORIES],
+    )
+    metric_ids = pd.DataFrame({"metric_id": pd.unique(df["metric_id"])})
+    metric_ids = metric_ids.merge(metrics, on="metric_id", how="left").fillna(False)
+    metric_ids["category"] = np.select(
+        [metric_ids[c].astype(bool) for c in JARGON_CATEGORIES], list(JARGON_CATEGORIES), default="other"
+    )
+    categories = dict(zip(metric_ids["metric_id"].tolist(), metric_ids["category"]))
+
+    # ── Grouped build of the nested structure ────────────────────────────────────────
+    labels = df["date_range"].to_numpy()
+    values = df["value"].to_numpy()
+    site_cache: Dict[str, Optional[Sites]] = {}
+    for (metric_id, group_name), rows in df.groupby(["metric_id", "group_name"], sort=False).indices.items():
+        metric_id = int(metric_id)
+        cat_dict = nested_result["result"][categories[metric_id]]
         if metric_id not in cat_dict:
-            cat_dict[metric_id] = {"metadata": metric_meta}
-
+            cat_dict[metric_id] = {"metadata": getMetricByID(session=session, metric_id=metric_id)}
         metric_dict = cat_dict[metric_id]
 
-        # ── Site metadata --------------------------------------------------------------
-        if group_name not in metric_dict:
-            if group_name not in site_cache:
-                site_cache[group_name] = getSiteByID(session=session, site_id=group_name)
-            metric_dict[group_name] = {"metadata": site_cache[group_name]}
-
-        # ── Assign the actual datapoint -----------------------------------------------
-        metric_dict[group_name][date_range] = value
+        if group_name not in site_cache:
+            site_cache[group_name] = getSiteByID(session=session, site_id=group_name)
+        leaf = metric_dict.setdefault(group_name, {"metadata": site_cache[group_name]})
+        leaf.update(zip(labels[rows].tolist(), values[rows].tolist()))
 
     return nested_result
 
 
-
-
-    
-
-
 def getMetricFromCategory(session: SessionClass, category: List[str]) -> List[int]:
+    """
+    Return the ids of the metrics in the given categories (all metrics for
+    an empty list or "*"). Served from the metadata cache; ``session`` is
+    kept for compatibility.
+    """
     # If no category is specified, return all metrics
     if not category or "*" in category:
-        all_ids = session.query(Metrics.id).all()
-        return [metric_id for (metric_id,) in all_ids]
-
-    # Build individual queries based on the category
-    query_parts = []
-    if "Retail" in category:
-        query_parts.append(session.query(
-            Metrics.id).filter(Metrics.is_retail == True))
-    if "Email & Social Media" in category:
-        query_parts.append(session.query(Metrics.id).filter(
-            Metrics.is_marketing == True))
-    if "Customer Survey" in category:
-        query_parts.append(session.query(
-            Metrics.id).filter(Metrics.is_survey == True))
-
-    if not query_parts:
-        return []
-
-    # Union all queries into one
-    combined_query = query_parts[0]
-    for q in query_parts[1:]:
-        combined_query = combined_query.union(q)
-
-    # Execute and retrieve a unique list of IDs
-    # returns list of tuples, e.g. [(1,), (2,), ...]
-    results = combined_query.all()
-    distinct_ids = [r[0] for r in results]
-    return distinct_ids
+        return sorted(m.id for m in METADATA_CACHE.metrics())
+    return METADATA_CACHE.metric_ids_for_categories(category)
 
 
 def getSiteByID(session: SessionClass, site_id: int) -> Optional[Sites]:
     """
-    Retrieve a Sites record by its site_id, using an existing session.
+    Retrieve a Sites record by its site_id from the metadata cache.
 
-    :param session: An existing SQLAlchemy Session.
+    :param session: Unused; kept for compatibility.
     :param site_id: ID of the site to retrieve.
-    :return: A Sites object if found, otherwise None.
+    :return: A (detached, read-only) Sites object if found, otherwise None.
     """
     try:
-        site = session.query(Sites).filter_by(site_id=site_id).first()
-        return site
+        return METADATA_CACHE.site(site_id)
     except Exception as e:
         LOGGER.error(f"Error fetching site_id={site_id}: {e}")
         return None
@@ -281,15 +633,15 @@ def getSiteByID(session: SessionClass, site_id: int) -> Optional[Sites]:
 
 def getMetricByID(session: SessionClass, metric_id: int) -> Optional[Dict[str, str]]:
     """
-    Retrieve a Metrics record by its primary key ID, using an existing session.
+    Retrieve a Metrics record by its primary key ID from the metadata cache.
     Return a dictionary with only 'metric_name' and 'metric_desc'.
 
-    :param session: An existing SQLAlchemy Session.
+    :param session: Unused; kept for compatibility.
     :param metric_id: ID of the metric to retrieve.
     :return: A dict with {'metric_name': ..., 'metric_desc': ...} if found, otherwise None.
     """
     try:
-        metric = session.query(Metrics).filter_by(id=metric_id).first()
+        metric = METADATA_CACHE.metric(metric_id)
         if metric is None:
             return None
 
@@ -302,14 +654,13 @@ def getMetricByID(session: SessionClass, metric_id: int) -> Optional[Dict[str, s
 
 def getSites(session: SessionClass) -> List[Sites]:
     """
-    Retrieve all Sites records from the database.
+    Retrieve all Sites records from the metadata cache.
 
-    :param session: An existing SQLAlchemy Session.
-    :return: A list of Sites objects.
+    :param session: Unused; kept for compatibility.
+    :return: A list of (detached, read-only) Sites objects.
     """
     try:
-        sites = session.query(Sites).all()
-        return sites
+        return METADATA_CACHE.sites()
     except Exception as e:
         LOGGER.error(f"Error fetching all sites: {e}")
         return []
@@ -317,14 +668,13 @@ def getSites(session: SessionClass) -> List[Sites]:
 
 def getCamps(session: SessionClass) -> List[Camps]:
     """
-    Retrieve all Camps records from the database.
+    Retrieve all Camps records from the metadata cache.
 
-    :param session: An existing SQLAlchemy Session.
-    :return: A list of Camps objects.
+    :param session: Unused; kept for compatibility.
+    :return: A list of (detached, read-only) Camps objects.
     """
     try:
-        camps = session.query(Camps).all()
-        return camps
+        return METADATA_CACHE.camps()
     except Exception as e:
         LOGGER.error(f"Error fetching all camps: {e}")
         return []
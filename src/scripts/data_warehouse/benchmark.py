@@ -0,0 +1,208 @@
+"""
+Before/after benchmark of the facts query shapes against storage and index layouts.
+
+    python -m src.scripts.data_warehouse.benchmark [path/to/database.sqlite3] [--repeat N]
+
+The database is copied to a temporary file first (the original is never
+modified). Each layout is applied to the copy, the planner statistics are
+refreshed, and every query shape is timed (median of ``--repeat`` runs,
+rows fully fetched) together with its query plan, the cost of upserting
+a batch of rows and the space the database uses. Run it against a copy of
+production-sized data; on a small development database every layout looks
+fast.
+"""
+
+import argparse
+import os
+import sqlite3
+import statistics
+import tempfile
+import time
+from functools import partial
+from typing import Callable, Dict, List, Tuple
+
+import pandas as pd
+
+from src.scripts.data_warehouse.models.warehouse import FACT_INDEXES, db_path, migrate_facts_layout, upgrade_indexes
+from src.utils.logging import LOGGER
+
+# name -> SQL; the parameters are picked from the data by _benchmark_params.
+BENCHMARK_QUERIES: Dict[str, str] = {
+    "page: metric + sites + level (all columns)": (
+        "SELECT * FROM facts WHERE metric_id = :metric_id AND group_id IN ({sites}) AND period_level = 1"
+    ),
+    "page: metric + sites + level (date, group, value)": (
+        "SELECT date, group_id, value FROM facts "
+        "WHERE metric_id = :metric_id AND group_id IN ({sites}) AND period_level = 1"
+    ),
+    "report: metric + 'all' + month": (
+        "SELECT date, group_id, value FROM facts "
+        "WHERE metric_id = :metric_id AND group_id = :all_group AND period_level = 2 AND date = :month"
+    ),
+    "month picker: metric + month across groups": (
+        "SELECT group_id, value FROM facts WHERE metric_id = :metric_id AND period_level = 2 AND date = :month"
+    ),
+    "daily range across groups": (
+        "SELECT group_id, date, value FROM facts "
+        "WHERE metric_id = :metric_id AND period_level = 1 AND date BETWEEN :day_from AND :day_to"
+    ),
+    "rollup source: monthly buckets of daily rows": (
+        "SELECT group_id, substr(date, 1, 7) AS bucket, SUM(value) FROM facts "
+        "WHERE metric_id = :metric_id AND period_level = 1 GROUP BY group_id, bucket"
+    ),
+}
+
+# Rows upserted (then rolled back) to measure the write cost of each layout.
+WRITE_BATCH_ROWS = 20_000
+
+
+def _drop_fact_indexes(conn: sqlite3.Connection) -> None:
+    for name, _ in FACT_INDEXES:
+        conn.execute(f"DROP INDEX IF EXISTS {name}")
+    conn.commit()
+
+
+def _rowid_layout(conn: sqlite3.Connection, indexes: Callable[[sqlite3.Connection], object]) -> None:
+    migrate_facts_layout(conn, "rowid")
+    indexes(conn)
+
+
+# Layout name -> function bringing the copy to that layout.
+LAYOUTS: Dict[str, Callable[[sqlite3.Connection], object]] = {
+    "rowid, unique key only": partial(_rowid_layout, indexes=_drop_fact_indexes),
+    "rowid + FACT_INDEXES": partial(_rowid_layout, indexes=upgrade_indexes),
+    "clustered WITHOUT ROWID": partial(migrate_facts_layout, layout="clustered"),
+}
+
+
+def _benchmark_params(conn: sqlite3.Connection) -> Dict[str, object]:
+    """Pick the busiest metric and realistic dates / sites from the data."""
+    metric_id, = conn.execute(
+        "SELECT metric_id FROM facts WHERE period_level = 1 GROUP BY metric_id ORDER BY COUNT(*) DESC LIMIT 1"
+    ).fetchone()
+    sites = [
+        row[0]
+        for row in conn.execute(
+            "SELECT DISTINCT group_id FROM facts "
+            "WHERE metric_id = ? AND group_id IN (SELECT id FROM groups WHERE kind = 'site') LIMIT 20",
+            (metric_id,),
+        )
+    ]
+    all_group, = conn.execute("SELECT id FROM groups WHERE natural_key = 'all'").fetchone() or (-1,)
+    last_day, = conn.execute(
+        "SELECT MAX(date) FROM facts WHERE metric_id = ? AND period_level = 1", (metric_id,)
+    ).fetchone()
+    last = pd.Timestamp(last_day)
+    return {
+        "metric_id": metric_id,
+        "sites": sites,
+        "all_group": all_group,
+        "month": last.replace(day=1).strftime("%Y-%m-%d"),
+        "day_from": (last - pd.Timedelta(days=90)).strftime("%Y-%m-%d"),
+        "day_to": last.strftime("%Y-%m-%d"),
+    }
+
+
+def _time_query(conn: sqlite3.Connection, sql: str, params: Dict[str, object], repeat: int) -> Tuple[float, int]:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        rows = conn.execute(sql, params).fetchall()
+        timings.append((time.perf_counter() - started) * 1000)
+    return statistics.median(timings), len(rows)
+
+
+def _query_plan(conn: sqlite3.Connection, sql: str, params: Dict[str, object]) -> str:
+    return "; ".join(row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {sql}", params))
+
+
+def _time_write(conn: sqlite3.Connection) -> float:
+    """Milliseconds to upsert WRITE_BATCH_ROWS new fact rows (rolled back)."""
+    days = pd.date_range("2000-01-01", periods=WRITE_BATCH_ROWS // 100 + 1).strftime("%Y-%m-%d")
+    rows = [(-1, i % 100 + 1, float(i), days[i // 100], 1) for i in range(WRITE_BATCH_ROWS)]
+    started = time.perf_counter()
+    conn.executemany(
+        "INSERT INTO facts (metric_id, group_id, value, date, period_level) VALUES (?, ?, ?, ?, ?) "
+        "ON CONFLICT (metric_id, group_id, date, period_level) DO UPDATE SET value = excluded.value",
+        rows,
+    )
+    elapsed = (time.perf_counter() - started) * 1000
+    conn.rollback()
+    return elapsed
+
+
+def run_benchmark(source: str = db_path, repeat: int = 20, layouts: List[str] = None) -> pd.DataFrame:
+    """
+    Time every ``BENCHMARK_QUERIES`` shape (plus a write batch) under each
+    layout in ``LAYOUTS`` on a temporary copy of *source*. Returns one row
+    per (layout, query) with the median milliseconds, row count and plan.
+    """
+    layouts = layouts or list(LAYOUTS)
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        copy = os.path.join(tmp, "benchmark.sqlite3")
+        with sqlite3.connect(source) as src, sqlite3.connect(copy) as dst:
+            src.backup(dst)  # consistent snapshot, WAL included
+
+        conn = sqlite3.connect(copy)
+        try:
+            params = _benchmark_params(conn)
+            sites = params.pop("sites")
+            site_params = {f"s{i}": site for i, site in enumerate(sites)}
+            site_list = ", ".join(f":s{i}" for i in range(len(sites)))
+            LOGGER.info(f"Benchmark on {source}: metric {params['metric_id']}, {len(sites)} sites")
+
+            for layout in layouts:
+                started = time.perf_counter()
+                LAYOUTS[layout](conn)
+                conn.execute("ANALYZE facts")
+                conn.commit()
+                LOGGER.info(f"Layout {layout!r} applied in {time.perf_counter() - started:.1f}s")
+                used_pages = (conn.execute("PRAGMA page_count").fetchone()[0]
+                              - conn.execute("PRAGMA freelist_count").fetchone()[0])
+                size_mb = used_pages * conn.execute("PRAGMA page_size").fetchone()[0] / 1e6
+
+                for name, sql in BENCHMARK_QUERIES.items():
+                    sql = sql.format(sites=site_list)
+                    query_params = {**params, **site_params}
+                    median_ms, rows = _time_query(conn, sql, query_params, repeat)
+                    results.append({
+                        "layout": layout, "query": name, "median_ms": median_ms, "rows": rows,
+                        "plan": _query_plan(conn, sql, query_params), "db_mb": size_mb,
+                    })
+                results.append({
+                    "layout": layout, "query": f"write: upsert {WRITE_BATCH_ROWS} rows",
+                    "median_ms": _time_write(conn), "rows": WRITE_BATCH_ROWS, "plan": "", "db_mb": size_mb,
+                })
+        finally:
+            conn.close()
+    return pd.DataFrame(results)
+
+
+def summarize(results: pd.DataFrame) -> pd.DataFrame:
+    """
+    Median milliseconds per query (rows) and layout (columns), plus the
+    megabytes the database uses, with the ratio of the first layout to
+    each other one (above 1 = faster / smaller).
+    """
+    table = results.pivot_table(index="query", columns="layout", values="median_ms", sort=False)
+    layouts = list(dict.fromkeys(results["layout"]))
+    table = table[layouts]
+    table.loc["database size (MB)"] = results.groupby("layout", sort=False)["db_mb"].first()[layouts]
+    for layout in layouts[1:]:
+        table[f"x {layout}"] = table[layouts[0]] / table[layout]
+    return table
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("database", nargs="?", default=db_path)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--layout", action="append", choices=list(LAYOUTS), help="default: all layouts")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.database, args.repeat, args.layout)
+    with pd.option_context("display.width", 200, "display.max_colwidth", 120, "display.float_format", "{:.2f}".format):
+        print(summarize(results).to_string())
+        print()
+        print(results[["layout", "query", "plan"]].to_string(index=False))
@@ -0,0 +1,553 @@
+import hashlib
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Callable, Dict, Hashable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from src.scripts.data_warehouse.models.warehouse import (
+    Base,
+    Camps,
+    Generation,
+    Groups,
+    Metrics,
+    SessionLocal,
+    Sites,
+    engine,
+)
+from src.utils.logging import LOGGER
+
+try:
+    import pyarrow as pa
+except ImportError:
+    pa = None
+
+# Generation names bumped by the dimension loaders (one per table).
+METADATA_GENERATIONS = ("metrics", "sites", "camps")
+# Generation bumped after every committed write to the facts table.
+FACTS_GENERATION = "facts"
+# Generations row holding a random id assigned when the database is created,
+# so results cached for one database are never served for a re-created one.
+DATABASE_EPOCH = "epoch"
+
+# Metric category flag per getMetricFromCategory label.
+CATEGORY_FLAGS = {
+    "Retail": "is_retail",
+    "Email & Social Media": "is_marketing",
+    "Customer Survey": "is_survey",
+}
+
+_table_ready = False
+
+
+def _ensure_table() -> None:
+    """Create the generations table and the database epoch on databases that predate them."""
+    global _table_ready
+    if not _table_ready:
+        Base.metadata.create_all(engine, tables=[Generation.__table__])
+        stmt = sqlite_insert(Generation).values(name=DATABASE_EPOCH, value=uuid.uuid4().int >> 65)
+        with engine.begin() as conn:
+            conn.execute(stmt.on_conflict_do_nothing(index_elements=["name"]))
+        _table_ready = True
+
+
+def bump_generation(name: str) -> None:
+    """Record that *name* (a table) changed, invalidating caches built on it."""
+    _ensure_table()
+    stmt = sqlite_insert(Generation).values(name=name, value=1)
+    stmt = stmt.on_conflict_do_update(index_elements=["name"], set_={"value": Generation.value + 1})
+    with SessionLocal() as session:
+        session.execute(stmt)
+        session.commit()
+    if name in METADATA_GENERATIONS:
+        # this process sees its own change immediately
+        METADATA_CACHE.expire()
+
+
+def read_generations() -> Dict[str, int]:
+    """Current generation of every table that has one (missing = 0)."""
+    _ensure_table()
+    with SessionLocal() as session:
+        return dict(session.execute(select(Generation.name, Generation.value)).all())
+
+
+def read_facts_version(session) -> Tuple[int, int]:
+    """
+    ``(database epoch, facts generation)`` read on the caller's session: the
+    part of every query cache key that changes when the facts do.
+    """
+    _ensure_table()
+    stmt = select(Generation.name, Generation.value).where(Generation.name.in_((DATABASE_EPOCH, FACTS_GENERATION)))
+    values = dict(session.execute(stmt).all())
+    return values.get(DATABASE_EPOCH, 0), values.get(FACTS_GENERATION, 0)
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    misses: int = 0
+    reloads: int = 0
+    evictions: int = 0
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+class MetadataCache:
+    """
+    In-process cache of the metrics, sites and camps dimensions.
+
+    Each table is loaded once into indexed structures and reloaded only
+    after its generation (see :func:`bump_generation`) changes. The
+    generation check is a single small query, run at most once every
+    ``revalidate_seconds``. Cached ORM objects are detached and shared;
+    treat them as read-only.
+    """
+
+    def __init__(self, revalidate_seconds: float = 5.0):
+        self.revalidate_seconds = revalidate_seconds
+        self.stats = CacheStats()
+        self._lock = threading.RLock()
+        self._generations: Dict[str, int] = {}
+        self._checked_at = float("-inf")
+        self._metrics: Optional[Dict[int, Metrics]] = None
+        self._sites: Optional[Dict[int, Sites]] = None
+        self._camps: Optional[List[Camps]] = None
+
+    def invalidate(self) -> None:
+        """Drop everything; the next lookup reloads."""
+        with self._lock:
+            self._metrics = self._sites = self._camps = None
+            self._checked_at = float("-inf")
+
+    def expire(self) -> None:
+        """Check the generations on the next lookup instead of waiting for the interval."""
+        self._checked_at = float("-inf")
+
+    def stats_dict(self) -> Dict[str, float]:
+        return {"hits": self.stats.hits, "misses": self.stats.misses, "hit_rate": self.stats.hit_rate}
+
+    def _revalidate(self) -> None:
+        now = time.monotonic()
+        if now - self._checked_at < self.revalidate_seconds:
+            return
+        generations = read_generations()
+        for name in METADATA_GENERATIONS:
+            if generations.get(name, 0) != self._generations.get(name, 0):
+                LOGGER.info(f"Metadata cache: {name} generation changed, dropping cached {name}")
+                setattr(self, f"_{name}", None)
+        self._generations = generations
+        self._checked_at = now
+
+    def _table(self, name: str):
+        """Return the cached structure for *name*, loading it on a miss."""
+        with self._lock:
+            self._revalidate()
+            cached = getattr(self, f"_{name}")
+            if cached is not None:
+                self.stats.hits += 1
+                return cached
+
+            self.stats.misses += 1
+            self.stats.reloads += 1
+            with SessionLocal() as session:
+                if name == "metrics":
+                    rows = session.query(Metrics).all()
+                    cached = {m.id: m for m in rows}
+                elif name == "sites":
+                    rows = session.query(Sites).all()
+                    cached = {s.site_id: s for s in rows}
+                else:
+                    cached = rows = session.query(Camps).all()
+                session.expunge_all()
+            setattr(self, f"_{name}", cached)
+            LOGGER.info(f"Metadata cache: loaded {len(rows)} {name}")
+            return cached
+
+    def metric(self, metric_id: int) -> Optional[Metrics]:
+        return self._table("metrics").get(int(metric_id))
+
+    def metrics(self) -> List[Metrics]:
+        return list(self._table("metrics").values())
+
+    def metric_ids_for_categories(self, categories: List[str]) -> List[int]:
+        flags = [CATEGORY_FLAGS[c] for c in categories if c in CATEGORY_FLAGS]
+        return sorted(m.id for m in self._table("metrics").values() if any(getattr(m, f) for f in flags))
+
+    def site(self, site_id) -> Optional[Sites]:
+        try:
+            key = int(site_id)
+        except (TypeError, ValueError):
+            # hierarchy groups such as 'all' or a camp name are not sites
+            return None
+        return self._table("sites").get(key)
+
+    def sites(self) -> List[Sites]:
+        return list(self._table("sites").values())
+
+    def camps(self) -> List[Camps]:
+        return list(self._table("camps"))
+
+
+METADATA_CACHE = MetadataCache()
+
+
+class GroupRegistry:
+    """
+    In-process map between group natural keys (the ``group_name`` callers
+    see) and the ``groups.id`` values stored in facts.
+
+    Ids are only meaningful within one database: re-creating the warehouse
+    numbers the groups afresh. Readers therefore pass the current database
+    epoch (see :func:`read_facts_version`) to :meth:`validate` before a
+    lookup, which forgets a map loaded from another database. Within one
+    database groups are only added, so an unknown name or id just reloads
+    the map, on the caller's *session* when one is given (so a reader never
+    needs a second pooled connection). Writers do not use this map; they
+    resolve names to ids inside their own write transaction.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._epoch: Optional[int] = None
+        self._ids: Dict[str, int] = {}
+        self._names = np.empty(0, dtype=object)  # indexed by id, None = no such group
+
+    def validate(self, epoch: int) -> None:
+        """Drop the map if it was loaded from a database other than *epoch*'s."""
+        with self._lock:
+            if epoch != self._epoch:
+                self._epoch = epoch
+                self._ids = {}
+                self._names = np.empty(0, dtype=object)
+
+    def _reload(self, session=None) -> None:
+        stmt = select(Groups.id, Groups.natural_key)
+        if session is not None:
+            rows = session.execute(stmt).all()
+        else:
+            with engine.connect() as conn:
+                rows = conn.execute(stmt).all()
+        names = np.full(max((group_id for group_id, _ in rows), default=-1) + 1, None, dtype=object)
+        for group_id, key in rows:
+            names[group_id] = key
+        self._ids = {key: group_id for group_id, key in rows}
+        self._names = names
+        LOGGER.info(f"Group registry: loaded {len(rows)} groups")
+
+    def ids(self, names, session=None) -> np.ndarray:
+        """``groups.id`` of each name (compared as str) as an int64 array; -1 for names without a group."""
+        codes, keys = pd.factorize(pd.Series(names, dtype=object).astype(str))
+        key_ids = keys.map(self._ids)
+        if key_ids.isna().any():
+            with self._lock:
+                self._reload(session)
+            key_ids = keys.map(self._ids)
+        key_ids = np.asarray(key_ids.fillna(-1), dtype=np.int64)
+        return key_ids[codes] if len(codes) else np.empty(0, dtype=np.int64)
+
+    def id(self, name, session=None) -> int:
+        """``groups.id`` of one name, -1 if it has none."""
+        return int(self.ids([name], session)[0])
+
+    def names(self, ids, session=None) -> np.ndarray:
+        """Natural key of each group id as an object array."""
+        ids = np.asarray(ids, dtype=np.int64)
+        if ids.size and (ids.max() >= len(self._names) or pd.isna(self._names[ids]).any()):
+            with self._lock:
+                self._reload(session)
+            if ids.max() >= len(self._names):
+                raise KeyError(f"Unknown group id {ids.max()}")
+        return self._names[ids]
+
+
+GROUP_REGISTRY = GroupRegistry()
+
+
+# Cached query result: one NumPy array per column.
+ColumnArrays = Dict[str, np.ndarray]
+
+
+def column_arrays_nbytes(data: ColumnArrays) -> int:
+    """Approximate memory held by a column-array result, string payloads included."""
+    return int(
+        sum(pd.Series(values).memory_usage(index=False, deep=True) if values.dtype == object else values.nbytes
+            for values in data.values())
+    )
+
+
+class QueryCache:
+    """
+    Bounded LRU cache of query_facts results.
+
+    Keys are the normalised query parameters plus the database epoch and facts
+    generation that were current when the result was read (see
+    :func:`read_facts_version`), so every committed fact write (which bumps
+    the generation) or re-created database (new epoch, generation back at 0)
+    makes older entries unreachable; they age out of the LRU. Entries are
+    sized with :func:`column_arrays_nbytes` and the least recently used ones
+    are evicted once ``max_bytes`` is exceeded. Results are stored as column
+    arrays and handed out as copies.
+    """
+
+    def __init__(self, max_bytes: int = 64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.stats = CacheStats()
+        self.bytes = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[Hashable, Tuple[ColumnArrays, int]]" = OrderedDict()
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def stats_dict(self) -> Dict[str, float]:
+        return {
+            "hits": self.stats.hits,
+            "misses": self.stats.misses,
+            "hit_rate": self.stats.hit_rate,
+            "evictions": self.stats.evictions,
+            "entries": len(self._entries),
+            "bytes": self.bytes,
+        }
+
+    def get(self, key: Hashable) -> Optional[ColumnArrays]:
+        """Copy of the cached result for *key*, or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.stats.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.stats.hits += 1
+        return {name: values.copy() for name, values in entry[0].items()}
+
+    def put(self, key: Hashable, data: ColumnArrays) -> None:
+        """Store a copy of *data* under *key*, evicting LRU entries past ``max_bytes``."""
+        size = column_arrays_nbytes(data)
+        if size > self.max_bytes:
+            return
+        data = {name: values.copy() for name, values in data.items()}
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._entries[key] = (data, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.bytes -= evicted
+                self.stats.evictions += 1
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], ColumnArrays]) -> ColumnArrays:
+        """Cached result for *key*, calling *loader* (and caching its result) on a miss."""
+        data = self.get(key)
+        if data is None:
+            data = loader()
+            self.put(key, data)
+        return data
+
+
+QUERY_CACHE = QueryCache()
+
+
+@dataclass
+class _Flight:
+    done: threading.Event
+    result: object = None
+    error: Optional[BaseException] = None
+    waiters: int = 0
+
+
+@dataclass
+class FlightStats:
+    calls: int = 0
+    coalesced: int = 0
+
+    @property
+    def coalesced_rate(self) -> float:
+        return self.coalesced / self.calls if self.calls else 0.0
+
+
+class SingleFlight:
+    """
+    Coalesce concurrent calls for the same key within one process.
+
+    The first caller of :meth:`do` for a key runs the function; callers that
+    arrive while it is still running wait for it and receive the same result
+    (or exception) instead of running it again. Once the call finishes the
+    key is forgotten, so later calls run afresh (and typically hit a cache).
+    """
+
+    def __init__(self):
+        self.stats = FlightStats()
+        self._lock = threading.Lock()
+        self._flights: Dict[Hashable, _Flight] = {}
+
+    def stats_dict(self) -> Dict[str, float]:
+        return {
+            "calls": self.stats.calls,
+            "coalesced": self.stats.coalesced,
+            "coalesced_rate": self.stats.coalesced_rate,
+            "in_flight": len(self._flights),
+        }
+
+    def do(self, key: Hashable, fn: Callable[[], object]) -> Tuple[object, bool]:
+        """
+        Return ``(result, shared)``; ``shared`` is True when other callers
+        received the same result object (the leader included, if anyone
+        waited on it), which must then be treated as read-only.
+        """
+        with self._lock:
+            self.stats.calls += 1
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight(done=threading.Event())
+            else:
+                self.stats.coalesced += 1
+                flight.waiters += 1
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result = fn()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+            if flight.waiters:
+                LOGGER.debug(f"Single-flight: {flight.waiters} caller(s) shared one call")
+        # the flight is gone, so no waiter can join after this count
+        return flight.result, flight.waiters > 0
+
+
+# Coalesces concurrent identical query_facts cache misses.
+QUERY_FLIGHTS = SingleFlight()
+
+
+# Directory of the cross-process result cache; unset disables it.
+SHARED_CACHE_DIR_ENV = "MDA_SHARED_CACHE_DIR"
+
+
+class SharedQueryCache:
+    """
+    Cross-process cache of query results as Arrow IPC files.
+
+    Meant for several Streamlit processes on one host: point
+    ``MDA_SHARED_CACHE_DIR`` at a shared directory (ideally a tmpfs such as
+    ``/dev/shm/mda-cache``) and every process reads the others' results by
+    memory-mapping the file, so the data is mapped zero-copy instead of being
+    re-queried and held once per process. Files are named by a hash of the
+    database path and the cache key, which carries the database epoch and
+    facts generation, so a write, or a database re-created at the same path
+    while files survive in the directory, makes the old files unreachable.
+    They are pruned oldest-first once the directory exceeds ``max_bytes``.
+    Files are written to a temporary name and renamed, so readers never see a
+    partial file.
+
+    Disabled (every lookup misses) when the directory is not configured or
+    pyarrow is not installed.
+    """
+
+    SUFFIX = ".arrow"
+
+    def __init__(self, directory: Optional[str] = None, max_bytes: int = 512 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.stats = CacheStats()
+        if directory and pa is None:
+            LOGGER.warning("pyarrow is not installed. The shared query cache is disabled.")
+            self.directory = None
+        elif directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @property
+    def enabled(self) -> bool:
+        return self.directory is not None
+
+    def stats_dict(self) -> Dict[str, float]:
+        return {
+            "hits": self.stats.hits,
+            "misses": self.stats.misses,
+            "hit_rate": self.stats.hit_rate,
+            "evictions": self.stats.evictions,
+        }
+
+    def _path(self, key: Hashable) -> str:
+        digest = hashlib.sha256(repr((str(engine.url), key)).encode()).hexdigest()
+        return os.path.join(self.directory, digest + self.SUFFIX)
+
+    def get(self, key: Hashable) -> Optional["pa.Table"]:
+        """Memory-mapped table cached under *key* by any process, or None."""
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        try:
+            table = pa.ipc.open_file(pa.memory_map(path)).read_all()
+        except (FileNotFoundError, pa.ArrowInvalid, OSError):
+            self.stats.misses += 1
+            return None
+        try:
+            os.utime(path)  # recently used: pruned last
+        except OSError:
+            pass
+        self.stats.hits += 1
+        return table
+
+    def put(self, key: Hashable, table: "pa.Table") -> None:
+        if not self.enabled:
+            return
+        path = self._path(key)
+        tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+        try:
+            with pa.OSFile(tmp, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+            os.replace(tmp, path)
+        except OSError as e:
+            LOGGER.warning(f"Shared query cache: could not write {path}: {e}")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            return
+        self._prune()
+
+    def _prune(self) -> None:
+        """Delete least recently used files until the directory fits in ``max_bytes``."""
+        files = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(self.SUFFIX):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:  # pruned by another process
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in files)
+        for _, size, path in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)  # processes that mapped it keep their mapping
+            except FileNotFoundError:
+                pass
+            total -= size
+            self.stats.evictions += 1
+
+
+SHARED_QUERY_CACHE = SharedQueryCache(os.environ.get(SHARED_CACHE_DIR_ENV))
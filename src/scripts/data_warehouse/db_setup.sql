@@ -19,7 +19,8 @@ CREATE TABLE metrics (
     is_quarterly    BOOLEAN DEFAULT 0,
     is_yearly       BOOLEAN DEFAULT 0,
     agg_method      VARCHAR(50) NOT NULL,
-    etl_method      VARCHAR(200) NOT NULL
+    etl_method      VARCHAR(200) NOT NULL,
+    formula         VARCHAR(200) NULL
 );
 
 -- DROP TABLE IF EXISTS period_dim;
@@ -28,17 +29,32 @@ CREATE TABLE metrics (
 --     period_name VARCHAR(15) NOT NULL
 -- );
 
+-- Keep groups and facts in sync with GROUPS_TABLE_SQL, FACTS_TABLE_SQL and
+-- FACT_INDEXES in models/warehouse.py. init_db rebuilds facts in the layout
+-- named by MDA_FACTS_LAYOUT (e.g. the clustered WITHOUT ROWID one), if set.
+DROP TABLE IF EXISTS groups;
+CREATE TABLE IF NOT EXISTS groups (
+    id           INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind         VARCHAR(10) NOT NULL CHECK (kind IN ('site', 'camp', 'format', 'all')),
+    natural_key  VARCHAR(100) NOT NULL UNIQUE,
+    parent_id    INTEGER REFERENCES groups (id)
+);
+
 DROP TABLE IF EXISTS facts;
 CREATE TABLE IF NOT EXISTS facts (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
     metric_id INTEGER NOT NULL,
-    group_name TEXT NOT NULL,
+    group_id INTEGER NOT NULL REFERENCES groups (id),
     value REAL NOT NULL,
+    numerator REAL,
+    denominator REAL,
     date DATE NOT NULL,
     period_level INTEGER NOT NULL,
     record_inserted_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-    UNIQUE (metric_id, group_name, date, period_level)
+    UNIQUE (metric_id, group_id, date, period_level)
 );
+CREATE INDEX IF NOT EXISTS ix_facts_metric_level_group_date ON facts (metric_id, period_level, group_id, date, value);
+CREATE INDEX IF NOT EXISTS ix_facts_metric_level_date_group ON facts (metric_id, period_level, date, group_id, value);
 
 DROP TABLE IF EXISTS camps;
 
@@ -48,3 +64,34 @@ CREATE TABLE camps (
     lat   REAL NOT NULL  CHECK (lat  BETWEEN -90  AND  90),
     long  REAL NOT NULL  CHECK (long BETWEEN -180 AND 180)
 );
+
+DROP TABLE IF EXISTS ingestion_journal;
+CREATE TABLE ingestion_journal (
+    id            INTEGER PRIMARY KEY AUTOINCREMENT,
+    run_id        VARCHAR(32) NOT NULL,
+    file_hash     VARCHAR(64) NOT NULL,
+    stage         VARCHAR(30) NOT NULL,
+    metric_id     INTEGER NOT NULL REFERENCES metrics(id),
+    status        VARCHAR(10) NOT NULL CHECK (status IN ('started', 'done', 'failed')),
+    rows_written  INTEGER,
+    started_at    TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    finished_at   TIMESTAMP,
+    UNIQUE (file_hash, stage, metric_id)
+);
+
+DROP TABLE IF EXISTS generations;
+CREATE TABLE generations (
+    name   VARCHAR(50) PRIMARY KEY,
+    value  INTEGER NOT NULL DEFAULT 0
+);
+-- Random id of this database, part of every query cache key (see cache.py).
+INSERT INTO generations (name, value) VALUES ('epoch', abs(random()));
+
+-- Lifetime fact-write totals per load mode ('normal', 'bulk'), the baseline
+-- bulk_load_mode reports its gain against.
+DROP TABLE IF EXISTS write_throughput;
+CREATE TABLE write_throughput (
+    mode     VARCHAR(10) PRIMARY KEY,
+    rows     INTEGER NOT NULL DEFAULT 0,
+    seconds  REAL NOT NULL DEFAULT 0
+);
@@ -0,0 +1,105 @@
+import re
+from typing import Iterable, List, Optional, Set
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import select, true
+
+from src.scripts.data_warehouse.access import query_facts
+from src.scripts.data_warehouse.models.warehouse import Facts, Groups, Metrics, SessionLocal
+from src.scripts.data_warehouse.utils import replace_facts_atomically
+from src.utils.logging import LOGGER
+
+# A formula is arithmetic over metric references such as "m1 / m3".
+FORMULA_RE = re.compile(r"^[m0-9\s.+\-*/()]+$")
+METRIC_REF_RE = re.compile(r"\bm(\d+)\b")
+# "mA / mB" keeps its operands as the ratio components of the result.
+SIMPLE_RATIO_RE = re.compile(r"^\s*m(\d+)\s*/\s*m(\d+)\s*$")
+
+
+def formula_metric_ids(formula: str) -> List[int]:
+    """Return the metric ids a formula refers to, validating its syntax."""
+    if not formula or not FORMULA_RE.match(formula) or "m" in METRIC_REF_RE.sub("", formula):
+        raise ValueError(f"Invalid derived-metric formula: {formula!r}")
+    ids = sorted({int(m) for m in METRIC_REF_RE.findall(formula)})
+    if not ids:
+        raise ValueError(f"Formula {formula!r} does not reference any metric.")
+    return ids
+
+
+def get_derived_metrics(depends_on: Optional[Iterable[int]] = None) -> List[Metrics]:
+    """
+    Return every metric that has a formula, optionally only those that
+    reference at least one of the metric ids in *depends_on*.
+    """
+    with SessionLocal() as session:
+        metrics = session.execute(select(Metrics).where(Metrics.formula.is_not(None))).scalars().all()
+    if depends_on is None:
+        return list(metrics)
+    wanted: Set[int] = {int(m) for m in depends_on}
+    return [m for m in metrics if wanted.intersection(formula_metric_ids(m.formula))]
+
+
+def evaluate_derived_metric(metric: Metrics, group_names: Optional[List[str]] = None) -> int:
+    """
+    Recompute a derived metric for every group, date and period level at
+    which all of its input metrics exist, and replace its fact rows.
+    ``group_names`` limits the recompute (and the replacement) to those groups.
+
+    The inputs are pivoted into one column per metric (``m<id>``) and the
+    formula is evaluated once over the whole frame with ``DataFrame.eval``.
+    Non-finite results (e.g. division by zero) are dropped. The new rows
+    replace the old ones atomically. Returns the number of rows written.
+    """
+    ids = formula_metric_ids(metric.formula)
+    if metric.id in ids:
+        raise ValueError(f"Derived metric {metric.id} refers to itself.")
+
+    with SessionLocal() as session:
+        inputs = query_facts(
+            session=session,
+            metric_ids=ids,
+            group_names=group_names,
+            columns=["metric_id", "group_name", "date", "period_level", "value"],
+            use_cache=False,
+        )
+
+    if inputs.empty:
+        if group_names is None:
+            LOGGER.warning(f"No input facts for derived metric {metric.id} ({metric.formula})")
+            return 0
+        # the groups lost all their inputs: only their old rows go
+        result = pd.DataFrame(columns=["metric_id", "group_name", "date", "period_level", "value"])
+    else:
+        result = _evaluate_formula(metric, inputs, ids)
+
+    # every existing row of the derived metric (in scope) is replaced in one transaction
+    stale = (
+        true() if group_names is None
+        else Facts.group_id.in_(select(Groups.id).where(Groups.natural_key.in_([str(g) for g in group_names])))
+    )
+    written = replace_facts_atomically(metric.id, stale, result)
+    LOGGER.info(f"Derived metric {metric.id} = {metric.formula}: wrote {written} rows from {len(inputs)} input rows")
+    return written
+
+
+def _evaluate_formula(metric: Metrics, inputs: pd.DataFrame, ids: List[int]) -> pd.DataFrame:
+    """Pivot the input facts to one ``m<id>`` column per metric and evaluate the formula."""
+    wide = inputs.pivot_table(
+        index=["group_name", "date", "period_level"], columns="metric_id", values="value", aggfunc="first"
+    )
+    wide.columns = [f"m{c}" for c in wide.columns]
+    wide = wide.reindex(columns=[f"m{i}" for i in ids]).dropna()
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        values = wide.eval(metric.formula).astype(float)
+    result = pd.DataFrame({"value": values}, index=wide.index)
+
+    ratio = SIMPLE_RATIO_RE.match(metric.formula)
+    if ratio:
+        result["numerator"] = wide[f"m{ratio.group(1)}"]
+        result["denominator"] = wide[f"m{ratio.group(2)}"]
+
+    result = result[np.isfinite(result["value"])].reset_index()
+    result["metric_id"] = metric.id
+    return result
@@ -131,15 +131,27 @@ def _initialize_spark_and_read(
         return None, None
 
 
-def _format_output(df_spark: pyspark.sql.DataFrame, metric_id: int, value_col: str = "value") -> pd.DataFrame:
-    """Formats the aggregated Spark DataFrame into the standard Pandas output."""
+def _format_output(
+    df_spark: pyspark.sql.DataFrame,
+    metric_id: int,
+    value_col: str = "value",
+    numerator_col: str | None = None,
+    denominator_col: str | None = None,
+) -> pd.DataFrame:
+    """
+    Formats the aggregated Spark DataFrame into the standard Pandas output.
+
+    Ratio metrics pass ``numerator_col`` / ``denominator_col`` so the additive
+    components are stored alongside the value and can be rolled up exactly.
+    """
     if df_spark is None:
         LOGGER.error(
             f"Cannot format output for metric_id {metric_id} because input DataFrame is None.")
         return pd.DataFrame()
 
     # Ensure required columns for formatting exist
-    required_format_cols = [COL_SALE_DATE, COL_SITE_ID, value_col]
+    component_cols = [c for c in (numerator_col, denominator_col) if c is not None]
+    required_format_cols = [COL_SALE_DATE, COL_SITE_ID, value_col] + component_cols
     if not all(col in df_spark.columns for col in required_format_cols):
         LOGGER.error(
             f"Cannot format output for metric_id {metric_id}. Missing columns in aggregated DataFrame. Expected: {required_format_cols}, Got: {df_spark.columns}"
@@ -152,6 +164,8 @@ def _format_output(df_spark: pyspark.sql.DataFrame, metric_id: int, value_col: s
         F.col(value_col).alias("value"),
         F.col(COL_SALE_DATE).alias("date"),
         F.lit(1).alias("period_level"),
+        *[F.col(c).cast(DoubleType()).alias(alias) for c, alias in
+          ((numerator_col, "numerator"), (denominator_col, "denominator")) if c is not None],
     )
     # --- Debugging: Inspect final Spark DF before converting to Pandas ---
     LOGGER.info(f"Final Spark DataFrame schema for metric_id {metric_id}:")
@@ -308,60 +322,6 @@ def get_number_of_transactions_from_parquet(_file_name: str) -> pd.DataFrame:
             LOGGER.info(f"Spark session stopped for metric {METRIC_ID}.")
 
 
-def get_average_order_value_from_parquet(_file_name: str) -> pd.DataFrame:
-    """
-    Calculates the Average Order Value (AOV) per site per day.
-    AOV = Net Sales Revenue / Number of Transactions (Slips). Handles division by zero.
-    Metric ID: 4
-
-    Args:
-        _file_name: Path to the Parquet file.
-
-    Returns:
-        Pandas DataFrame with columns: metric_id, group_name, value, date, period_level.
-        Returns empty DataFrame on error.
-    """
-    METRIC_ID = 4
-    # Requires amount for sum, slip_no for count distinct
-    required_cols = [COL_SALE_DATE, COL_SITE_ID,
-                     COL_EXTENSION_AMOUNT, COL_SLIP_NO]
-    spart, df_spark = _initialize_spark_and_read(_file_name, required_cols)
-
-    if not spart or df_spark is None:
-        return pd.DataFrame()
-
-    try:
-        # Cast amount to double for calculation
-        df_spark = df_spark.withColumn(COL_EXTENSION_AMOUNT, F.col(
-            COL_EXTENSION_AMOUNT).cast(DoubleType()))
-
-        # Group by date and site, calculate net revenue and number of unique slips
-        grouped_df = df_spark.groupBy(COL_SALE_DATE, COL_SITE_ID).agg(
-            F.sum(COL_EXTENSION_AMOUNT).alias("total_net_revenue"),
-            F.countDistinct(COL_SLIP_NO).alias("num_transactions"),
-        )
-
-        # Calculate AOV, handling division by zero
-        calculated_aov_df = grouped_df.withColumn(
-            "value",
-            F.when(F.col("num_transactions") == 0, 0.0).otherwise(  # Avoid division by zero, result is 0.0
-                F.col("total_net_revenue") / F.col("num_transactions")
-            ),
-        )
-
-        result_df = _format_output(calculated_aov_df, METRIC_ID)
-        return result_df
-
-    except Exception as e:
-        LOGGER.error(
-            f"Error calculating metric_id {METRIC_ID}: {e}", exc_info=True)
-        return pd.DataFrame()
-    finally:
-        if spart:
-            spart.stop()
-            LOGGER.info(f"Spark session stopped for metric {METRIC_ID}.")
-
-
 def get_number_of_returned_items_from_parquet(_file_name: str) -> pd.DataFrame:
     """
     Calculates the Total Number of Returned Items (Units) per site per day.
@@ -540,7 +500,9 @@ def get_positive_feedback_from_json(_file_name: str) -> pd.DataFrame:
         metric_id=METRIC_ID,
         group_name=agg["storeid"],
         period_level=1,
-    )[["metric_id", "group_name", "value", "date", "period_level"]]
+        numerator=agg["positive_cnt"].astype(float),
+        denominator=agg["total_cnt"].astype(float),
+    )[["metric_id", "group_name", "value", "date", "period_level", "numerator", "denominator"]]
 
     # filter out zeros
     agg = agg[agg["value"] > 0]
@@ -622,6 +584,8 @@ def get_average_satisfaction_score_from_json(_file_name: str) -> pd.DataFrame:
         group_name=("storeid", "first"),
         value=("value", "mean"),
         period_level=("period_level", "first"),
+        numerator=("value", "sum"),
+        denominator=("value", "count"),
     )
     return df_agg
 
@@ -733,6 +697,8 @@ def get_store_atmosphere_score_from_json(_file_name: str) -> pd.DataFrame:
             group_name=("storeid", "first"),
             value=("value", "mean"),
             period_level=("period_level", "first"),
+            numerator=("value", "sum"),  # score sum / response count, for exact rollups
+            denominator=("value", "count"),
         )
         .rename(columns={"storeid": "store_id"})  # optional: tidy up naming
     )
@@ -847,6 +813,8 @@ def get_store_price_satisfaction_score_from_json(_file_name: str) -> pd.DataFram
             group_name=("storeid", "first"),
             value=("value", "mean"),
             period_level=("period_level", "first"),
+            numerator=("value", "sum"),  # score sum / response count, for exact rollups
+            denominator=("value", "count"),
         )
         .rename(columns={"storeid": "store_id"})  # optional: tidy up naming
     )
@@ -961,6 +929,8 @@ def get_store_service_satisfaction_score_from_json(_file_name: str) -> pd.DataFr
             group_name=("storeid", "first"),
             value=("value", "mean"),
             period_level=("period_level", "first"),
+            numerator=("value", "sum"),  # score sum / response count, for exact rollups
+            denominator=("value", "count"),
         )
         .rename(columns={"storeid": "store_id"})  # optional: tidy up naming
     )
@@ -1,12 +1,18 @@
 import os
 import sqlite3
 
+from src.scripts.data_warehouse.models.warehouse import (
+    FACTS_LAYOUT_ENV,
+    db_path,
+    migrate_facts_layout,
+    upgrade_schema,
+)
 from src.utils.logging import LOGGER
 
 SRC_ROOT = os.path.dirname(
     os.path.dirname(os.path.dirname(__file__))
 )  # goes from /src/scripts/data_warehouse -> /marines-data-analytics
-DB_PATH = os.path.join(SRC_ROOT, "..", "db", "database.sqlite3")
+DB_PATH = db_path
 SQL_FILE = os.path.join(SRC_ROOT, "scripts", "data_warehouse", "db_setup.sql")
 
 
@@ -24,7 +30,14 @@ def initialize_database():
                     conn.executescript(f.read())
             LOGGER.info("Database initialized.")
         else:
-            LOGGER.info("Database already exists. Skipping initialization.")
+            LOGGER.info("Database already exists. Applying schema upgrades.")
+            with sqlite3.connect(DB_PATH) as conn:
+                upgrade_schema(conn)
+
+        layout = os.environ.get(FACTS_LAYOUT_ENV)
+        if layout:
+            with sqlite3.connect(DB_PATH) as conn:
+                migrate_facts_layout(conn, layout)
     except Exception as e:
         LOGGER.info(f"Error during DB init: {e}")
         exit(1)
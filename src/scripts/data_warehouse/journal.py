@@ -0,0 +1,144 @@
+import hashlib
+import uuid
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Iterable, Iterator, Optional, Set, Tuple
+
+from sqlalchemy import delete, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from src.scripts.data_warehouse.models.warehouse import Base, IngestionJournal, SessionLocal, engine
+from src.utils.logging import LOGGER
+
+# Hydration stages in the order the pipeline runs them.
+STAGE_ETL = "etl"
+STAGE_ROLLUP = "rollup"  # time x group-hierarchy cube, see utils.build_metric_cube
+STAGE_DERIVED = "derived"  # metrics with a formula, see derived.evaluate_derived_metric
+
+_table_ready = False
+
+
+def _ensure_table() -> None:
+    """Create the journal table on databases that predate it."""
+    global _table_ready
+    if not _table_ready:
+        Base.metadata.create_all(engine, tables=[IngestionJournal.__table__])
+        _table_ready = True
+
+
+def file_sha256(path: str, chunk_size: int = 1 << 20) -> str:
+    """Return the hex SHA-256 of a file, read in chunks."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+@dataclass
+class JournalEntry:
+    """
+    Handle yielded by :meth:`HydrationJournal.stage`; set ``rows`` before the
+    block ends, or call :meth:`skip` if the stage had nothing to write.
+    """
+
+    stage: str
+    metric_id: int
+    rows: int = 0
+    skipped: bool = False
+
+    def skip(self) -> None:
+        """End the stage without completing it, so the next run of the file retries it."""
+        self.skipped = True
+
+
+class HydrationJournal:
+    """
+    Progress journal for one hydration of one input file.
+
+    Stages are keyed by (file hash, stage, metric_id), so re-running the
+    pipeline on the same file after a crash skips every stage that already
+    reached ``done`` and redoes only the unfinished ones. :meth:`reset`
+    forces a full re-run of the file.
+    """
+
+    def __init__(self, file_hash: str, run_id: Optional[str] = None):
+        _ensure_table()
+        self.file_hash = file_hash
+        self.run_id = run_id or uuid.uuid4().hex
+        with SessionLocal() as session:
+            rows = session.execute(
+                select(IngestionJournal.stage, IngestionJournal.metric_id).where(
+                    IngestionJournal.file_hash == file_hash, IngestionJournal.status == "done"
+                )
+            ).all()
+        self.completed: Set[Tuple[str, int]] = {(stage, metric_id) for stage, metric_id in rows}
+        if self.completed:
+            LOGGER.info(
+                "Journal: resuming file %s with %d completed stage(s)", file_hash[:12], len(self.completed))
+
+    def reset(self) -> int:
+        """
+        Forget every stage journaled for this file, so this run redoes them
+        all (e.g. after an ETL fix, a metrics.json change or a manual facts
+        cleanup). Returns the number of journal entries removed.
+        """
+        with SessionLocal() as session:
+            removed = session.execute(
+                delete(IngestionJournal).where(IngestionJournal.file_hash == self.file_hash)).rowcount
+            session.commit()
+        self.completed.clear()
+        LOGGER.info("Journal: reset file %s (%d entries removed)", self.file_hash[:12], removed)
+        return removed
+
+    def is_done(self, stage: str, metric_id: int) -> bool:
+        return (stage, int(metric_id)) in self.completed
+
+    def all_done(self, stage: str, metric_ids: Iterable[int]) -> bool:
+        return all(self.is_done(stage, m) for m in metric_ids)
+
+    def _record(self, stage: str, metric_id: int, status: str, rows: Optional[int] = None) -> None:
+        now = datetime.utcnow()
+        values = {
+            "run_id": self.run_id,
+            "file_hash": self.file_hash,
+            "stage": stage,
+            "metric_id": metric_id,
+            "status": status,
+            "rows_written": rows,
+        }
+        if status == "started":
+            values["started_at"] = now
+            values["finished_at"] = None
+        else:
+            values["finished_at"] = now
+
+        stmt = sqlite_insert(IngestionJournal).values(**values)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=["file_hash", "stage", "metric_id"],
+            set_={k: stmt.excluded[k] for k in values if k not in ("file_hash", "stage", "metric_id")},
+        )
+        with SessionLocal() as session:
+            session.execute(stmt)
+            session.commit()
+
+    @contextmanager
+    def stage(self, stage: str, metric_id: int) -> Iterator[JournalEntry]:
+        """
+        Journal one stage for one metric: ``started`` on entry, ``done`` on
+        exit, or ``failed`` if the block raised or skipped the stage.
+        """
+        metric_id = int(metric_id)
+        entry = JournalEntry(stage=stage, metric_id=metric_id)
+        self._record(stage, metric_id, "started")
+        try:
+            yield entry
+        except BaseException:
+            self._record(stage, metric_id, "failed", entry.rows)
+            raise
+        if entry.skipped:
+            self._record(stage, metric_id, "failed", entry.rows)
+            return
+        self._record(stage, metric_id, "done", entry.rows)
+        self.completed.add((stage, metric_id))
@@ -1,14 +1,61 @@
 import json
 import os
-from typing import List
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, Set, Tuple
 
+from sqlalchemy import insert, select, update
+
+from src.scripts.data_warehouse.cache import bump_generation
+from src.scripts.data_warehouse.derived import evaluate_derived_metric, get_derived_metrics
 from src.scripts.data_warehouse.models.warehouse import Camps, Metrics, SessionLocal, Sites
+from src.scripts.data_warehouse.utils import rerollup_site_hierarchy
 from src.utils.logging import LOGGER
 
 HERE = os.path.dirname(os.path.abspath(__file__))
 STATIC_DIR = os.path.join(HERE, "static")
 
 
+@dataclass
+class DimensionChanges:
+    """
+    Summary of one set-based dimension load.
+
+    ``inserted`` holds the natural keys of new rows (their values in
+    ``inserted_rows``), ``updated`` maps the natural key of every modified row
+    to ``{column: (old, new)}`` so callers (e.g. hierarchy rollups) can tell
+    exactly what moved.
+    """
+
+    table: str
+    inserted: List[Any] = field(default_factory=list)
+    updated: Dict[Any, Dict[str, Tuple[Any, Any]]] = field(default_factory=dict)
+    unchanged: int = 0
+    skipped: int = 0
+    inserted_rows: Dict[Any, Dict[str, Any]] = field(default_factory=dict)
+
+    @property
+    def changed(self) -> bool:
+        return bool(self.inserted or self.updated)
+
+    def moves(self, columns: Iterable[str]) -> Dict[Any, Dict[str, Tuple[Any, Any]]]:
+        """
+        ``{key: {column: (old, new)}}`` for every row whose *columns* changed;
+        a new row counts as moving from None to its value.
+        """
+        columns = tuple(columns)
+        moved: Dict[Any, Dict[str, Tuple[Any, Any]]] = {}
+        for key in self.inserted:
+            row = self.inserted_rows.get(key, {})
+            diff = {col: (None, row[col]) for col in columns if row.get(col) is not None}
+            if diff:
+                moved[key] = diff
+        for key, diff in self.updated.items():
+            diff = {col: change for col, change in diff.items() if col in columns}
+            if diff:
+                moved[key] = diff
+        return moved
+
+
 def _json_path(fname: str) -> str:
     """Return the absolute path of a file inside the static folder."""
     return os.path.join(STATIC_DIR, fname)
@@ -28,112 +75,214 @@ def _load_json(path: str):
     return None
 
 
-def load_metrics_from_json(path: str = _json_path("metrics.json")) -> None:
-    """Upsert metric rows from JSON."""
-    data = _load_json(path)
-    if data is None:
-        return
+def _diff_rows(
+    incoming: Dict[Any, Dict[str, Any]],
+    existing: Dict[Any, Dict[str, Any]],
+    changes: DimensionChanges,
+    columns: Iterable[str],
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Compare the parsed JSON rows against the current table contents.
+
+    Both row mappings are keyed by the table's natural key. Every column in
+    *columns* (the ones the JSON file maps) is compared, so a column missing
+    from a JSON row is written back as None. Returns the rows to bulk-insert
+    and the (primary-key-carrying) rows to bulk-update.
+    """
+    columns = tuple(columns)
+    to_insert: List[Dict[str, Any]] = []
+    to_update: List[Dict[str, Any]] = []
+    for key, row in incoming.items():
+        current = existing.get(key)
+        if current is None:
+            to_insert.append(row)
+            changes.inserted.append(key)
+            changes.inserted_rows[key] = row
+            continue
+
+        row = {col: row.get(col) for col in columns}
+        diff = {col: (current[col], val) for col, val in row.items() if current[col] != val}
+        if not diff:
+            changes.unchanged += 1
+            continue
+        changes.updated[key] = diff
+        to_update.append({**row, **{pk: current[pk] for pk in current if pk not in row}})
+    return to_insert, to_update
+
 
+def _apply_bulk(model, to_insert: List[Dict[str, Any]], to_update: List[Dict[str, Any]], changes: DimensionChanges):
+    """Write the diff in a single transaction and log a one-line summary."""
     with SessionLocal() as session:
         try:
-            for d in data:
-                metric_id = d.get("id")
-                if metric_id is None:
-                    LOGGER.warning("Skipping metric without id: %s", d)
-                    continue
-
-                obj = session.get(Metrics, metric_id)
-                if obj:
-                    for k, v in d.items():
-                        setattr(obj, k, v)
-                    LOGGER.info("Updated metric id=%s (%s)",
-                                obj.id, obj.metric_name)
-                else:
-                    session.add(Metrics(**d))
-                    LOGGER.info("Inserted new metric id=%s (%s)",
-                                metric_id, d.get("metric_name"))
+            if to_insert:
+                session.execute(insert(model), to_insert)
+            if to_update:
+                session.execute(update(model), to_update)
             session.commit()
         except Exception as e:
-            LOGGER.exception("load_metrics_from_json failed: %s", e)
+            LOGGER.exception("Bulk load of %s failed: %s", changes.table, e)
             session.rollback()
+            return DimensionChanges(table=changes.table, skipped=changes.skipped)
 
+    if changes.changed:
+        bump_generation(changes.table)
 
-def load_camps_from_json(path: str = _json_path("camps.json")) -> None:
-    """Upsert camp rows from JSON."""
+    LOGGER.info(
+        "Loaded %s: %d inserted, %d updated, %d unchanged, %d skipped",
+        changes.table,
+        len(changes.inserted),
+        len(changes.updated),
+        changes.unchanged,
+        changes.skipped,
+    )
+    return changes
+
+
+def load_metrics_from_json(path: str = _json_path("metrics.json")) -> DimensionChanges:
+    """Upsert metric rows from JSON in one diff + bulk write."""
+    changes = DimensionChanges(table="metrics")
     data = _load_json(path)
     if data is None:
-        return
+        return changes
+
+    columns = [c.key for c in Metrics.__table__.columns]
+    incoming: Dict[int, Dict[str, Any]] = {}
+    for d in data:
+        metric_id = d.get("id")
+        if metric_id is None:
+            LOGGER.warning("Skipping metric without id: %s", d)
+            changes.skipped += 1
+            continue
+        incoming[int(metric_id)] = {k: v for k, v in d.items() if k in columns}
 
     with SessionLocal() as session:
-        try:
-            for d in data:
-                name = (d.get("CAMPNAME") or d.get("name") or "").strip()
-                lat = d.get("LAT")
-                lon = d.get("LONG") or d.get("LON")
-                if not (name and lat and lon):
-                    LOGGER.warning("Skipping camp with missing fields: %s", d)
-                    continue
-
-                obj = session.query(Camps).filter(
-                    Camps.name.ilike(name)).one_or_none()
-
-                if obj:
-                    obj.lat = float(lat)
-                    obj.long = float(str(lon).strip())
-                    LOGGER.info("Updated camp %s", name)
-                else:
-                    session.add(Camps(name=name, lat=float(
-                        lat), long=float(str(lon).strip())))
-                    LOGGER.info("Inserted new camp %s", name)
-            session.commit()
-        except Exception as e:
-            LOGGER.exception("load_camps_from_json failed: %s", e)
-            session.rollback()
+        existing = {
+            row["id"]: dict(row) for row in session.execute(select(*Metrics.__table__.columns)).mappings()
+        }
+
+    to_insert, to_update = _diff_rows(incoming, existing, changes, columns)
+    return _apply_bulk(Metrics, to_insert, to_update, changes)
 
 
-def load_sites_from_json(path: str = _json_path("sites.json")) -> None:
-    """Upsert site rows from JSON."""
+def load_camps_from_json(path: str = _json_path("camps.json")) -> DimensionChanges:
+    """Upsert camp rows from JSON, matching existing camps case-insensitively by name."""
+    changes = DimensionChanges(table="camps")
     data = _load_json(path)
     if data is None:
-        return
+        return changes
+
+    incoming: Dict[str, Dict[str, Any]] = {}
+    for d in data:
+        name = (d.get("CAMPNAME") or d.get("name") or "").strip()
+        lat = d.get("LAT")
+        lon = d.get("LONG") or d.get("LON")
+        if not (name and lat and lon):
+            LOGGER.warning("Skipping camp with missing fields: %s", d)
+            changes.skipped += 1
+            continue
+        incoming[name.casefold()] = {"name": name, "lat": float(lat), "long": float(str(lon).strip())}
 
     with SessionLocal() as session:
+        existing = {
+            row["name"].casefold(): dict(row) for row in session.execute(select(*Camps.__table__.columns)).mappings()
+        }
+
+    # Keep the stored spelling of the name; only coordinates are updatable.
+    for key, row in incoming.items():
+        if key in existing:
+            row["name"] = existing[key]["name"]
+
+    to_insert, to_update = _diff_rows(incoming, existing, changes, ("name", "lat", "long"))
+    return _apply_bulk(Camps, to_insert, to_update, changes)
+
+
+def load_sites_from_json(path: str = _json_path("sites.json")) -> DimensionChanges:
+    """Upsert site rows from JSON in one diff + bulk write."""
+    changes = DimensionChanges(table="sites")
+    data = _load_json(path)
+    if data is None:
+        return changes
+
+    incoming: Dict[int, Dict[str, Any]] = {}
+    for d in data:
+        site_id_raw = d.get("SITE_ID") or d.get("site_id")
+        if site_id_raw is None:
+            LOGGER.warning("Skipping site without SITE_ID: %s", d)
+            changes.skipped += 1
+            continue
         try:
-            for d in data:
-                site_id_raw = d.get("SITE_ID") or d.get("site_id")
-                if site_id_raw is None:
-                    LOGGER.warning("Skipping site without SITE_ID: %s", d)
-                    continue
-                try:
-                    site_id = int(site_id_raw)
-                except ValueError:
-                    LOGGER.warning(
-                        "Invalid SITE_ID %s – skipping", site_id_raw)
-                    continue
-
-                obj = session.get(Sites, site_id)
-                if obj:
-                    obj.site_name = d.get("SITE_NAME")
-                    obj.command_name = d.get("COMMAND_NAME")
-                    obj.store_format = d.get("STORE_FORMAT")
-                    LOGGER.info("Updated site_id %s", site_id)
-                else:
-                    session.add(
-                        Sites(
-                            site_id=site_id,
-                            site_name=d.get("SITE_NAME"),
-                            command_name=d.get("COMMAND_NAME"),
-                            store_format=d.get("STORE_FORMAT"),
-                        )
-                    )
-                    LOGGER.info("Inserted new site_id %s", site_id)
-            session.commit()
-        except Exception as e:
-            LOGGER.exception("load_sites_from_json failed: %s", e)
-            session.rollback()
+            site_id = int(site_id_raw)
+        except ValueError:
+            LOGGER.warning("Invalid SITE_ID %s – skipping", site_id_raw)
+            changes.skipped += 1
+            continue
 
+        incoming[site_id] = {
+            "site_id": site_id,
+            "site_name": d.get("SITE_NAME"),
+            "command_name": d.get("COMMAND_NAME"),
+            "store_format": d.get("STORE_FORMAT"),
+        }
 
-if __name__ == "__main__":
+    with SessionLocal() as session:
+        existing = {
+            row["site_id"]: dict(row) for row in session.execute(select(*Sites.__table__.columns)).mappings()
+        }
+
+    to_insert, to_update = _diff_rows(incoming, existing, changes, [c.key for c in Sites.__table__.columns])
+    return _apply_bulk(Sites, to_insert, to_update, changes)
+
+
+# Site columns that place a site in the camp / store-format group hierarchy.
+SITE_HIERARCHY_COLUMNS = ("command_name", "store_format")
+
+
+def affected_sites(changes: DimensionChanges) -> Set[int]:
+    """Site ids whose camp or store format changed (or that are new) in a sites load."""
+    return set(changes.moves(SITE_HIERARCHY_COLUMNS))
+
+
+def refresh_site_hierarchy(changes: DimensionChanges) -> int:
+    """
+    Re-roll only the camp and store-format groups that the affected sites
+    of a sites load moved between (old and new values), for every metric
+    and period level, then re-evaluate derived metrics for those groups.
+    Returns the number of rollup rows written.
+    """
+    moves = changes.moves(SITE_HIERARCHY_COLUMNS)
+    if not moves:
+        return 0
+    groups: Dict[str, Set[str]] = {col: set() for col in SITE_HIERARCHY_COLUMNS}
+    for diff in moves.values():
+        for col, (old, new) in diff.items():
+            groups[col].update(g for g in (old, new) if g)
+
+    LOGGER.info(
+        "Sites %s moved; re-rolling camps %s and formats %s",
+        sorted(moves),
+        sorted(groups["command_name"]),
+        sorted(groups["store_format"]),
+    )
+    written = rerollup_site_hierarchy(camps=groups["command_name"], formats=groups["store_format"])
+    group_names = sorted(groups["command_name"] | groups["store_format"])
+    for derived in get_derived_metrics():
+        evaluate_derived_metric(derived, group_names=group_names)
+    return written
+
+
+def reload_dimensions() -> int:
+    """
+    Load metrics, camps and sites from the static JSON files, then re-roll
+    the hierarchy groups of any site that moved (see
+    :func:`refresh_site_hierarchy`). Every sites load should go through
+    here so camp and store-format rollups never go stale. Cheap when the
+    files are unchanged: one diff query per table and no writes. Returns
+    the number of rollup rows written.
+    """
     load_metrics_from_json()
     load_camps_from_json()
-    load_sites_from_json()
+    return refresh_site_hierarchy(load_sites_from_json())
+
+
+if __name__ == "__main__":
+    reload_dimensions()
@@ -1,8 +1,16 @@
 import json
 import os
+import re
+import sqlite3
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from datetime import date, datetime
-from typing import List, Optional
+from typing import Deque, Dict, Iterator, List, Optional
 
+import pandas as pd
 from sqlalchemy import (
     Boolean,
     CheckConstraint,
@@ -13,7 +21,9 @@ from sqlalchemy import (
     String,
     UniqueConstraint,
     create_engine,
+    event,
 )
+from sqlalchemy.exc import OperationalError
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship, sessionmaker
 
 from src.utils.logging import LOGGER  # Assuming you have this
@@ -81,6 +91,8 @@ class Metrics(Base):
     is_yearly: Mapped[bool] = mapped_column(Boolean, default=False)
     agg_method: Mapped[Optional[str]] = mapped_column(String(50))
     etl_method: Mapped[Optional[str]] = mapped_column(String(200))
+    # Derived metrics are computed from other metrics, e.g. "m1 / m3"; see derived.py
+    formula: Mapped[Optional[str]] = mapped_column(String(200))
 
     # Relationship definition (adjust 'Facts' import/definition as needed)
     facts: Mapped[List["Facts"]] = relationship(
@@ -100,15 +112,51 @@ class PeriodDim(Base):
         return f"PeriodDim(id={self.id!r}, " f"period_name={self.period_name!r})"
 
 
+# Values of groups.kind, one per level of the group hierarchy.
+GROUP_KINDS = ("site", "camp", "format", "all")
+
+
+class Groups(Base):
+    """
+    Group dimension: every site, camp, store format and 'all' that facts are
+    keyed on. ``natural_key`` is the name used everywhere outside the facts
+    table (a site id as text, a camp or store-format name, or 'all');
+    ``parent_id`` points a site at its camp and a camp or format at 'all'.
+    Ids are never reused, so they can be cached for the life of a process.
+    """
+
+    __tablename__ = "groups"
+    __table_args__ = (
+        UniqueConstraint("natural_key", name="uq_group_natural_key"),
+        CheckConstraint("kind IN ('site', 'camp', 'format', 'all')", name="chk_group_kind"),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    kind: Mapped[str] = mapped_column(String(10), nullable=False)
+    natural_key: Mapped[str] = mapped_column(String(100), nullable=False)
+    parent_id: Mapped[Optional[int]] = mapped_column(ForeignKey("groups.id"))
+
+    def __repr__(self) -> str:
+        return (
+            f"Groups(id={self.id!r}, kind={self.kind!r}, "
+            f"natural_key={self.natural_key!r}, parent_id={self.parent_id!r})"
+        )
+
+
 class Facts(Base):
     __tablename__ = "facts"
 
-    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
-    metric_id: Mapped[Optional[int]] = mapped_column(ForeignKey("metrics.id"))
-    group_name: Mapped[Optional[str]] = mapped_column(String(50))
+    # Mapped on the natural key, which every storage layout has (see
+    # FACTS_LAYOUTS); the rowid layout's AUTOINCREMENT id is not used.
+    metric_id: Mapped[int] = mapped_column(ForeignKey("metrics.id"), primary_key=True)
+    # groups.id; query_facts translates to and from the group's natural key
+    group_id: Mapped[int] = mapped_column(ForeignKey("groups.id"), primary_key=True)
     value: Mapped[Optional[float]] = mapped_column(Float)
-    date: Mapped[Optional[datetime]] = mapped_column(Date)
-    period_level: Mapped[Optional[int]] = mapped_column()
+    # Additive components of ratio metrics (agg_method 'ratio'): value = numerator / denominator
+    numerator: Mapped[Optional[float]] = mapped_column(Float)
+    denominator: Mapped[Optional[float]] = mapped_column(Float)
+    date: Mapped[datetime] = mapped_column(Date, primary_key=True)
+    period_level: Mapped[int] = mapped_column(primary_key=True)
     record_inserted_date: Mapped[datetime] = mapped_column(
         DateTime, default=datetime.utcnow)
 
@@ -117,13 +165,53 @@ class Facts(Base):
 
     def __repr__(self) -> str:
         return (
-            f"Facts(id={self.id!r}, metric_id={self.metric_id!r}, "
-            f"group_name={self.group_name!r}, value={self.value!r}, "
+            f"Facts(metric_id={self.metric_id!r}, "
+            f"group_id={self.group_id!r}, value={self.value!r}, "
             f"date={self.date!r}, period_level={self.period_level!r}, "
             f"record_inserted_date={self.record_inserted_date!r})"
         )
 
 
+class IngestionJournal(Base):
+    __tablename__ = "ingestion_journal"
+    __table_args__ = (
+        UniqueConstraint("file_hash", "stage", "metric_id",
+                         name="uq_journal_file_stage_metric"),
+        CheckConstraint("status IN ('started', 'done', 'failed')",
+                        name="chk_journal_status"),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
+    run_id: Mapped[str] = mapped_column(String(32), nullable=False)
+    file_hash: Mapped[str] = mapped_column(String(64), nullable=False)
+    stage: Mapped[str] = mapped_column(String(30), nullable=False)
+    metric_id: Mapped[int] = mapped_column(
+        ForeignKey("metrics.id"), nullable=False)
+    status: Mapped[str] = mapped_column(String(10), nullable=False)
+    rows_written: Mapped[Optional[int]] = mapped_column()
+    started_at: Mapped[datetime] = mapped_column(
+        DateTime, default=datetime.utcnow)
+    finished_at: Mapped[Optional[datetime]] = mapped_column(DateTime)
+
+    def __repr__(self) -> str:
+        return (
+            f"IngestionJournal(run_id={self.run_id!r}, file_hash={self.file_hash[:12]!r}, "
+            f"stage={self.stage!r}, metric_id={self.metric_id!r}, status={self.status!r})"
+        )
+
+
+class Generation(Base):
+    """Change counter per warehouse table; bumped by writers, read by caches."""
+
+    __tablename__ = "generations"
+
+    name: Mapped[str] = mapped_column(String(50), primary_key=True)
+    value: Mapped[int] = mapped_column(nullable=False, default=0)
+
+    def __repr__(self) -> str:
+        return f"Generation(name={self.name!r}, value={self.value!r})"
+
+
 class CustomJSONEncoder(json.JSONEncoder):
     def default(self, obj):
         # Convert date/datetime
@@ -143,9 +231,12 @@ class CustomJSONEncoder(json.JSONEncoder):
 # Keep this part as you have it:
 
 
+# Environment variable pointing the app (e.g. a test run) at another database file.
+DB_PATH_ENV = "MDA_DB_PATH"
+
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-db_path = os.path.join(BASE_DIR, "..", "..", "..",
-                       "..", "db", "database.sqlite3")
+db_path = os.environ.get(DB_PATH_ENV) or os.path.join(BASE_DIR, "..", "..", "..",
+                                                      "..", "db", "database.sqlite3")
 db_path = os.path.normpath(db_path)
 
 # echo=False is often better for production/streamlit
@@ -163,6 +254,735 @@ def get_db():
         db.close()
 
 
+# ── Schema upgrades ────────────────────────────────────────────────────────────
+# Columns added after the first release: (table, column, SQL type).
+# db_setup.sql creates them on new databases; upgrade_schema adds them to
+# existing ones.
+SCHEMA_COLUMNS = [
+    ("facts", "numerator", "REAL"),
+    ("facts", "denominator", "REAL"),
+    ("metrics", "formula", "TEXT"),
+]
+
+
+# WAL lets the dashboards keep reading the last committed aggregates while a
+# rollup rebuild writes the next ones. The setting is stored in the file.
+DEFAULT_JOURNAL_MODE = "wal"
+
+
+def upgrade_schema(dbapi_conn) -> None:
+    """
+    Idempotently bring an existing database up to the current schema,
+    including any facts index that is missing (for instance because a
+    process died while :func:`deferred_fact_indexes` had dropped them).
+    """
+    cursor = dbapi_conn.cursor()
+    try:
+        try:
+            cursor.execute(f"PRAGMA journal_mode = {DEFAULT_JOURNAL_MODE}")
+        except sqlite3.OperationalError as e:
+            # another connection holds the file; the next first connect retries
+            LOGGER.warning(f"Could not switch journal_mode to {DEFAULT_JOURNAL_MODE}: {e}")
+        for table, column, sql_type in SCHEMA_COLUMNS:
+            existing = {row[1] for row in cursor.execute(f"PRAGMA table_info({table})")}
+            if existing and column not in existing:
+                cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {sql_type}")
+                LOGGER.info(f"Schema upgrade: added {table}.{column}")
+        dbapi_conn.commit()
+        facts_columns = _table_columns(cursor, "facts")
+        if "group_name" in facts_columns:
+            _migrate_facts_to_group_ids(dbapi_conn)
+        elif facts_columns:
+            upgrade_indexes(dbapi_conn)
+    finally:
+        cursor.close()
+
+
+def _table_columns(cursor, table: str) -> List[str]:
+    return [row[1] for row in cursor.execute(f"PRAGMA table_info({table})")]
+
+
+# ── Group dimension ────────────────────────────────────────────────────────────
+# Keep in sync with db_setup.sql.
+GROUPS_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS groups (
+    id           INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind         VARCHAR(10) NOT NULL CHECK (kind IN ('site', 'camp', 'format', 'all')),
+    natural_key  VARCHAR(100) NOT NULL UNIQUE,
+    parent_id    INTEGER REFERENCES groups (id)
+)"""
+
+# Store formats allowed by sites.chk_store_type.
+STORE_FORMATS = ("MAIN STORE", "MARINE MART")
+
+# Parent links: site -> its camp (or 'all' without one), camp / format -> 'all'.
+GROUP_PARENTS_SQL = (
+    "UPDATE groups SET parent_id = (SELECT id FROM groups WHERE natural_key = 'all') "
+    "WHERE kind IN ('camp', 'format')",
+    """
+    UPDATE groups SET parent_id = COALESCE(
+        (SELECT c.id FROM sites s JOIN groups c ON c.natural_key = s.command_name AND c.kind = 'camp'
+         WHERE CAST(s.site_id AS TEXT) = groups.natural_key),
+        (SELECT id FROM groups WHERE natural_key = 'all'))
+    WHERE kind = 'site'
+    """,
+)
+
+# Every site, camp, store format and 'all' of the dimension tables; existing
+# groups keep their ids.
+SYNC_GROUPS_SQL = (
+    "INSERT INTO groups (kind, natural_key) VALUES ('all', 'all') ON CONFLICT (natural_key) DO NOTHING",
+    "INSERT INTO groups (kind, natural_key) SELECT DISTINCT 'format', store_format FROM sites "
+    "WHERE store_format IS NOT NULL ON CONFLICT (natural_key) DO NOTHING",
+    "INSERT INTO groups (kind, natural_key) SELECT 'camp', name FROM camps "
+    "UNION SELECT 'camp', command_name FROM sites WHERE command_name IS NOT NULL "
+    "ON CONFLICT (natural_key) DO NOTHING",
+    "INSERT INTO groups (kind, natural_key) SELECT DISTINCT 'site', CAST(site_id AS TEXT) FROM sites "
+    "WHERE true ON CONFLICT (natural_key) DO NOTHING",
+) + GROUP_PARENTS_SQL
+
+
+def group_kind(natural_key: str) -> str:
+    """Kind of a group known only by its name: all-digit names are site ids."""
+    if natural_key == "all":
+        return "all"
+    if natural_key.isascii() and natural_key.isdigit():
+        return "site"
+    if natural_key in STORE_FORMATS:
+        return "format"
+    return "camp"
+
+
+def sync_groups(dbapi_conn) -> None:
+    """Add the groups of the sites and camps tables and refresh parent links (no commit)."""
+    cursor = dbapi_conn.cursor()
+    try:
+        for sql in SYNC_GROUPS_SQL:
+            cursor.execute(sql)
+    finally:
+        cursor.close()
+
+
+def register_groups(dbapi_conn, natural_keys: List[str]) -> None:
+    """
+    Add groups for names that have none yet, their kind inferred by
+    :func:`group_kind` (no commit). Used for names written to facts before
+    the dimension tables know them.
+    """
+    cursor = dbapi_conn.cursor()
+    try:
+        cursor.executemany(
+            "INSERT INTO groups (kind, natural_key) VALUES (?, ?) ON CONFLICT (natural_key) DO NOTHING",
+            [(group_kind(key), key) for key in natural_keys],
+        )
+        for sql in GROUP_PARENTS_SQL:
+            cursor.execute(sql)
+    finally:
+        cursor.close()
+
+
+def _migrate_facts_to_group_ids(dbapi_conn) -> None:
+    """
+    One-time rebuild of a facts table keyed on group_name text into one keyed
+    on ``groups.id``. Every distinct name becomes a group (kinds from the
+    dimension tables, else inferred), rows keep their ids, and the indexes
+    are rebuilt. Runs in one IMMEDIATE transaction, so a concurrent process
+    either waits and finds the work done or sees the old table throughout.
+    """
+    started = time.perf_counter()
+    cursor = dbapi_conn.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        if "group_name" not in _table_columns(cursor, "facts"):
+            dbapi_conn.rollback()
+            return
+        cursor.execute(GROUPS_TABLE_SQL)
+        sync_groups(dbapi_conn)
+        names = [row[0] for row in cursor.execute(
+            "SELECT DISTINCT group_name FROM facts WHERE group_name NOT IN (SELECT natural_key FROM groups)")]
+        register_groups(dbapi_conn, [str(name) for name in names])
+
+        cursor.execute("DROP TABLE IF EXISTS facts_new")
+        cursor.execute(FACTS_TABLE_SQL.replace("CREATE TABLE facts", "CREATE TABLE facts_new", 1))
+        rows = cursor.execute(
+            "INSERT INTO facts_new (id, metric_id, group_id, value, numerator, denominator, date, period_level, "
+            "record_inserted_date) "
+            "SELECT f.id, f.metric_id, g.id, f.value, f.numerator, f.denominator, f.date, f.period_level, "
+            "f.record_inserted_date FROM facts f JOIN groups g ON g.natural_key = CAST(f.group_name AS TEXT) "
+            "ORDER BY f.id"
+        ).rowcount
+        cursor.execute("DROP TABLE facts")
+        cursor.execute("ALTER TABLE facts_new RENAME TO facts")
+        for name, columns in FACT_INDEXES:
+            cursor.execute(f"CREATE INDEX {name} ON facts ({', '.join(columns)})")
+        cursor.execute("ANALYZE facts")
+        dbapi_conn.commit()
+    except Exception:
+        dbapi_conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    LOGGER.info(
+        f"Schema upgrade: re-keyed {rows} facts rows on groups.id ({len(names)} groups inferred from names) "
+        f"in {time.perf_counter() - started:.1f}s"
+    )
+
+
+# Keep in sync with db_setup.sql.
+FACTS_TABLE_SQL = """
+CREATE TABLE facts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    metric_id INTEGER NOT NULL,
+    group_id INTEGER NOT NULL REFERENCES groups (id),
+    value REAL NOT NULL,
+    numerator REAL,
+    denominator REAL,
+    date DATE NOT NULL,
+    period_level INTEGER NOT NULL,
+    record_inserted_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE (metric_id, group_id, date, period_level)
+)"""
+
+# Secondary indexes on facts: (name, columns). Chosen from the query shapes
+# of access.query_facts, the report builder and the pages:
+# * metric + period level + group(s) [+ dates]: trend charts, group-filtered
+#   report lookups and the rollup scans (group_id, date, value in order).
+# * metric + period level + date [range] across groups: month pickers and
+#   daily ranges without a group filter.
+# Both end in value, so reads of (group_id, date, value) never touch the
+# table. The UNIQUE (metric_id, group_id, date, period_level) key stays for
+# the upserts.
+FACT_INDEXES = [
+    ("ix_facts_metric_level_group_date", ("metric_id", "period_level", "group_id", "date", "value")),
+    ("ix_facts_metric_level_date_group", ("metric_id", "period_level", "date", "group_id", "value")),
+]
+
+# ── Facts storage layouts ──────────────────────────────────────────────────────
+# "rowid" (FACTS_TABLE_SQL): AUTOINCREMENT id, the UNIQUE key as an index of
+#   its own, and both FACT_INDEXES.
+# "clustered": a WITHOUT ROWID table whose primary key is the storage order,
+#   so the time series of one (metric, level, group) is a contiguous key
+#   range and the key is stored once. The group-first index would duplicate
+#   that order and is left out. Keep in sync with FACTS_TABLE_SQL.
+FACTS_CLUSTERED_TABLE_SQL = """
+CREATE TABLE facts (
+    metric_id INTEGER NOT NULL,
+    period_level INTEGER NOT NULL,
+    group_id INTEGER NOT NULL REFERENCES groups (id),
+    date DATE NOT NULL,
+    value REAL NOT NULL,
+    numerator REAL,
+    denominator REAL,
+    record_inserted_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (metric_id, period_level, group_id, date)
+) WITHOUT ROWID"""
+
+# layout -> (CREATE TABLE statement, secondary indexes)
+FACTS_LAYOUTS = {
+    "rowid": (FACTS_TABLE_SQL, FACT_INDEXES),
+    "clustered": (FACTS_CLUSTERED_TABLE_SQL, FACT_INDEXES[1:]),
+}
+# Environment variable naming the layout init_db keeps the facts table in.
+FACTS_LAYOUT_ENV = "MDA_FACTS_LAYOUT"
+
+# Columns every layout has, in clustered key order.
+_FACTS_LAYOUT_COLUMNS = (
+    "metric_id, period_level, group_id, date, value, numerator, denominator, record_inserted_date"
+)
+
+
+def facts_layout(dbapi_conn) -> str:
+    """Storage layout of the facts table: "clustered" if it has a primary-key index, else "rowid"."""
+    cursor = dbapi_conn.cursor()
+    try:
+        origins = {row[3] for row in cursor.execute("PRAGMA index_list(facts)")}
+    finally:
+        cursor.close()
+    return "clustered" if "pk" in origins else "rowid"
+
+
+def migrate_facts_layout(dbapi_conn, layout: str) -> bool:
+    """
+    Rebuild facts in *layout* (a ``FACTS_LAYOUTS`` key) unless it is already
+    stored that way, and return whether it was rebuilt.
+
+    Rows are copied in key order into a new table inside one IMMEDIATE
+    transaction, which then replaces facts; the layout's indexes are built
+    and the planner statistics refreshed. Row contents are unchanged;
+    moving back to "rowid" assigns new ids. The old table's pages go to the
+    freelist (VACUUM returns them to the file system).
+    """
+    if layout not in FACTS_LAYOUTS:
+        raise ValueError(f"Unknown facts layout {layout!r}; expected one of {list(FACTS_LAYOUTS)}")
+    table_sql, indexes = FACTS_LAYOUTS[layout]
+    started = time.perf_counter()
+    cursor = dbapi_conn.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        current = facts_layout(dbapi_conn)
+        if current == layout:
+            dbapi_conn.rollback()
+            return False
+        cursor.execute("DROP TABLE IF EXISTS facts_new")
+        cursor.execute(table_sql.replace("CREATE TABLE facts", "CREATE TABLE facts_new", 1))
+        rows = cursor.execute(
+            f"INSERT INTO facts_new ({_FACTS_LAYOUT_COLUMNS}) SELECT {_FACTS_LAYOUT_COLUMNS} FROM facts "
+            f"ORDER BY metric_id, period_level, group_id, date"
+        ).rowcount
+        cursor.execute("DROP TABLE facts")
+        cursor.execute("ALTER TABLE facts_new RENAME TO facts")
+        for name, columns in indexes:
+            cursor.execute(f"CREATE INDEX {name} ON facts ({', '.join(columns)})")
+        cursor.execute("ANALYZE facts")
+        dbapi_conn.commit()
+    except Exception:
+        dbapi_conn.rollback()
+        raise
+    finally:
+        cursor.close()
+    LOGGER.info(
+        f"Facts layout {current} -> {layout}: copied {rows} rows in {time.perf_counter() - started:.1f}s")
+    return True
+
+
+def upgrade_indexes(dbapi_conn) -> List[str]:
+    """
+    Create any missing secondary indexes of the facts table's layout (see
+    ``FACTS_LAYOUTS``) and refresh the planner statistics.
+
+    Runs from :func:`upgrade_schema`, so the first connect of a process
+    restores indexes left dropped by a crash. That can also re-create them
+    under another process's short :func:`deferred_fact_indexes` block,
+    which only costs that block its speed-up. Returns the names of the
+    indexes created.
+    """
+    cursor = dbapi_conn.cursor()
+    try:
+        existing = {row[0] for row in cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+        created = []
+        for name, columns in FACTS_LAYOUTS[facts_layout(dbapi_conn)][1]:
+            if name not in existing:
+                started = time.perf_counter()
+                cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON facts ({', '.join(columns)})")
+                created.append(name)
+                LOGGER.info(f"Schema upgrade: created index {name} in {time.perf_counter() - started:.1f}s")
+        if created:
+            cursor.execute("ANALYZE facts")
+        dbapi_conn.commit()
+        return created
+    finally:
+        cursor.close()
+
+
+@event.listens_for(engine, "first_connect")
+def _upgrade_on_first_connect(dbapi_conn, _connection_record):
+    upgrade_schema(dbapi_conn)
+
+
+# ── Bulk-load mode ─────────────────────────────────────────────────────────────
+# Per-connection PRAGMAs applied to every connection checked out while a
+# bulk load is active. journal_mode is persistent and handled separately.
+BULK_LOAD_PRAGMAS: Dict[str, object] = {
+    "synchronous": "NORMAL",
+    "cache_size": -262144,  # negative => KiB, i.e. 256 MiB
+    "temp_store": "MEMORY",
+}
+
+
+@dataclass
+class WriteThroughput:
+    """Running total of fact rows written and the wall time spent writing them."""
+
+    rows: int = 0
+    seconds: float = 0.0
+
+    @property
+    def rows_per_sec(self) -> float:
+        return self.rows / self.seconds if self.seconds else 0.0
+
+
+WRITE_THROUGHPUT: Dict[str, WriteThroughput] = {
+    "normal": WriteThroughput(), "bulk": WriteThroughput()}
+_write_throughput_lock = threading.Lock()
+
+# Lifetime totals per load mode, so a bulk load is compared with normal-mode
+# writes made by earlier processes too.
+WRITE_THROUGHPUT_TABLE_SQL = """
+CREATE TABLE IF NOT EXISTS write_throughput (
+    mode     VARCHAR(10) PRIMARY KEY,
+    rows     INTEGER NOT NULL DEFAULT 0,
+    seconds  REAL NOT NULL DEFAULT 0
+)"""
+_write_throughput_table_ready = False
+
+# Bulk-load mode changes the whole database (journal mode, dropped indexes),
+# so one thread owns it at a time: other threads entering bulk_load_mode wait
+# until the owner leaves, while the owner itself may nest blocks.
+_bulk_load_lock = threading.RLock()
+_bulk_load_owner: Optional[int] = None
+_bulk_load_depth = 0
+_bulk_load_session: Optional[WriteThroughput] = None
+
+
+def _read_pragma(dbapi_conn, name: str):
+    cursor = dbapi_conn.cursor()
+    try:
+        return cursor.execute(f"PRAGMA {name}").fetchone()[0]
+    finally:
+        cursor.close()
+
+
+def _set_pragmas(dbapi_conn, pragmas: Dict[str, object]) -> None:
+    cursor = dbapi_conn.cursor()
+    try:
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+    finally:
+        cursor.close()
+
+
+@event.listens_for(engine, "checkout")
+def _sync_bulk_load_pragmas(dbapi_conn, connection_record, _connection_proxy):
+    """Bring a pooled connection in line with the current bulk-load state."""
+    if _bulk_load_depth and not connection_record.info.get("bulk_load"):
+        connection_record.info["pragma_defaults"] = {
+            name: _read_pragma(dbapi_conn, name) for name in BULK_LOAD_PRAGMAS}
+        _set_pragmas(dbapi_conn, BULK_LOAD_PRAGMAS)
+        connection_record.info["bulk_load"] = True
+    elif not _bulk_load_depth and connection_record.info.get("bulk_load"):
+        _set_pragmas(dbapi_conn, connection_record.info.pop("pragma_defaults"))
+        connection_record.info["bulk_load"] = False
+
+
+def _persist_write_throughput(mode: str, rows: int, seconds: float) -> None:
+    """Add a write to the lifetime totals of *mode* in the write_throughput table."""
+    global _write_throughput_table_ready
+    try:
+        with engine.begin() as conn:
+            if not _write_throughput_table_ready:
+                conn.exec_driver_sql(WRITE_THROUGHPUT_TABLE_SQL)
+                _write_throughput_table_ready = True
+            conn.exec_driver_sql(
+                "INSERT INTO write_throughput (mode, rows, seconds) VALUES (?, ?, ?) "
+                "ON CONFLICT (mode) DO UPDATE SET rows = rows + excluded.rows, seconds = seconds + excluded.seconds",
+                (mode, rows, seconds),
+            )
+    except OperationalError as e:
+        # only statistics: never fail the write they describe
+        LOGGER.warning("Could not record %s write throughput: %s", mode, e)
+
+
+def persisted_write_throughput(mode: str) -> WriteThroughput:
+    """Lifetime write totals of *mode* on this database (zero if none were recorded)."""
+    with engine.connect() as conn:
+        if not conn.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'write_throughput'").scalar():
+            return WriteThroughput()
+        row = conn.exec_driver_sql("SELECT rows, seconds FROM write_throughput WHERE mode = ?", (mode,)).first()
+    return WriteThroughput(*row) if row else WriteThroughput()
+
+
+def record_write_throughput(rows: int, seconds: float) -> None:
+    """Account *rows* written in *seconds* against the current load mode."""
+    mode = "bulk" if _bulk_load_depth else "normal"
+    with _write_throughput_lock:
+        stats = WRITE_THROUGHPUT[mode]
+        stats.rows += rows
+        stats.seconds += seconds
+        if _bulk_load_owner == threading.get_ident():
+            _bulk_load_session.rows += rows
+            _bulk_load_session.seconds += seconds
+    if mode == "normal":
+        # bulk loads persist their totals once, when the mode ends
+        _persist_write_throughput(mode, rows, seconds)
+
+
+@contextmanager
+def bulk_load_mode() -> Iterator[WriteThroughput]:
+    """
+    Tune SQLite for large fact loads for the duration of the block.
+
+    Switches the database to WAL, relaxes ``synchronous``, enlarges the page
+    cache and keeps temp tables in memory. Everything is restored on exit,
+    and the throughput of the block is logged against the normal-mode
+    baseline persisted in the ``write_throughput`` table. Wrap only the raw
+    insert loop in :func:`deferred_fact_indexes` as well; the indexes are
+    left alone here because rollups and dashboards read through them.
+
+    One thread holds the mode at a time; a block entered from another thread
+    waits for the current one to finish. Blocks nested in the owning thread
+    share the outer block's setup and :class:`WriteThroughput`.
+
+    Yields the :class:`WriteThroughput` of this block.
+    """
+    global _bulk_load_depth, _bulk_load_session, _bulk_load_owner
+
+    if not _bulk_load_lock.acquire(blocking=False):
+        LOGGER.info("Bulk-load mode is held by another thread; waiting for it to finish")
+        _bulk_load_lock.acquire()
+    try:
+        if _bulk_load_depth:
+            # Nested use: the outer block owns setup and teardown.
+            _bulk_load_depth += 1
+            try:
+                yield _bulk_load_session
+            finally:
+                _bulk_load_depth -= 1
+            return
+
+        with engine.connect() as conn:
+            previous_journal_mode = conn.exec_driver_sql(
+                "PRAGMA journal_mode").scalar()
+            conn.exec_driver_sql("PRAGMA journal_mode = WAL")
+
+        LOGGER.info("Bulk-load mode on (journal_mode %s -> wal)", previous_journal_mode)
+        _bulk_load_session = WriteThroughput()
+        _bulk_load_owner = threading.get_ident()
+        _bulk_load_depth = 1
+        started = time.perf_counter()
+        try:
+            yield _bulk_load_session
+        finally:
+            _bulk_load_depth = 0
+            _bulk_load_owner = None
+            session_stats, _bulk_load_session = _bulk_load_session, None
+
+            # Return idle pooled connections so the next checkout restores PRAGMAs
+            # and the journal mode can be switched back.
+            engine.dispose()
+            with engine.connect() as conn:
+                try:
+                    restored = conn.exec_driver_sql(
+                        f"PRAGMA journal_mode = {previous_journal_mode}").scalar()
+                except OperationalError:
+                    # Leaving WAL needs exclusive access; other readers still have
+                    # the file open, and staying in WAL is harmless.
+                    restored = "wal"
+            if restored != previous_journal_mode:
+                LOGGER.warning(
+                    "Could not restore journal_mode to %s (still %s)", previous_journal_mode, restored)
+
+            if session_stats.rows:
+                _persist_write_throughput("bulk", session_stats.rows, session_stats.seconds)
+            baseline = persisted_write_throughput("normal").rows_per_sec
+            gain = f", {session_stats.rows_per_sec / baseline:.1f}x normal mode" if baseline else ""
+            LOGGER.info(
+                "Bulk-load mode off after %.1fs: wrote %d fact rows at %.0f rows/s%s",
+                time.perf_counter() - started,
+                session_stats.rows,
+                session_stats.rows_per_sec,
+                gain,
+            )
+    finally:
+        _bulk_load_lock.release()
+
+
+@contextmanager
+def deferred_fact_indexes() -> Iterator[List[str]]:
+    """
+    Drop the non-unique secondary indexes on ``facts`` for the block and
+    rebuild them once at the end instead of maintaining them row by row.
+
+    Meant for the raw insert loop of a bulk load only: while the block runs,
+    every reader of facts (rollups, dashboards in other processes) scans
+    without these indexes. UNIQUE indexes stay because the upserts rely on
+    them. The block holds the bulk-load lock, so it serialises with other
+    threads' bulk loads. If the process dies inside it, the next process's
+    :func:`upgrade_schema` re-creates the indexes. Yields the dropped names.
+    """
+    with _bulk_load_lock:
+        with engine.connect() as conn:
+            deferred = conn.exec_driver_sql(
+                "SELECT name, sql FROM sqlite_master "
+                "WHERE type = 'index' AND tbl_name = 'facts' AND sql IS NOT NULL "
+                "AND sql NOT LIKE 'CREATE UNIQUE%'"
+            ).fetchall()
+            for name, _ in deferred:
+                conn.exec_driver_sql(f'DROP INDEX IF EXISTS "{name}"')
+            conn.commit()
+        names = [name for name, _ in deferred]
+        LOGGER.info("Deferred facts indexes: %s", names or "none")
+        started = time.perf_counter()
+        try:
+            yield names
+        finally:
+            with engine.connect() as conn:
+                for _, sql in deferred:
+                    # another process's upgrade_schema may have re-created it already
+                    conn.exec_driver_sql(re.sub(r"^CREATE INDEX ", "CREATE INDEX IF NOT EXISTS ", sql))
+                if deferred:
+                    # the rebuilt indexes start without planner statistics
+                    conn.exec_driver_sql("ANALYZE facts")
+                conn.commit()
+            LOGGER.info("Rebuilt %d facts index(es) after %.1fs", len(deferred), time.perf_counter() - started)
+
+
+# ── Slow-query log ─────────────────────────────────────────────────────────────
+# Statements are timed by cursor events on the engine. Timings are kept per
+# query shape (the statement with bind lists collapsed), each new shape gets
+# its EXPLAIN QUERY PLAN once, and statements slower than the threshold are
+# written with their parameters and plan to a separate SQLite file so logging
+# never contends with warehouse writes.
+QUERY_LOG_PATH = os.path.join(os.path.dirname(db_path), "query_log.sqlite3")
+SLOW_QUERY_THRESHOLD_MS = 100.0
+# Statement kinds EXPLAIN QUERY PLAN is run for.
+EXPLAINABLE = ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE")
+
+_BIND_LIST_RE = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_WHITESPACE_RE = re.compile(r"\s+")
+# A plan step that reads a whole table (or a whole index) rather than a range.
+_FULL_SCAN_RE = re.compile(r"^SCAN (?!CONSTANT ROW)(\w+)", re.MULTILINE)
+
+
+def query_shape(statement: str) -> str:
+    """Normalise a statement so calls differing only in IN-list length share a shape."""
+    return _BIND_LIST_RE.sub("(?, ...)", _WHITESPACE_RE.sub(" ", statement).strip())
+
+
+@dataclass
+class ShapeStats:
+    """Latency samples (ms) of one query shape and its plan."""
+
+    count: int = 0
+    total_ms: float = 0.0
+    samples: Deque[float] = field(default_factory=lambda: deque(maxlen=1024))
+    plan: Optional[str] = None
+
+    @property
+    def full_scans(self) -> List[str]:
+        return _FULL_SCAN_RE.findall(self.plan or "")
+
+
+class QueryLog:
+    """
+    Statement timings for the warehouse engine.
+
+    ``shape_stats()`` reports count, mean and p50/p95/p99/max latency per
+    query shape (over the last 1024 calls of each) together with the tables
+    its plan scans in full. Statements taking at least ``threshold_ms`` are
+    also appended to the ``slow_queries`` table of ``QUERY_LOG_PATH``.
+
+    SQLite does most of the work of a plain filtered SELECT while rows are
+    fetched, after the cursor event fires; timings therefore cover planning
+    and the first row (all the work for sorts and aggregates). The captured
+    plans show full scans regardless.
+    """
+
+    def __init__(self, path: str = QUERY_LOG_PATH, threshold_ms: float = SLOW_QUERY_THRESHOLD_MS):
+        self.path = path
+        self.threshold_ms = threshold_ms
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._shapes: Dict[str, ShapeStats] = {}
+        self._log_conn: Optional[sqlite3.Connection] = None
+
+    def _log_connection(self) -> sqlite3.Connection:
+        if self._log_conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._log_conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._log_conn.execute(
+                "CREATE TABLE IF NOT EXISTS slow_queries ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, logged_at TEXT NOT NULL, elapsed_ms REAL NOT NULL, "
+                "shape TEXT NOT NULL, statement TEXT NOT NULL, parameters TEXT, plan TEXT)"
+            )
+        return self._log_conn
+
+    @staticmethod
+    def _explain(cursor, statement: str, parameters) -> Optional[str]:
+        if not statement.lstrip().upper().startswith(EXPLAINABLE):
+            return None
+        explain = cursor.connection.cursor()
+        try:
+            rows = explain.execute(f"EXPLAIN QUERY PLAN {statement}", parameters or ()).fetchall()
+        except sqlite3.Error as e:
+            return f"(EXPLAIN failed: {e})"
+        finally:
+            explain.close()
+        # rows are (id, parent, notused, detail); indent children under parents
+        depth = {0: -1}
+        lines = []
+        for node_id, parent, _, detail in rows:
+            depth[node_id] = depth.get(parent, -1) + 1
+            lines.append("  " * depth[node_id] + detail)
+        return "\n".join(lines) or None
+
+    def record(self, cursor, statement: str, parameters, elapsed_ms: float, executemany: bool) -> None:
+        shape = query_shape(statement)
+        with self._lock:
+            stats = self._shapes.get(shape)
+            new_shape = stats is None
+            if new_shape:
+                stats = self._shapes[shape] = ShapeStats()
+            stats.count += 1
+            stats.total_ms += elapsed_ms
+            stats.samples.append(elapsed_ms)
+        if new_shape and not executemany:
+            stats.plan = self._explain(cursor, statement, parameters)
+            if stats.full_scans:
+                LOGGER.debug(f"Query shape scans {stats.full_scans} in full: {shape[:200]}")
+        if elapsed_ms < self.threshold_ms:
+            return
+
+        plan = stats.plan if not executemany else None
+        if executemany:
+            # a bulk write's parameter list can hold every row; keep a sample
+            logged_parameters = f"{parameters[:3]!r} ... ({len(parameters)} parameter sets)"
+        else:
+            logged_parameters = repr(parameters)[:4000]
+        LOGGER.info(f"Slow query ({elapsed_ms:.0f} ms): {shape[:200]}")
+        with self._lock:
+            conn = self._log_connection()
+            conn.execute(
+                "INSERT INTO slow_queries (logged_at, elapsed_ms, shape, statement, parameters, plan) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (datetime.utcnow().isoformat(), elapsed_ms, shape, statement, logged_parameters, plan),
+            )
+            conn.commit()
+
+    def shape_stats(self):
+        """Per-shape latency summary as a DataFrame, slowest p95 first."""
+        with self._lock:
+            rows = [
+                {
+                    "shape": shape,
+                    "count": stats.count,
+                    "mean_ms": stats.total_ms / stats.count,
+                    **dict(zip(("p50_ms", "p95_ms", "p99_ms"), _percentiles(list(stats.samples), (50, 95, 99)))),
+                    "max_ms": max(stats.samples),
+                    "full_scans": ", ".join(stats.full_scans),
+                    "plan": stats.plan,
+                }
+                for shape, stats in self._shapes.items()
+            ]
+        columns = ["shape", "count", "mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms", "full_scans", "plan"]
+        return pd.DataFrame(rows, columns=columns).sort_values("p95_ms", ascending=False, ignore_index=True)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._shapes.clear()
+
+
+def _percentiles(samples: List[float], qs) -> List[float]:
+    """Nearest-rank percentiles of a non-empty sample."""
+    ordered = sorted(samples)
+    return [ordered[min(len(ordered) - 1, max(0, -(-q * len(ordered) // 100) - 1))] for q in qs]
+
+
+QUERY_LOG = QueryLog()
+
+
+@event.listens_for(engine, "before_cursor_execute")
+def _start_query_timer(_conn, _cursor, _statement, _parameters, context, _executemany):
+    if QUERY_LOG.enabled:
+        context._query_started = time.perf_counter()
+
+
+@event.listens_for(engine, "after_cursor_execute")
+def _record_query_time(_conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, "_query_started", None)
+    if started is not None:
+        QUERY_LOG.record(cursor, statement, parameters, (time.perf_counter() - started) * 1000, executemany)
+
 # if __name__ == "__main__":
 # BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 # LOGGER.info(f"Base dir - {BASE_DIR}")
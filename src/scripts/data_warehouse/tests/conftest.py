@@ -0,0 +1,81 @@
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+# Point the warehouse at a throwaway database before any module creates its engine.
+TEST_DB_DIR = tempfile.mkdtemp(prefix="mda-tests-")
+os.environ["MDA_DB_PATH"] = os.path.join(TEST_DB_DIR, "database.sqlite3")
+os.environ.pop("MDA_FACTS_LAYOUT", None)
+os.environ.pop("MDA_SHARED_CACHE_DIR", None)
+
+from src.scripts.data_warehouse.cache import FACTS_GENERATION, QUERY_CACHE, bump_generation  # noqa: E402
+from src.scripts.data_warehouse.init_db import initialize_database  # noqa: E402
+from src.scripts.data_warehouse.load_db import (  # noqa: E402
+    load_camps_from_json,
+    load_metrics_from_json,
+    load_sites_from_json,
+)
+from src.scripts.data_warehouse.models.warehouse import engine  # noqa: E402
+
+SITES = ("1100", "5100", "10320", "10101", "14100")
+
+
+@pytest.fixture(scope="session", autouse=True)
+def warehouse():
+    """A fresh database with the metrics, camps and sites dimensions loaded."""
+    initialize_database()
+    load_metrics_from_json()
+    load_camps_from_json()
+    load_sites_from_json()
+    yield engine
+    engine.dispose()
+    shutil.rmtree(TEST_DB_DIR, ignore_errors=True)
+
+
+@pytest.fixture(autouse=True)
+def empty_facts(warehouse):
+    """Start every test without fact rows or cached query results."""
+    with warehouse.begin() as conn:
+        conn.exec_driver_sql("DELETE FROM facts")
+    bump_generation(FACTS_GENERATION)
+    QUERY_CACHE.clear()
+
+
+@pytest.fixture
+def make_facts():
+    """Factory of daily site-level fact frames with reproducible random values."""
+
+    def _make(metric_id, start="2024-01-01", end="2024-12-31", sites=SITES, seed=0):
+        rng = np.random.default_rng(seed + metric_id)
+        dates = pd.date_range(start, end, freq="D")
+        return pd.DataFrame(
+            {
+                "metric_id": metric_id,
+                "group_name": np.repeat(sites, len(dates)),
+                "value": rng.integers(1, 1000, len(sites) * len(dates)).astype(float),
+                "date": np.tile(dates, len(sites)),
+                "period_level": 1,
+            }
+        )
+
+    return _make
+
+
+@pytest.fixture
+def stored_facts(warehouse):
+    """Reader of every stored row of a metric, sorted on its key, with the group's natural key."""
+
+    def _read(metric_id) -> pd.DataFrame:
+        return pd.read_sql(
+            "SELECT f.metric_id, g.natural_key AS group_name, f.date, f.period_level, f.value, f.numerator, "
+            "f.denominator FROM facts f JOIN groups g ON g.id = f.group_id WHERE f.metric_id = ? "
+            "ORDER BY f.period_level, g.natural_key, f.date",
+            warehouse,
+            params=(metric_id,),
+        )
+
+    return _read
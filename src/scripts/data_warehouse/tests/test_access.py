@@ -0,0 +1,88 @@
+from datetime import date
+
+import pytest
+from pandas.testing import assert_frame_equal
+from sqlalchemy import event
+
+from src.scripts.data_warehouse import access
+from src.scripts.data_warehouse.access import FactQuery, query_facts, query_facts_many
+from src.scripts.data_warehouse.models.warehouse import SessionLocal
+from src.scripts.data_warehouse.utils import insert_facts_from_df
+
+
+@pytest.fixture
+def batched_statements(warehouse):
+    """Texts of the batched query_facts_many statements run while the test is active."""
+    statements = []
+
+    def _record(conn, cursor, statement, parameters, context, executemany):
+        if "UNION ALL" in statement or " AS spec" in statement:
+            statements.append(statement)
+
+    event.listen(warehouse, "before_cursor_execute", _record)
+    yield statements
+    event.remove(warehouse, "before_cursor_execute", _record)
+
+
+SPECS = {
+    "site": FactQuery(metric_id=1, group_name="1100"),
+    "sites": FactQuery(metric_id=1, group_names=["5100", "10320"], date_from=date(2024, 1, 10)),
+    "day": FactQuery(metric_ids=[1, 3], exact_date=date(2024, 1, 15)),
+    "range": FactQuery(metric_id=3, date_from=date(2024, 1, 5), date_to=date(2024, 1, 7)),
+    "none": FactQuery(metric_id=2),
+}
+
+
+def test_query_facts_many_splits_compound_selects(make_facts, monkeypatch, batched_statements):
+    for metric_id in (1, 3):
+        insert_facts_from_df(make_facts(metric_id, end="2024-01-31"))
+    monkeypatch.setattr(access, "MAX_COMPOUND_SELECT", 2)
+
+    with SessionLocal() as session:
+        results = query_facts_many(session, SPECS, use_cache=False)
+        expected = {key: query_facts(session, **vars(spec), use_cache=False) for key, spec in SPECS.items()}
+
+    assert len(batched_statements) == 3
+    assert list(results) == list(SPECS)
+    assert results["none"].empty
+    for key, frame in expected.items():
+        assert_frame_equal(results[key].reset_index(drop=True), frame.reset_index(drop=True), check_dtype=False)
+
+
+def test_query_facts_many_serves_cached_specs_without_sql(make_facts, batched_statements):
+    insert_facts_from_df(make_facts(1, end="2024-01-31"))
+
+    with SessionLocal() as session:
+        first = query_facts_many(session, SPECS)
+        statements = len(batched_statements)
+        second = query_facts_many(session, SPECS)
+
+    assert statements == 1 and len(batched_statements) == 1
+    for key in SPECS:
+        assert_frame_equal(first[key], second[key])
+
+
+@pytest.mark.parametrize("period_level, start", [
+    (1, date(2024, 2, 29)),
+    (2, date(2024, 2, 1)),
+    (2, date(2023, 2, 1)),
+    (2, date(2024, 12, 1)),
+    (3, date(2024, 1, 1)),
+    (3, date(2024, 10, 1)),
+    (4, date(2024, 1, 1)),
+])
+def test_date_range_labels_match_scalar_labels(period_level, start):
+    labels = access.date_range_labels([period_level], [start])
+    assert labels.tolist() == [access.get_date_range_by_datekey(period_level, start)]
+
+
+def test_date_range_labels_mix_levels_and_reject_unknown_ones():
+    labels = access.date_range_labels([1, 2, 3, 4], ["2024-05-06"] + ["2024-04-01"] * 3)
+    assert labels.tolist() == [
+        "20240506 to 20240506",
+        "20240401 to 20240430",
+        "20240401 to 20240630",
+        "20240401 to 20241231",
+    ]
+    with pytest.raises(ValueError, match="Unsupported period level: 5"):
+        access.date_range_labels([2, 5], ["2024-01-01", "2024-01-01"])
@@ -0,0 +1,106 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from src.scripts.data_warehouse.access import query_facts
+from src.scripts.data_warehouse.cache import (
+    DATABASE_EPOCH,
+    QueryCache,
+    SingleFlight,
+    column_arrays_nbytes,
+    read_facts_version,
+)
+from src.scripts.data_warehouse.models.warehouse import SessionLocal
+from src.scripts.data_warehouse.utils import insert_facts_from_df
+
+
+def _result(n: int):
+    return {"value": np.arange(n, dtype=np.float64)}
+
+
+def test_query_cache_evicts_least_recently_used_past_byte_budget():
+    size = column_arrays_nbytes(_result(100))
+    cache = QueryCache(max_bytes=2 * size)
+    cache.put("a", _result(100))
+    cache.put("b", _result(100))
+    assert cache.get("a") is not None  # "b" is now the least recently used
+
+    cache.put("c", _result(100))
+    assert cache.get("b") is None
+    assert cache.get("a") is not None and cache.get("c") is not None
+    assert cache.bytes == 2 * size
+    assert cache.stats.evictions == 1
+
+
+def test_query_cache_skips_results_over_budget_and_hands_out_copies():
+    cache = QueryCache(max_bytes=column_arrays_nbytes(_result(10)))
+    cache.put("big", _result(11))
+    assert cache.get("big") is None and cache.bytes == 0
+
+    cache.put("small", _result(10))
+    cache.get("small")["value"][:] = -1
+    assert cache.get("small")["value"][0] == 0
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    flights = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def load():
+        calls.append(1)
+        release.wait(5)
+        return object()
+
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        futures = [pool.submit(flights.do, "key", load) for _ in range(4)]
+        while flights.stats.calls < 4:
+            time.sleep(0.01)
+        release.set()
+        results = [future.result() for future in futures]
+
+    assert len(calls) == 1
+    assert len({id(result) for result, _ in results}) == 1
+    assert all(shared for _, shared in results)
+    assert flights.stats.coalesced == 3
+    assert flights.stats_dict()["in_flight"] == 0
+
+
+def test_single_flight_shares_the_leader_error_and_forgets_the_key():
+    flights = SingleFlight()
+    release = threading.Event()
+
+    def fail():
+        release.wait(5)
+        raise RuntimeError("query failed")
+
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        futures = [pool.submit(flights.do, "key", fail) for _ in range(2)]
+        while flights.stats.calls < 2:
+            time.sleep(0.01)
+        release.set()
+        for future in futures:
+            with pytest.raises(RuntimeError):
+                future.result()
+
+    assert flights.do("key", lambda: 1) == (1, False)
+
+
+def test_cached_results_are_not_served_for_a_recreated_database(make_facts, warehouse):
+    insert_facts_from_df(make_facts(1, end="2024-01-31"))
+    with SessionLocal() as session:
+        epoch, generation = read_facts_version(session)
+        before = query_facts(session=session, metric_id=1, period_level=1)
+
+    # a re-created database: other facts, a new epoch, the same facts generation
+    with warehouse.begin() as conn:
+        conn.exec_driver_sql("UPDATE facts SET value = value + 1")
+        conn.exec_driver_sql("UPDATE generations SET value = ? WHERE name = ?", (epoch + 1, DATABASE_EPOCH))
+
+    with SessionLocal() as session:
+        assert read_facts_version(session) == (epoch + 1, generation)
+        after = query_facts(session=session, metric_id=1, period_level=1)
+    assert np.allclose(after["value"].to_numpy(), before["value"].to_numpy() + 1)
@@ -0,0 +1,38 @@
+import pytest
+
+from src.scripts.data_warehouse.derived import evaluate_derived_metric, formula_metric_ids, get_derived_metrics
+from src.scripts.data_warehouse.utils import apply_metric_cube, build_metric_cube, insert_facts_from_df
+
+FACT_KEY = ["group_name", "date", "period_level"]
+
+
+@pytest.fixture
+def average_order_value():
+    (metric,) = [m for m in get_derived_metrics(depends_on=[1]) if m.id == 4]
+    assert metric.formula == "m1 / m3"
+    return metric
+
+
+def test_average_order_value_is_revenue_over_transactions(make_facts, stored_facts, average_order_value):
+    transactions = make_facts(3)
+    transactions.loc[transactions.index[:3], "value"] = 0  # no transactions: no AOV row
+    for metric_id, facts in ((1, make_facts(1)), (3, transactions)):
+        insert_facts_from_df(facts)
+        apply_metric_cube(build_metric_cube(metric_id, "sum"))
+
+    assert evaluate_derived_metric(average_order_value) > 0
+
+    revenue, orders, aov = stored_facts(1), stored_facts(3), stored_facts(4)
+    expected = revenue.merge(orders, on=FACT_KEY, suffixes=("_1", "_3"))
+    expected = expected[expected["value_3"] != 0]
+    actual = aov.merge(expected, on=FACT_KEY, how="outer", indicator=True)
+    assert (actual["_merge"] == "both").all()
+    assert actual["value"].to_numpy() == pytest.approx((actual["value_1"] / actual["value_3"]).to_numpy())
+    assert actual["numerator"].to_numpy() == pytest.approx(actual["value_1"].to_numpy())
+    assert actual["denominator"].to_numpy() == pytest.approx(actual["value_3"].to_numpy())
+
+
+@pytest.mark.parametrize("formula", ["", "m1 / x3", "import os", "2 * 3"])
+def test_invalid_formulas_are_rejected(formula):
+    with pytest.raises(ValueError):
+        formula_metric_ids(formula)
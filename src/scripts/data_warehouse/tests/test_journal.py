@@ -0,0 +1,70 @@
+import uuid
+
+import pytest
+from sqlalchemy import select
+
+from src.scripts.data_warehouse.journal import STAGE_ETL, STAGE_ROLLUP, HydrationJournal
+from src.scripts.data_warehouse.models.warehouse import IngestionJournal, SessionLocal
+
+
+@pytest.fixture
+def file_hash():
+    return uuid.uuid4().hex
+
+
+def _status(file_hash, stage, metric_id):
+    with SessionLocal() as session:
+        return session.execute(
+            select(IngestionJournal.status).where(
+                IngestionJournal.file_hash == file_hash,
+                IngestionJournal.stage == stage,
+                IngestionJournal.metric_id == metric_id,
+            )
+        ).scalar_one_or_none()
+
+
+def test_done_stages_are_skipped_on_resume(file_hash):
+    journal = HydrationJournal(file_hash)
+    with journal.stage(STAGE_ETL, 1) as entry:
+        entry.rows = 10
+
+    resumed = HydrationJournal(file_hash)
+    assert resumed.is_done(STAGE_ETL, 1)
+    assert not resumed.is_done(STAGE_ROLLUP, 1)
+    assert resumed.all_done(STAGE_ETL, [1])
+    assert not resumed.all_done(STAGE_ETL, [1, 2])
+
+
+def test_skipped_stage_is_recorded_as_failed(file_hash):
+    journal = HydrationJournal(file_hash)
+    with journal.stage(STAGE_ETL, 1) as entry:
+        entry.skip()
+
+    assert _status(file_hash, STAGE_ETL, 1) == "failed"
+    assert not journal.is_done(STAGE_ETL, 1)
+    assert not HydrationJournal(file_hash).is_done(STAGE_ETL, 1)
+
+
+def test_raising_stage_is_recorded_as_failed(file_hash):
+    journal = HydrationJournal(file_hash)
+    with pytest.raises(RuntimeError):
+        with journal.stage(STAGE_ETL, 1):
+            raise RuntimeError("ETL crashed")
+
+    assert _status(file_hash, STAGE_ETL, 1) == "failed"
+    assert not HydrationJournal(file_hash).is_done(STAGE_ETL, 1)
+
+
+def test_reset_forgets_every_stage_of_the_file(file_hash):
+    journal = HydrationJournal(file_hash)
+    for stage in (STAGE_ETL, STAGE_ROLLUP):
+        with journal.stage(stage, 1) as entry:
+            entry.rows = 1
+    other = HydrationJournal(uuid.uuid4().hex)
+    with other.stage(STAGE_ETL, 1) as entry:
+        entry.rows = 1
+
+    assert HydrationJournal(file_hash).reset() == 2
+    assert journal.reset() == 0
+    assert not HydrationJournal(file_hash).completed
+    assert HydrationJournal(other.file_hash).is_done(STAGE_ETL, 1)
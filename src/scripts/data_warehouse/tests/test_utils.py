@@ -0,0 +1,86 @@
+import pytest
+from pandas.testing import assert_frame_equal
+
+from src.scripts.data_warehouse.utils import (
+    apply_metric_cube,
+    build_metric_cube,
+    insert_facts_from_df,
+    rollup_metric_in_sql,
+)
+
+
+def test_incremental_cube_matches_full_rebuild(make_facts, stored_facts):
+    facts = make_facts(1)
+    insert_facts_from_df(facts.copy())
+    apply_metric_cube(build_metric_cube(1, "sum"))
+
+    # a few days straddling a month / quarter boundary change
+    changed = facts[(facts["date"] >= "2024-03-30") & (facts["date"] <= "2024-04-02")].copy()
+    changed["value"] += 7
+    insert_facts_from_df(changed.copy())
+    cube = build_metric_cube(1, "sum", changed_keys=changed)
+    assert cube.incremental
+    apply_metric_cube(cube)
+    incremental = stored_facts(1)
+
+    apply_metric_cube(build_metric_cube(1, "sum"))
+    assert_frame_equal(incremental, stored_facts(1))
+
+
+def test_incremental_cube_without_changes_is_empty(make_facts):
+    facts = make_facts(1)
+    insert_facts_from_df(facts.copy())
+    assert build_metric_cube(1, "sum", changed_keys=facts.iloc[:0]).rows.empty
+
+
+def test_sql_rollup_matches_cube(make_facts, stored_facts):
+    insert_facts_from_df(make_facts(1, start="2023-11-01"))
+    apply_metric_cube(build_metric_cube(1, "sum"))
+    cube = stored_facts(1)
+
+    assert rollup_metric_in_sql(1, "sum") > 0
+    assert_frame_equal(cube, stored_facts(1), check_exact=False, rtol=1e-9)
+
+
+def _ratio_facts(make_facts, metric_id):
+    facts = make_facts(metric_id, start="2023-11-01")
+    facts["denominator"] = (facts["value"] % 40 + 1).astype(float)
+    facts["numerator"] = facts["value"] * facts["denominator"]
+    return facts
+
+
+def test_ratio_rollup_weights_by_components(make_facts, stored_facts):
+    facts = _ratio_facts(make_facts, 7)
+    insert_facts_from_df(facts.copy())
+    apply_metric_cube(build_metric_cube(7, "ratio"))
+    cube = stored_facts(7)
+
+    year = facts[facts["date"].dt.year == 2024]
+    total = cube[(cube["group_name"] == "all") & (cube["period_level"] == 4) & (cube["date"] == "2024-01-01")]
+    assert total["value"].item() == pytest.approx(year["numerator"].sum() / year["denominator"].sum())
+
+    rollup_metric_in_sql(7, "ratio")
+    assert_frame_equal(cube, stored_facts(7), check_exact=False, rtol=1e-9)
+
+
+@pytest.mark.parametrize("rollup", [
+    lambda: apply_metric_cube(build_metric_cube(7, "ratio")),
+    lambda: rollup_metric_in_sql(7, "ratio"),
+])
+def test_ratio_rollup_refuses_mixed_rows(make_facts, warehouse, rollup):
+    insert_facts_from_df(_ratio_facts(make_facts, 7))
+    with warehouse.begin() as conn:
+        conn.exec_driver_sql("UPDATE facts SET numerator = NULL, denominator = NULL WHERE date < '2024-03-01'")
+
+    with pytest.raises(ValueError, match="2024-01-01"):
+        rollup()
+
+
+def test_ratio_rollup_of_rows_without_components_is_a_mean(make_facts, stored_facts):
+    facts = make_facts(7)
+    insert_facts_from_df(facts.copy())
+    apply_metric_cube(build_metric_cube(7, "ratio"))
+    cube = stored_facts(7)
+
+    total = cube[(cube["group_name"] == "all") & (cube["period_level"] == 4)]
+    assert total["value"].item() == pytest.approx(facts["value"].mean())
@@ -0,0 +1,63 @@
+import sqlite3
+from contextlib import closing
+
+import pytest
+from pandas.testing import assert_frame_equal
+
+from src.scripts.data_warehouse.access import query_facts
+from src.scripts.data_warehouse.models.warehouse import (
+    FACTS_LAYOUTS,
+    SessionLocal,
+    db_path,
+    facts_layout,
+    migrate_facts_layout,
+)
+from src.scripts.data_warehouse.utils import insert_facts_from_df
+
+SNAPSHOT_SQL = (
+    "SELECT metric_id, period_level, group_id, date, value, numerator, denominator FROM facts "
+    "ORDER BY metric_id, period_level, group_id, date"
+)
+
+
+@pytest.fixture
+def dbapi_conn():
+    """A raw connection to the test database, with facts moved back to the rowid layout afterwards."""
+    with closing(sqlite3.connect(db_path)) as conn:
+        yield conn
+        migrate_facts_layout(conn, "rowid")
+
+
+def _index_names(conn):
+    return {row[1] for row in conn.execute("PRAGMA index_list(facts)") if row[3] == "c"}
+
+
+def _query(metric_id):
+    with SessionLocal() as session:
+        return query_facts(session=session, metric_id=metric_id, use_cache=False)
+
+
+def test_layout_migration_round_trip_keeps_rows(make_facts, dbapi_conn):
+    insert_facts_from_df(make_facts(1, end="2024-03-31"))
+    before = dbapi_conn.execute(SNAPSHOT_SQL).fetchall()
+    frame = _query(1)
+    assert facts_layout(dbapi_conn) == "rowid"
+
+    assert migrate_facts_layout(dbapi_conn, "clustered")
+    assert facts_layout(dbapi_conn) == "clustered"
+    assert not migrate_facts_layout(dbapi_conn, "clustered")
+    assert dbapi_conn.execute(SNAPSHOT_SQL).fetchall() == before
+    assert _index_names(dbapi_conn) == {name for name, _ in FACTS_LAYOUTS["clustered"][1]}
+    assert_frame_equal(_query(1).sort_values(["group_name", "date"], ignore_index=True),
+                       frame.sort_values(["group_name", "date"], ignore_index=True))
+
+    assert migrate_facts_layout(dbapi_conn, "rowid")
+    assert facts_layout(dbapi_conn) == "rowid"
+    assert dbapi_conn.execute(SNAPSHOT_SQL).fetchall() == before
+    assert _index_names(dbapi_conn) == {name for name, _ in FACTS_LAYOUTS["rowid"][1]}
+
+
+def test_layout_migration_rejects_unknown_layouts(dbapi_conn):
+    with pytest.raises(ValueError, match="Unknown facts layout"):
+        migrate_facts_layout(dbapi_conn, "columnar")
+    assert facts_layout(dbapi_conn) == "rowid"
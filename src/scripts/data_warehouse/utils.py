@@ -1,9 +1,27 @@
+import multiprocessing
+import os
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from dataclasses import dataclass
+from datetime import date
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+import numpy as np
 import pandas as pd
-from sqlalchemy import Integer, cast
-from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy import delete, or_, select
 
 from src.scripts.data_warehouse.access import getSites, query_facts
-from src.scripts.data_warehouse.models.warehouse import Facts, Metrics, SessionLocal
+from src.scripts.data_warehouse.cache import FACTS_GENERATION, bump_generation
+from src.scripts.data_warehouse.models.warehouse import (
+    Facts,
+    Groups,
+    Metrics,
+    SessionLocal,
+    engine,
+    record_write_throughput,
+    register_groups,
+    sync_groups,
+)
 from src.utils.logging import LOGGER
 
 
@@ -116,281 +134,661 @@ def aggregate_metric_by_time_period_legacy(lowest_level: pd.DataFrame, _method:
     return res
 
 
-def insert_facts_from_df(df_facts: pd.DataFrame) -> int:
+# Columns of _fact_records rows, in the order of the facts INSERTs.
+FACT_RECORD_COLUMNS = ["metric_id", "group_name", "date", "period_level", "value", "numerator", "denominator"]
+# Storage columns they are written to (group_name becomes group_id).
+_FACT_STORE_COLUMNS = "metric_id, group_id, date, period_level, value, numerator, denominator, record_inserted_date"
+
+
+def _fact_records(df_facts: pd.DataFrame) -> List[dict]:
+    """
+    Fact rows as executemany parameters: dates as ISO ``date`` strings,
+    group names as text (resolved to ``groups.id`` by the INSERT itself, see
+    :func:`_register_fact_groups`), NaN components as NULL.
+    """
     df_facts["date"] = pd.to_datetime(
-        df_facts["date"], errors="coerce").dt.date
-    records = df_facts.to_dict(orient="records")
+        df_facts["date"], errors="coerce").dt.strftime("%Y-%m-%d")
+    if df_facts["group_name"].isna().any():
+        LOGGER.error("Fact rows without a group_name cannot be stored.")
+        raise ValueError("Fact rows without a group_name cannot be stored.")
+    df_facts["group_name"] = df_facts["group_name"].astype(str)
+    # Ratio components are optional; NaN is stored as NULL.
+    frame = df_facts.reindex(columns=FACT_RECORD_COLUMNS).astype({"numerator": object, "denominator": object})
+    return frame.where(frame.notna(), None).to_dict(orient="records")
 
-    with SessionLocal() as session:
-        num_processed = 0
-
-        for row in records:
-            # 1) Build a base insert statement:
-            base_stmt = sqlite_insert(Facts).values(
-                metric_id=row["metric_id"],
-                group_name=row["group_name"],
-                date=row["date"],
-                period_level=row["period_level"],
-                value=row["value"],
-            )
-            # 2) Add the on_conflict_do_update part:
-            stmt = base_stmt.on_conflict_do_update(
-                index_elements=["metric_id",
-                                "group_name", "date", "period_level"],
-                set_={
-                    # Refer to base_stmt.excluded instead of stmt.excluded
-                    "value": base_stmt.excluded.value
-                },
-            )
-
-            session.execute(stmt)
-            num_processed += 1
-
-        session.commit()
-
-    return num_processed
-
-
-def aggregate_metric_by_time_period(_metric_id: int, _method: str) -> pd.DataFrame:
-    """
-    Aggregates daily data into monthly, quarterly, or yearly totals,
-    depending on the flags in the metric associated with the given metric_id.
-    Appends the aggregated rows to the original DataFrame ('res') and returns
-    the combined result.
-
-    :param metric_id: The ID of the metric to process.
-    :param _method: The name of a pandas aggregation method (e.g. 'sum', 'mean').
-    :param session: An active SQLAlchemy Session for database interaction.
-    :return: A DataFrame with daily rows plus aggregated rows, each flagged
-        by 'period_level' (1=daily, 2=monthly, 3=quarterly, 4=yearly).
+
+def _register_fact_groups(conn, records: List[dict]) -> None:
     """
-    LOGGER.info(f"Fetching daily data for metric_id: {_metric_id}")
+    Give every group name in *records* a group, inside the caller's write
+    transaction. The ids are then looked up by the INSERT in that same
+    transaction rather than taken from ``GROUP_REGISTRY``, whose ids may
+    belong to an earlier incarnation of the database.
+    """
+    register_groups(conn.connection, sorted({r["group_name"] for r in records}))
 
-    metric_id = int(_metric_id)
-    LOGGER.info(f"Processing metric_id: {metric_id}")
 
-    metric = get_metric_md(metric_id)
+# Conflict clause for INSERTs into facts: upsert on the natural key.
+_SQL_UPSERT = (
+    "ON CONFLICT (metric_id, group_id, date, period_level) DO UPDATE SET "
+    "value = excluded.value, numerator = excluded.numerator, denominator = excluded.denominator"
+)
 
-    if metric is None:
-        LOGGER.error(f"Metric with id {metric_id} not found.")
-        raise ValueError(f"Metric with id {metric_id} not found.")
+_SQL_INSERT_FACT = (
+    f"INSERT INTO facts ({_FACT_STORE_COLUMNS}) VALUES (:metric_id, "
+    "(SELECT id FROM groups WHERE natural_key = :group_name), "
+    ":date, :period_level, :value, :numerator, :denominator, CURRENT_TIMESTAMP) "
+    f"{_SQL_UPSERT}"
+)
 
-    if metric.is_daily:
-        min_level = 1
-    elif metric.is_monthly:
-        min_level = 2
-    elif metric.is_quarterly:
-        min_level = 3
-    elif metric.is_yearly:
-        min_level = 4
-    else:
-        raise ValueError(f"Metric {metric_id} has no granularity flags set.")
 
-    with SessionLocal() as session:
-        deleted = (
-            session.query(Facts)
-            # anything above the base level
-            .filter(Facts.metric_id == metric_id, Facts.period_level > min_level)
-            .delete(synchronize_session=False)
+def insert_facts_from_df(df_facts: pd.DataFrame) -> int:
+    """
+    Upsert fact rows on (metric_id, group, date, period_level).
+
+    All rows go through one executemany in a single transaction; the elapsed
+    time is recorded so bulk-load throughput can be compared with normal mode.
+    """
+    records = _fact_records(df_facts)
+    if not records:
+        return 0
+
+    started = time.perf_counter()
+    with engine.begin() as conn:
+        _register_fact_groups(conn, records)
+        conn.exec_driver_sql(_SQL_INSERT_FACT, records)
+    record_write_throughput(len(records), time.perf_counter() - started)
+    bump_generation(FACTS_GENERATION)
+
+    return len(records)
+
+
+# Per-connection TEMP table that rebuilt rows are staged in before the swap.
+SHADOW_TABLE = "facts_shadow"
+_SHADOW_COLUMNS = ", ".join(FACT_RECORD_COLUMNS)
+
+
+def replace_facts_atomically(metric_id: int, stale, df_facts: pd.DataFrame) -> int:
+    """
+    Swap a metric's rebuilt rollups in with a single write transaction.
+
+    Rows are first staged in a TEMP shadow table on the writing connection,
+    which takes no lock on the main database. Then one transaction deletes
+    the rows matched by *stale* (a condition on ``Facts``) and upserts the
+    shadow rows into ``facts``. In WAL mode, readers keep seeing the old
+    complete aggregates until the commit and the new ones afterwards, and
+    they are never blocked. Returns the number of rows written.
+    """
+    records = _fact_records(df_facts)
+    placeholders = ", ".join(f":{name}" for name in FACT_RECORD_COLUMNS)
+    started = time.perf_counter()
+    with engine.connect() as conn:
+        conn.exec_driver_sql(
+            f"CREATE TEMP TABLE IF NOT EXISTS {SHADOW_TABLE} (metric_id INTEGER, group_name TEXT, date DATE, "
+            "period_level INTEGER, value FLOAT, numerator FLOAT, denominator FLOAT)"
         )
-        session.commit()
-    LOGGER.info(
-        f"Deleted {deleted} stale rows (period_level >{min_level}) for metric_id={metric_id}")
+        conn.exec_driver_sql(f"DELETE FROM {SHADOW_TABLE}")
+        if records:
+            conn.exec_driver_sql(f"INSERT INTO {SHADOW_TABLE} ({_SHADOW_COLUMNS}) VALUES ({placeholders})", records)
+            _register_fact_groups(conn, records)
+        deleted = conn.execute(delete(Facts).where(Facts.metric_id == metric_id, stale)).rowcount
+        written = conn.exec_driver_sql(
+            f"INSERT INTO facts ({_FACT_STORE_COLUMNS}) "
+            "SELECT s.metric_id, g.id, s.date, s.period_level, s.value, s.numerator, s.denominator, "
+            f"CURRENT_TIMESTAMP FROM {SHADOW_TABLE} s JOIN groups g ON g.natural_key = s.group_name "
+            f"WHERE true {_SQL_UPSERT}"
+        ).rowcount
+        conn.exec_driver_sql(f"DELETE FROM {SHADOW_TABLE}")
+        conn.commit()
+    record_write_throughput(len(records), time.perf_counter() - started)
+    bump_generation(FACTS_GENERATION)
+    LOGGER.info(f"Swapped in {written} rows for metric_id={metric_id} (replaced {deleted} stale rows)")
+    return written
+
+
+FACT_COLUMNS = ["metric_id", "group_name", "value", "date", "period_level", "numerator", "denominator"]
+HIERARCHY_ALL = "all"
+
+# Facts rows of hierarchy groups ('all', camps, store formats), i.e. output
+# of an earlier rollup.
+NON_SITE_ROWS = Facts.group_id.in_(select(Groups.id).where(Groups.kind != "site"))
+
+# agg_method of metrics stored with additive numerator / denominator components
+RATIO_METHOD = "ratio"
+RATIO_COMPONENTS = ["numerator", "denominator"]
+
+# (period_level, metric flag, pandas period alias) for every level above daily
+TIME_LEVELS = ((2, "is_monthly", "M"), (3, "is_quarterly", "Q"), (4, "is_yearly", "Y"))
+
+
+# Methods whose result over a period can be rebuilt from the results over its
+# sub-periods, mapped to the method that combines those partial results.
+CASCADE_METHODS = {"sum": "sum", "min": "min", "max": "max", "count": "sum", RATIO_METHOD: RATIO_METHOD}
+
+
+def _with_components(frame: pd.DataFrame) -> pd.DataFrame:
+    """
+    Return *frame* with float numerator / denominator columns. Rows loaded
+    before components were stored count as value / 1; the rollups refuse to
+    mix them with rows that have components (see
+    :func:`_mixed_ratio_periods`).
+    """
+    numerator = frame["numerator"] if "numerator" in frame else pd.Series(np.nan, index=frame.index)
+    denominator = frame["denominator"] if "denominator" in frame else pd.Series(np.nan, index=frame.index)
+    missing = numerator.isna() | denominator.isna()
+    return frame.assign(
+        numerator=numerator.astype(float).where(~missing, frame["value"].astype(float)),
+        denominator=denominator.astype(float).where(~missing, 1.0),
+    )
 
-    with SessionLocal() as session:
-        lowest_level = query_facts(
-            session=session, metric_id=metric_id, period_level=min_level)
 
-    if lowest_level.empty:
-        LOGGER.warning(f"No daily data found for metric_id: {metric_id}")
-        return pd.DataFrame(columns=["date", "value", "metric_id", "group_name", "period_level"])
+def _ratio_values(numerator: pd.Series, denominator: pd.Series) -> pd.Series:
+    """numerator / denominator, 0.0 where the denominator is 0 (as the ETL does)."""
+    return (numerator / denominator.where(denominator != 0)).fillna(0.0)
 
-    if not pd.api.types.is_datetime64_any_dtype(lowest_level["date"]):
-        # Assuming YYYYMMDD format if not datetime
-        try:
-            lowest_level["date"] = pd.to_datetime(
-                lowest_level["date"], format="%Y%m%d", errors="raise")
-        except ValueError:
-            try:
-                lowest_level["date"] = pd.to_datetime(
-                    lowest_level["date"], errors="raise")
-            except ValueError as e:
-                LOGGER.error(
-                    f"Failed to convert 'date' column to datetime: {e}")
-                raise
 
-    LOGGER.info(f"Processing lowest level {lowest_level.shape}")
+def _aggregate_values(frame: pd.DataFrame, by: List[str], _method: str, sort: bool = True) -> pd.DataFrame:
+    """
+    Group *frame* by *by* and aggregate its value column with *_method*.
 
-    res = lowest_level.copy()
+    'ratio' sums the numerator / denominator components and divides, so the
+    result is exact at every level; any other method is a plain pandas
+    aggregation of ``value``.
+    """
+    grouped = frame.groupby(by, dropna=False, sort=sort)
+    if _method != RATIO_METHOD:
+        return grouped.agg({"value": _method}).reset_index()
+    agg = grouped[RATIO_COMPONENTS].sum().reset_index()
+    agg["value"] = _ratio_values(agg["numerator"], agg["denominator"])
+    return agg
 
-    if "period_level" not in res.columns:
-        res["period_level"] = 1
 
+def _base_period_level(metric: Metrics) -> int:
+    """Return the lowest period_level a metric is loaded at."""
+    if metric.is_daily:
+        return 1
     if metric.is_monthly:
-        LOGGER.info(f"Aggregating metric_id {metric_id} at monthly level.")
+        return 2
+    if metric.is_quarterly:
+        return 3
+    if metric.is_yearly:
+        return 4
+    raise ValueError(f"Metric {metric.id} has no granularity flags set.")
 
-        lowest_level["month_start"] = lowest_level["date"].dt.to_period(
-            "M").dt.start_time
 
-        monthly_agg = (
-            lowest_level.groupby(["group_name", "month_start"], dropna=False).agg(
-                {"value": _method}).reset_index()
-        )
-        monthly_agg["date"] = monthly_agg["month_start"].dt.strftime("%Y%m%d")
-        monthly_agg.drop(columns=["month_start"], inplace=True)
-        monthly_agg["period_level"] = 2
-        res = pd.concat([res, monthly_agg], ignore_index=True)
-        LOGGER.info(
-            f"Aggregated {monthly_agg.shape[0]} rows at monthly level.")
+def _period_start(dates: pd.Series, freq: str) -> pd.Series:
+    """Map datetimes to the first day of their month / quarter / year."""
+    return dates.dt.to_period(freq).dt.start_time
 
-    if metric.is_quarterly:
-        LOGGER.info(f"Aggregating metric_id {metric_id} at quarterly level.")
-        lowest_level["quarter_start"] = lowest_level["date"].dt.to_period(
-            "Q").dt.start_time
-        quarterly_agg = (
-            lowest_level.groupby(["group_name", "quarter_start"], dropna=False).agg(
-                {"value": _method}).reset_index()
-        )
-        quarterly_agg["date"] = quarterly_agg["quarter_start"].dt.strftime(
-            "%Y%m%d")
-        quarterly_agg.drop(columns=["quarter_start"], inplace=True)
-        quarterly_agg["period_level"] = 3
-        res = pd.concat([res, quarterly_agg], ignore_index=True)
-        LOGGER.info(
-            f"Aggregated {quarterly_agg.shape[0]} rows at quarterly level.")
 
-    if metric.is_yearly:
-        LOGGER.info(f"Aggregating metric_id {metric_id} at yearly level.")
-        lowest_level["year_start"] = lowest_level["date"].dt.to_period(
-            "Y").dt.start_time
+def _aggregate_time_levels(lowest_level: pd.DataFrame, levels, _method: str) -> pd.DataFrame:
+    """
+    Roll base rows up into every (period_level, freq) in *levels*.
 
-        yearly_agg = (
-            lowest_level.groupby(["group_name", "year_start"], dropna=False).agg(
-                {"value": _method}).reset_index()
+    For decomposable methods (see ``CASCADE_METHODS``) each level is computed
+    from the one below it (days -> months -> quarters -> years), so upper
+    levels scan a few rows per group instead of the whole base frame.
+    Anything else, e.g. 'mean', is always computed from the base rows.
+
+    Returns one frame with columns group_name, bucket (period start as a
+    Timestamp), value and period_level.
+    """
+    cascade_method = CASCADE_METHODS.get(_method)
+    if _method == RATIO_METHOD:
+        lowest_level = _with_components(lowest_level)
+    source, source_method = lowest_level, _method
+    aggregated = []
+    for level, freq in levels:
+        agg = _aggregate_values(
+            source.assign(bucket=_period_start(source["date"], freq)), ["group_name", "bucket"], source_method
         )
-        yearly_agg["date"] = yearly_agg["year_start"].dt.strftime("%Y0101")
-        yearly_agg.drop(columns=["year_start"], inplace=True)
-        yearly_agg["period_level"] = 4
-        res = pd.concat([res, yearly_agg], ignore_index=True)
-        LOGGER.info(f"Aggregated {yearly_agg.shape[0]} rows at yearly level.")
+        agg["period_level"] = level
+        aggregated.append(agg)
+        LOGGER.info(
+            f"Aggregated {agg.shape[0]} rows at period_level {level} ({freq}) from {source.shape[0]} rows.")
+
+        if cascade_method is not None:
+            source = agg.drop(columns="period_level").rename(columns={"bucket": "date"})
+            source_method = cascade_method
+
+    if not aggregated:
+        return pd.DataFrame(
+            {
+                "group_name": pd.Series(dtype=object),
+                "bucket": pd.Series(dtype="datetime64[ns]"),
+                "value": pd.Series(dtype=float),
+                "period_level": pd.Series(dtype=int),
+            }
+        )
+    return pd.concat(aggregated, ignore_index=True)
 
-    res["metric_id"] = metric_id
-    return res
 
+@dataclass
+class MetricCube:
+    """
+    Every derived row of one metric: site-level time rollups plus the
+    'all' / camp / store-format rows at every period level.
 
-def aggregate_metric_by_group_hierachy(_metric_id: int, _method: str) -> pd.DataFrame:
+    ``has_sites`` is False for metrics loaded at a non-site group (e.g. the
+    social-media metrics keyed on 'all'); those only get time rollups.
+    ``incremental`` cubes cover only the buckets touched by an upload.
     """
-    Query all data for the given metric ID from the 'facts' table
-    and compute aggregated values for 'ALL', camp level, and store format level
-    for each time dimension (date, period_level).
+
+    metric_id: int
+    base_level: int
+    rows: pd.DataFrame
+    has_sites: bool
+    incremental: bool
+
+
+def _site_hierarchy_lookup(sites) -> Tuple[np.ndarray, np.ndarray, List[str]]:
     """
+    Build integer lookup arrays from site_id to hierarchy label codes.
 
-    LOGGER.info(
-        f"Aggregating metric_id {_metric_id} by group hierarchy with method '{_method}'")
-    _metric_id = int(_metric_id)
+    ``camp_code[site_id]`` and ``format_code[site_id]`` index into the
+    returned label list (-1 = not mapped); label 0 is always 'all'.
+    """
+    labels = [HIERARCHY_ALL]
+    codes: Dict[str, int] = {HIERARCHY_ALL: 0}
+    max_site_id = max((s.site_id for s in sites), default=0)
+    camp_code = np.full(max_site_id + 1, -1, dtype=np.int64)
+    format_code = np.full(max_site_id + 1, -1, dtype=np.int64)
+    for site in sites:
+        for lookup, label in ((camp_code, site.command_name), (format_code, site.store_format)):
+            if not label:
+                continue
+            if label not in codes:
+                codes[label] = len(labels)
+                labels.append(label)
+            lookup[site.site_id] = codes[label]
+    return camp_code, format_code, labels
+
+
+def _changed_key_frame(changed_keys: pd.DataFrame) -> pd.DataFrame:
+    """Normalise (group_name, date) keys to str / datetime64 and drop duplicates."""
+    keys = changed_keys[["group_name", "date"]].drop_duplicates()
+    keys = pd.DataFrame({"group_name": keys["group_name"].astype(str), "date": pd.to_datetime(keys["date"])})
+    return keys.dropna(subset=["date"]).drop_duplicates()
+
+
+def build_metric_cube(_metric_id: int, _method: str, changed_keys: Optional[pd.DataFrame] = None) -> MetricCube:
+    """
+    Compute all time and group-hierarchy rollups of a metric in one pass.
+
+    Base rows are read once. Site ids are resolved once per distinct group,
+    mapped to camp and store format through integer lookup arrays, and every
+    (period_level x {all, camp, format}) combination is produced by a single
+    groupby over a stacked frame (SQL-style GROUPING SETS).
+
+    With ``changed_keys`` the cube is restricted to the buckets those
+    (group_name, date) keys fall in: only the base history of the widest
+    affected period is read, and only rows of month / quarter / year
+    buckets (and hierarchy dates) containing a changed key are returned.
+    Nothing is written; see :func:`apply_metric_cube`.
+    """
+    metric_id = int(_metric_id)
+    metric = get_metric_md(metric_id)
+    base_level = _base_period_level(metric)
+    levels = [(level, freq) for level, flag, freq in TIME_LEVELS if level > base_level and getattr(metric, flag)]
+    incremental = changed_keys is not None
+    empty = MetricCube(metric_id, base_level, pd.DataFrame(columns=FACT_COLUMNS), False, incremental)
+
+    date_from = date_to = None
+    if incremental:
+        keys = _changed_key_frame(changed_keys)
+        if keys.empty:
+            return empty
+        if levels:
+            widest_freq = levels[-1][1]
+            date_from = _period_start(keys["date"], widest_freq).min().date()
+            date_to = keys["date"].dt.to_period(widest_freq).dt.end_time.max().date()
+        else:
+            date_from, date_to = keys["date"].min().date(), keys["date"].max().date()
 
     with SessionLocal() as session:
-        deleted = (
-            session.query(Facts)
-            # non‑numeric ⇒ NULL
-            .filter(Facts.metric_id == _metric_id, cast(Facts.group_name, Integer).is_(None))
-            .delete(synchronize_session=False)
-        )
-        session.commit()
+        base = query_facts(session=session, metric_id=metric_id,
+                           period_level=base_level, date_from=date_from, date_to=date_to, use_cache=False)
+        sites = getSites(session=session)
 
+    if base.empty:
+        LOGGER.warning(f"No base rows found for metric_id: {metric_id}")
+        return empty
+
+    # Resolve site ids once per distinct group instead of once per row.
+    groups = pd.Categorical(base["group_name"].astype(str))
+    category_site_ids = pd.to_numeric(pd.Series(groups.categories), errors="coerce").to_numpy()
+    is_site_row = ~np.isnan(category_site_ids[groups.codes])
+    has_sites = bool(is_site_row.any())
+
+    if _method == RATIO_METHOD:
+        with engine.connect() as conn:
+            _refuse_mixed_ratio_rollup(conn, metric_id, base_level, levels, has_sites, date_from, date_to)
+        base = _with_components(base)
+    base = pd.DataFrame({"group_name": np.asarray(groups), "date": pd.to_datetime(base["date"]),
+                         "value": base["value"].to_numpy(dtype=float),
+                         **{c: base[c].to_numpy(dtype=float) for c in RATIO_COMPONENTS if _method == RATIO_METHOD}})
+    if has_sites:
+        # Non-site rows at the base level are hierarchy output of earlier runs.
+        base = base[is_site_row]
+
+    time_rows = _aggregate_time_levels(base, levels, _method).rename(columns={"bucket": "date"})
+    parts = [time_rows]
+
+    if has_sites:
+        site_level = pd.concat([base.assign(period_level=base_level), time_rows], ignore_index=True)
+        site_codes = pd.Categorical(site_level["group_name"], categories=groups.categories).codes
+        site_ids = category_site_ids[site_codes].astype(np.int64)
+
+        camp_code, format_code, labels = _site_hierarchy_lookup(sites)
+        in_range = site_ids < len(camp_code)
+        clipped = np.where(in_range, site_ids, 0)
+        camp_rows = np.where(in_range, camp_code[clipped], -1)
+        format_rows = np.where(in_range, format_code[clipped], -1)
+
+        n_rows = len(site_level)
+        stacked = pd.DataFrame(
+            {
+                "hierarchy": np.concatenate([np.zeros(n_rows, dtype=np.int64), camp_rows, format_rows]),
+                "period_level": np.tile(site_level["period_level"].to_numpy(), 3),
+                "date": np.tile(site_level["date"].to_numpy(), 3),
+                "value": np.tile(site_level["value"].to_numpy(), 3),
+                **{c: np.tile(site_level[c].to_numpy(), 3) for c in RATIO_COMPONENTS if c in site_level},
+            }
+        )
+        stacked = stacked[stacked["hierarchy"] >= 0]
+        hierarchy_rows = _aggregate_values(stacked, ["hierarchy", "period_level", "date"], _method, sort=False)
+        hierarchy_rows["group_name"] = np.asarray(labels, dtype=object)[hierarchy_rows.pop("hierarchy").to_numpy()]
+        parts.append(hierarchy_rows)
+
+    if incremental:
+        affected = pd.concat(
+            [keys.assign(period_level=base_level)]
+            + [keys.assign(date=_period_start(keys["date"], freq), period_level=level) for level, freq in levels],
+            ignore_index=True,
+        ).drop_duplicates()
+        parts[0] = parts[0].merge(affected, on=["group_name", "date", "period_level"], how="inner")
+        if len(parts) > 1:
+            parts[1] = parts[1].merge(
+                affected[["date", "period_level"]].drop_duplicates(), on=["date", "period_level"], how="inner")
+
+    rows = pd.concat(parts, ignore_index=True)
+    rows["metric_id"] = metric_id
+    rows = rows.reindex(columns=FACT_COLUMNS)
     LOGGER.info(
-        f"Deleted {deleted} facts with non‑numeric group_name for metric_id={_metric_id}")
-    # 1. Query the existing facts records for our given metric_id:
-    with SessionLocal() as session:
-        df_facts = query_facts(session=session, metric_id=_metric_id)
+        f"Cube for metric_id={metric_id}: {len(base)} base rows -> {len(rows)} rollup rows "
+        f"({'incremental' if incremental else 'full'}, sites={has_sites})"
+    )
+    return MetricCube(metric_id, base_level, rows, has_sites, incremental)
 
-    if df_facts.empty:
-        # If there's no data for this metric, return an empty DataFrame
-        LOGGER.warning(f"No facts found for metric_id = {_metric_id}")
-        return pd.DataFrame(columns=["metric_id", "group_name", "value", "date", "period_level"])
 
-    # Ensure that 'date' is a datetime type
-    df_facts["date"] = pd.to_datetime(df_facts["date"], errors="coerce")
+def apply_metric_cube(cube: MetricCube) -> int:
+    """
+    Write a cube to ``facts``. A full cube replaces the metric's previous
+    rollups (every level above the base level and, for site-keyed metrics,
+    every non-site group) in one atomic swap; an incremental cube is a pure
+    upsert.
+    """
+    if not cube.incremental:
+        stale = Facts.period_level > cube.base_level
+        if cube.has_sites:
+            stale = or_(stale, NON_SITE_ROWS)
+        return replace_facts_atomically(cube.metric_id, stale, cube.rows.copy())
 
-    # Initialize a list to store the aggregated DataFrames
-    aggregated_dfs = []
+    if cube.rows.empty:
+        return 0
+    return insert_facts_from_df(cube.rows.copy())
 
-    # --- Aggregate at the 'all' level ---
-    LOGGER.info(f"Aggregating metric_id {_metric_id} at 'all' level.")
-    grouped_all = df_facts.groupby(["metric_id", "date", "period_level"], dropna=False, as_index=False).agg(
-        {"value": _method}
-    )
-    grouped_all["group_name"] = "all"
-    aggregated_dfs.append(grouped_all)
 
-    # --- Aggregate at the camp level ---
-    LOGGER.info(f"Aggregating metric_id {_metric_id} at camp level.")
-    with SessionLocal() as session:
-        # Fetch site to camp mapping
-        sites = getSites(session=session)
-        site_camp_map = {
-            site.site_id: site.command_name for site in sites if site.command_name}
-
-        # Filter for rows where group_name can be converted to integer (site_id)
-        df_camp_eligible = df_facts[pd.to_numeric(
-            df_facts["group_name"], errors="coerce").notna()].copy()
-        df_camp_eligible["site_id"] = df_camp_eligible["group_name"].astype(
-            int)
-
-        # Map camp names to the filtered DataFrame
-        df_camp_eligible["camp_name"] = df_camp_eligible["site_id"].map(
-            site_camp_map)
-        df_camp = df_camp_eligible.dropna(subset=["camp_name"])
-
-        if not df_camp.empty:
-            grouped_camp = df_camp.groupby(
-                ["metric_id", "camp_name", "date", "period_level"], dropna=False, as_index=False
-            ).agg({"value": _method})
-            grouped_camp.rename(
-                columns={"camp_name": "group_name"}, inplace=True)
-            aggregated_dfs.append(grouped_camp)
-        else:
-            LOGGER.info(
-                f"No camp information found for metric_id {_metric_id}.")
+# (metric_id, agg_method, changed_keys or None) -- the arguments of build_metric_cube
+CubeSpec = Tuple[int, str, Optional[pd.DataFrame]]
+
+
+def build_metric_cubes_parallel(
+    specs: List[CubeSpec], max_workers: Optional[int] = None
+) -> Iterator[Tuple[int, "Future[MetricCube]"]]:
+    """
+    Build the cubes of several independent metrics concurrently.
+
+    Each spec is computed by :func:`build_metric_cube` in a worker process
+    (read-only, own SQLite connection). Yields ``(metric_id, future)`` in
+    completion order so the caller, the single writer, can apply each cube
+    with :func:`apply_metric_cube` as soon as it is ready. A worker error is
+    raised by ``future.result()``. One spec, or ``max_workers=1``, runs
+    in-process.
+    """
+    workers = min(len(specs), max_workers or os.cpu_count() or 1)
+    if workers <= 1:
+        for spec in specs:
+            future: "Future[MetricCube]" = Future()
+            try:
+                future.set_result(build_metric_cube(*spec))
+            except Exception as e:
+                future.set_exception(e)
+            yield spec[0], future
+        return
+
+    LOGGER.info(f"Building {len(specs)} metric cubes in {workers} processes")
+    # spawn: forking a process that already holds SQLite connections and threads is unsafe
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = {pool.submit(build_metric_cube, *spec): spec[0] for spec in specs}
+        for future in as_completed(futures):
+            yield futures[future], future
+
+
+# ── SQL-pushed rollups ─────────────────────────────────────────────────────────
+# pandas method name -> SQLite aggregate
+SQL_AGGREGATES = {"sum": "SUM", "mean": "AVG", "min": "MIN", "max": "MAX", "count": "COUNT", RATIO_METHOD: "SUM"}
+
+# period alias -> expression giving the first day of the bucket as 'YYYY-MM-DD'
+SQL_BUCKETS = {
+    "M": "strftime('%Y-%m-01', date)",
+    "Q": "printf('%s-%02d-01', strftime('%Y', date), ((CAST(strftime('%m', date) AS INTEGER) - 1) / 3) * 3 + 1)",
+    "Y": "strftime('%Y-01-01', date)",
+}
+
+# facts rows of site groups
+SQL_IS_SITE = "group_id IN (SELECT id FROM groups WHERE kind = 'site')"
+
+# Natural key of each group-hierarchy level ('s' = the joined sites row)
+SQL_HIERARCHY_LABELS = (f"'{HIERARCHY_ALL}'", "s.command_name", "s.store_format")
+
+
+def _sql_measures(_method: str, prefix: str = "") -> str:
+    """SELECT list for (value, numerator, denominator) of one rollup group."""
+    if _method != RATIO_METHOD:
+        return f"{SQL_AGGREGATES[_method]}({prefix}value), NULL, NULL"
+    # Rows without components count as value / 1, like _with_components.
+    num = f"SUM(COALESCE({prefix}numerator, {prefix}value))"
+    den = f"SUM(COALESCE({prefix}denominator, 1.0))"
+    return f"CASE WHEN {den} != 0 THEN {num} / {den} ELSE 0.0 END, {num}, {den}"
+
+
+def _mixed_ratio_periods(conn, metric_id: int, base_level: int, levels, sites_only: bool,
+                         date_from: Optional[date] = None, date_to: Optional[date] = None) -> List[str]:
+    """
+    Start dates of the widest rollup periods of a ratio metric whose base
+    rows mix rows stored with numerator / denominator and rows loaded
+    before components existed.
+
+    Every rollup group (any period level, any hierarchy group) draws its
+    base rows from one widest period across all groups, so a rollup is
+    unbiased exactly when none is listed here. Periods made only of old
+    rows roll up as an unweighted mean, as they did before components.
+    """
+    bucket = SQL_BUCKETS[levels[-1][1]] if levels else "date"
+    legacy = "(numerator IS NULL OR denominator IS NULL)"
+    conditions = ["metric_id = :metric_id", "period_level = :base_level"]
+    if sites_only:
+        conditions.append(SQL_IS_SITE)
+    params = {"metric_id": metric_id, "base_level": base_level}
+    if date_from is not None:
+        conditions.append("date >= :date_from")
+        params["date_from"] = date_from.isoformat()
+    if date_to is not None:
+        conditions.append("date <= :date_to")
+        params["date_to"] = date_to.isoformat()
+    return list(conn.exec_driver_sql(
+        f"SELECT {bucket} AS bucket FROM facts WHERE {' AND '.join(conditions)} "
+        f"GROUP BY bucket HAVING MIN({legacy}) != MAX({legacy}) ORDER BY bucket",
+        params,
+    ).scalars())
+
+
+def _refuse_mixed_ratio_rollup(conn, metric_id: int, base_level: int, levels, sites_only: bool,
+                               date_from: Optional[date] = None, date_to: Optional[date] = None) -> None:
+    """Raise ValueError if a ratio rollup would weight old rows without components as 1."""
+    mixed = _mixed_ratio_periods(conn, metric_id, base_level, levels, sites_only, date_from, date_to)
+    if mixed:
+        message = (
+            f"Refusing ratio rollup of metric_id={metric_id}: {len(mixed)} period(s) starting at "
+            f"{', '.join(mixed[:5])}{' …' if len(mixed) > 5 else ''} mix rows with numerator/denominator and "
+            f"rows loaded before they were stored. Re-hydrate the older source files "
+            f"('Re-hydrate from scratch') so every row carries its components."
+        )
+        LOGGER.error(message)
+        raise ValueError(message)
+
+
+def rollup_metric_in_sql(_metric_id: int, _method: str) -> int:
+    """
+    Full rollup rebuild of one metric without moving fact rows into Python.
+
+    Same output as a full :func:`build_metric_cube` + :func:`apply_metric_cube`,
+    but every level is an ``INSERT ... SELECT ... GROUP BY`` inside SQLite:
+    months / quarters / years via date-bucket expressions (cascading from the
+    level below for decomposable methods), then 'all', camp and store-format
+    rows via joins to ``groups`` and ``sites``. Runs as one transaction and
+    returns the number of rows written.
+    """
+    metric_id = int(_metric_id)
+    if _method not in SQL_AGGREGATES:
+        raise ValueError(f"Aggregation method {_method!r} has no SQL equivalent.")
+    metric = get_metric_md(metric_id)
+    base_level = _base_period_level(metric)
+    levels = [(level, freq) for level, flag, freq in TIME_LEVELS if level > base_level and getattr(metric, flag)]
+    params = {"metric_id": metric_id, "base_level": base_level}
+
+    written = 0
+    with engine.begin() as conn:
+        sync_groups(conn.connection)
+        has_sites = (
+            conn.exec_driver_sql(
+                f"SELECT EXISTS (SELECT 1 FROM facts WHERE metric_id = :metric_id "
+                f"AND period_level = :base_level AND {SQL_IS_SITE})",
+                params,
+            ).scalar()
+            == 1
+        )
+        if _method == RATIO_METHOD:
+            _refuse_mixed_ratio_rollup(conn, metric_id, base_level, levels, has_sites)
+        stale = f"period_level > :base_level OR NOT ({SQL_IS_SITE})" if has_sites else "period_level > :base_level"
+        deleted = conn.exec_driver_sql(f"DELETE FROM facts WHERE metric_id = :metric_id AND ({stale})", params).rowcount
+        LOGGER.info(f"SQL rollup: deleted {deleted} stale rows for metric_id={metric_id}")
+
+        source_level, source_method = base_level, _method
+        for level, freq in levels:
+            written += conn.exec_driver_sql(
+                f"""
+                INSERT INTO facts (metric_id, group_id, value, numerator, denominator, date, period_level,
+                                   record_inserted_date)
+                SELECT metric_id, group_id, {_sql_measures(source_method)}, {SQL_BUCKETS[freq]} AS bucket,
+                       :level, CURRENT_TIMESTAMP
+                FROM facts
+                WHERE metric_id = :metric_id AND period_level = :source_level
+                GROUP BY group_id, bucket
+                {_SQL_UPSERT}
+                """,
+                {**params, "level": level, "source_level": source_level},
+            ).rowcount
+            if _method in CASCADE_METHODS:
+                source_level, source_method = level, CASCADE_METHODS[_method]
+
+        if has_sites:
+            for label in SQL_HIERARCHY_LABELS:
+                written += _insert_hierarchy_rows(conn, metric_id, _method, label)
+    bump_generation(FACTS_GENERATION)
+
+    LOGGER.info(f"SQL rollup for metric_id={metric_id}: wrote {written} rows (sites={has_sites})")
+    return written
+
+
+def _insert_hierarchy_rows(conn, metric_id: int, _method: str, label: str, only: Optional[List[str]] = None) -> int:
+    """
+    Upsert one level of the group hierarchy ('all', camp or store format) of
+    a metric at every date and period level, from its site rows. ``only``
+    restricts the rebuild to those group labels. The hierarchy groups must
+    exist (see ``sync_groups``).
+    """
+    join = "" if label.startswith("'") else "JOIN sites s ON s.site_id = CAST(sg.natural_key AS INTEGER)"
+    params = {"metric_id": metric_id}
+    restrict = ""
+    if only is not None:
+        params.update({f"g{i}": g for i, g in enumerate(only)})
+        restrict = f"AND {label} IN ({', '.join(f':g{i}' for i in range(len(only)))})"
+    return conn.exec_driver_sql(
+        f"""
+        INSERT INTO facts (metric_id, group_id, value, numerator, denominator, date, period_level,
+                           record_inserted_date)
+        SELECT f.metric_id, hg.id AS label, {_sql_measures(_method, "f.")}, f.date, f.period_level,
+               CURRENT_TIMESTAMP
+        FROM facts f
+        JOIN groups sg ON sg.id = f.group_id AND sg.kind = 'site' {join}
+        JOIN groups hg ON hg.natural_key = {label}
+        WHERE f.metric_id = :metric_id {restrict}
+        GROUP BY label, f.date, f.period_level
+        {_SQL_UPSERT}
+        """,
+        params,
+    ).rowcount
+
+
+def rerollup_site_hierarchy(camps: Set[str], formats: Set[str]) -> int:
+    """
+    Recompute only the given camp and store-format groups after sites moved
+    between them (see ``load_db.refresh_site_hierarchy``).
+
+    For every site-keyed metric the listed groups are deleted and rebuilt
+    from the current ``sites`` mapping at all period levels, inside one
+    transaction. Site rows, time rollups, 'all' and every other group are
+    left untouched. Derived metrics are skipped; re-evaluate them for the
+    same groups. Returns the number of rows written.
+    """
+    targets = [("s.command_name", sorted(g for g in camps if g)), ("s.store_format", sorted(g for g in formats if g))]
+    groups = [g for _, labels in targets for g in labels]
+    if not groups:
+        return 0
 
-    # --- Aggregate at the store format level ---
-    LOGGER.info(f"Aggregating metric_id {_metric_id} at store format level.")
     with SessionLocal() as session:
-        # Fetch site to store format mapping
-        sites = getSites(session=session)
-        site_store_format_map = {
-            site.site_id: site.store_format for site in sites if site.store_format}
-
-        # Filter for rows where group_name can be converted to integer (site_id)
-        df_store_format_eligible = df_facts[pd.to_numeric(
-            df_facts["group_name"], errors="coerce").notna()].copy()
-        df_store_format_eligible["site_id"] = df_store_format_eligible["group_name"].astype(
-            int)
-
-        # Map store formats to the filtered DataFrame
-        df_store_format_eligible["store_format"] = df_store_format_eligible["site_id"].map(
-            site_store_format_map)
-        df_store_format = df_store_format_eligible.dropna(
-            subset=["store_format"])
-
-        if not df_store_format.empty:
-            grouped_store_format = df_store_format.groupby(
-                ["metric_id", "store_format", "date", "period_level"], dropna=False, as_index=False
-            ).agg({"value": _method})
-            grouped_store_format.rename(
-                columns={"store_format": "group_name"}, inplace=True)
-            aggregated_dfs.append(grouped_store_format)
-        else:
-            LOGGER.info(
-                f"No store format information found for metric_id {_metric_id}.")
-
-    # 5. Concatenate all aggregated DataFrames:
-    if aggregated_dfs:
-        final_df = pd.concat(aggregated_dfs, ignore_index=True)
-
-        # 6. Rearrange columns to match the Facts schema order:
-        final_df = final_df[["metric_id", "group_name",
-                             "value", "date", "period_level"]]
-        return final_df
-    else:
-        return pd.DataFrame(columns=["metric_id", "group_name", "value", "date", "period_level"])
+        metrics = session.query(Metrics.id, Metrics.agg_method).filter(Metrics.formula.is_(None)).all()
+
+    written = 0
+    with engine.begin() as conn:
+        sync_groups(conn.connection)
+        for metric_id, agg_method in metrics:
+            has_sites = conn.exec_driver_sql(
+                f"SELECT EXISTS (SELECT 1 FROM facts WHERE metric_id = :metric_id AND {SQL_IS_SITE})",
+                {"metric_id": metric_id},
+            ).scalar()
+            if not has_sites:
+                continue
+            if agg_method not in SQL_AGGREGATES:
+                LOGGER.warning(f"Skipping metric_id={metric_id}: no SQL rollup for agg_method {agg_method!r}")
+                continue
+            if agg_method == RATIO_METHOD:
+                metric = get_metric_md(metric_id)
+                base_level = _base_period_level(metric)
+                levels = [(lv, freq) for lv, flag, freq in TIME_LEVELS if lv > base_level and getattr(metric, flag)]
+                try:
+                    _refuse_mixed_ratio_rollup(conn, metric_id, base_level, levels, True)
+                except ValueError:
+                    continue  # logged; keep the other metrics' groups current
+            conn.execute(delete(Facts).where(
+                Facts.metric_id == metric_id,
+                Facts.group_id.in_(select(Groups.id).where(Groups.natural_key.in_(groups))),
+            ))
+            for label, only in targets:
+                if only:
+                    written += _insert_hierarchy_rows(conn, metric_id, agg_method, label, only)
+    bump_generation(FACTS_GENERATION)
+
+    LOGGER.info(f"Re-rolled hierarchy groups {groups}: wrote {written} rows")
+    return written
@@ -1,12 +1,14 @@
 from __future__ import annotations
 from datetime import date
 import calendar
-import pandas as pd
+import numpy as np
 
 from typing import List, Callable, Dict
 
 from src.scripts.data_warehouse.access import (
+    FactQuery,
     query_facts,
+    query_facts_many,
     getSites,
     getCamps,
 )
@@ -76,25 +78,57 @@ def _retail_section(session, year: int, month: int) -> str:
         for s in sites
     }
 
-    # ---------------- 1. Total revenue & MoM -----------------
-    revenue_df     = query_facts(session, 1, group_name="all", period_level=2, exact_date=month_start)
-    total_revenue  = revenue_df["value"].sum() if not revenue_df.empty else 0.0
+    camps      = getCamps(session)
+    camp_names = [c.name for c in camps]
+
+    # ─── ALL RETAIL FACTS IN ONE ROUND TRIP ────────────────────────────────
+    def _monthly(metric_id, when, **groups):
+        return FactQuery(metric_id, period_level=2, exact_date=when, **groups)
+
+    def _daily(metric_id, **groups):
+        return FactQuery(metric_id, period_level=1, date_from=month_start, date_to=month_end, **groups)
+
+    specs = {
+        "revenue": _monthly(1, month_start, group_name="all"),
+        "prev_revenue": _monthly(1, prev_start, group_name="all"),
+        "units_mart": _monthly(2, month_start, group_names=mart_site_ids),
+        "units_main": _monthly(2, month_start, group_names=main_site_ids),
+        "aov_daily": _daily(4, group_name="all"),
+        "returned_camps": _monthly(5, month_start, group_names=camp_names),
+        "units": _monthly(2, month_start, group_name="all"),
+        "prev_units": _monthly(2, prev_start, group_name="all"),
+        "txn": _monthly(3, month_start, group_name="all"),
+        "prev_txn": _monthly(3, prev_start, group_name="all"),
+        "return_rate": _monthly(23, month_start, group_name="all"),
+        "returned": _monthly(5, month_start, group_name="all"),
+        "txn_daily": _daily(3, group_name="all"),
+        "rtxn": _monthly(6, month_start, group_name="all"),
+        "prev_rtxn": _monthly(6, prev_start, group_name="all"),
+    }
+    # an empty site list would mean "no group filter"
+    if mart_site_ids:
+        specs["units_daily_mart"] = _daily(2, group_names=mart_site_ids)
+    if main_site_ids:
+        specs["units_daily_main"] = _daily(2, group_names=main_site_ids)
+    # only the columns the insights read, so the facts indexes cover the lookups
+    facts = query_facts_many(session, specs, columns=["group_name", "date", "value"])
 
-    prev_rev_df    = query_facts(session, 1, group_name="all", period_level=2, exact_date=prev_start)
-    prev_revenue   = prev_rev_df["value"].sum() if not prev_rev_df.empty else 0.0
+    def _total(key):
+        return facts[key]["value"].sum()   # 0 for an empty frame
+
+    # ---------------- 1. Total revenue & MoM -----------------
+    total_revenue  = _total("revenue")
+    prev_revenue   = _total("prev_revenue")
     pct_rev_change = (100 * (total_revenue - prev_revenue) / prev_revenue) if prev_revenue else 0.0
 
     # ---------------- 2. Top-5 Marine Marts ------------------
-    units_df = query_facts(session, 2, group_names=mart_site_ids, period_level=2, exact_date=month_start)
-    md_top5_mart = _top5_list(units_df, id_to_name)
+    md_top5_mart = _top5_list(facts["units_mart"], id_to_name)
 
     # ---------------- 3. Top-5 Main Stores -------------------
-    main_units_df = query_facts(session, 2, group_names=main_site_ids, period_level=2, exact_date=month_start)
-    md_top5_main = _top5_list(main_units_df, id_to_name)
+    md_top5_main = _top5_list(facts["units_main"], id_to_name)
 
     # ---------------- 4. Day with highest AOV ----------------
-    aov_df = query_facts(session, 4, group_name="all", period_level=1,
-                         date_from=month_start, date_to=month_end)
+    aov_df = facts["aov_daily"]
     if not aov_df.empty:
         best_row  = aov_df.loc[aov_df["value"].idxmax()]
         best_day  = best_row["date"].strftime("%B %d, %Y")
@@ -103,10 +137,7 @@ def _retail_section(session, year: int, month: int) -> str:
         best_day, best_aov = "-", 0.0
 
     # ---------------- 5. Camp with fewest returned items -----
-    camps                 = getCamps(session)
-    camp_names            = [c.name for c in camps]
-    returned_items_df     = query_facts(session, 5, group_names=camp_names,
-                                        period_level=2, exact_date=month_start)
+    returned_items_df = facts["returned_camps"]
     if not returned_items_df.empty:
         min_row_items      = returned_items_df.loc[returned_items_df["value"].idxmin()]
         least_return_camp  = min_row_items["group_name"]
@@ -115,33 +146,26 @@ def _retail_section(session, year: int, month: int) -> str:
         least_return_camp, least_return_items = "-", 0
 
     # ---------------- 6. Units sold & MoM --------------------
-    units_month_df = query_facts(session, 2, group_name="all", period_level=2, exact_date=month_start)
-    units_total    = units_month_df["value"].sum() if not units_month_df.empty else 0
-    units_prev_df  = query_facts(session, 2, group_name="all", period_level=2, exact_date=prev_start)
-    units_prev     = units_prev_df["value"].sum() if not units_prev_df.empty else 0
+    units_total      = _total("units")
+    units_prev       = _total("prev_units")
     pct_units_change = (100 * (units_total - units_prev) / units_prev) if units_prev else 0.0
 
     # ---------------- 7. Transactions & MoM ------------------
-    txn_month_df = query_facts(session, 3, group_name="all", period_level=2, exact_date=month_start)
-    txn_total    = txn_month_df["value"].sum() if not txn_month_df.empty else 0
-    txn_prev_df  = query_facts(session, 3, group_name="all", period_level=2, exact_date=prev_start)
-    txn_prev     = txn_prev_df["value"].sum() if not txn_prev_df.empty else 0
+    txn_total      = _total("txn")
+    txn_prev       = _total("prev_txn")
     pct_txn_change = (100 * (txn_total - txn_prev) / txn_prev) if txn_prev else 0.0
 
     # ---------------- 8. Return-rate -------------------------
-    returned_all_df     = query_facts(
-        session,
-        5,                       # metric_id for returned items
-        group_name="all",        # <─ key change
-        period_level=2,
-        exact_date=month_start,
-    )
-    returned_items_total = returned_all_df["value"].sum() if not returned_all_df.empty else 0
-    return_rate          = (100 * returned_items_total / units_total) if units_total else 0.0
+    # Derived metric 23 = returned units (5) / units sold (2)
+    if not facts["return_rate"].empty:
+        return_rate = 100 * _total("return_rate")
+    else:
+        # warehouse hydrated before metric 23 existed
+        returned_items_total = _total("returned")
+        return_rate          = (100 * returned_items_total / units_total) if units_total else 0.0
 
     # ---------------- 9. Busiest day by transactions ---------
-    txn_daily_df = query_facts(session, 3, group_name="all", period_level=1,
-                               date_from=month_start, date_to=month_end)
+    txn_daily_df = facts["txn_daily"]
     if not txn_daily_df.empty:
         busiest_row   = txn_daily_df.loc[txn_daily_df["value"].idxmax()]
         busiest_day   = busiest_row["date"].strftime("%B %d, %Y")
@@ -150,15 +174,13 @@ def _retail_section(session, year: int, month: int) -> str:
         busiest_day, busiest_count = "-", 0
 
     # ---------------- 10. Return-transactions & MoM ----------
-    rtxn_month_df = query_facts(session, 6, group_name="all", period_level=2, exact_date=month_start)
-    rtxn_total    = rtxn_month_df["value"].sum() if not rtxn_month_df.empty else 0
-    rtxn_prev_df  = query_facts(session, 6, group_name="all", period_level=2, exact_date=prev_start)
-    rtxn_prev     = rtxn_prev_df["value"].sum() if not rtxn_prev_df.empty else 0
+    rtxn_total      = _total("rtxn")
+    rtxn_prev       = _total("prev_rtxn")
     pct_rtxn_change = (100 * (rtxn_total - rtxn_prev) / rtxn_prev) if rtxn_prev else 0.0
 
     # ---------------- 11. Weekday busyness -------------------
-    busiest_wk_mart, busiest_wk_mart_units = _weekday_peak(session, mart_site_ids, month_start, month_end)
-    busiest_wk_main, busiest_wk_main_units = _weekday_peak(session, main_site_ids, month_start, month_end)
+    busiest_wk_mart, busiest_wk_mart_units = _weekday_peak(facts.get("units_daily_mart"))
+    busiest_wk_main, busiest_wk_main_units = _weekday_peak(facts.get("units_daily_main"))
 
     # ─── Compose markdown for Retail ──────────────────────────────────────
     def word(change):        # pretty +/- wording
@@ -280,10 +302,16 @@ def _marketing_section(session, year: int, month: int) -> str:
     p_year, p_month = (year, month - 1) if month > 1 else (year - 1, 12)
     p_start  = date(p_year, p_month, 1)
 
+    # every metric for both months in one batched query
+    facts = query_facts_many(session, {
+        (metric_id, when): FactQuery(metric_id, group_name="all", period_level=2, exact_date=when)
+        for metric_id in range(9, 20)
+        for when in (m_start, p_start)
+    }, columns=["value"])
+
     # helper for one-liner metric pulls
     def _val(metric_id, when):
-        df = query_facts(session, metric_id, group_name="all",
-                         period_level=2, exact_date=when)
+        df = facts[(metric_id, when)]
         agg = df["value"].mean() if metric_id in (17, 18, 19) else df["value"].sum()
         return agg if not df.empty else 0.0
 
@@ -369,17 +397,16 @@ def _top5_list(df, id_to_name, fmt=lambda v: f"{v:.2f}") -> str:
                      for r in top5.itertuples(index=False))
 
 
-def _weekday_peak(session, site_ids, month_start, month_end):
-    """Return tuple (weekday_name, units) with highest units sold for a site list."""
-    if not site_ids:
-        return "-", 0
-    daily_df = query_facts(session, 2, group_names=site_ids, period_level=1,
-                           date_from=month_start, date_to=month_end)
-    if daily_df.empty:
+def _weekday_peak(daily):
+    """Return tuple (weekday_name, units) with highest units sold in a daily units frame."""
+    if daily is None or daily.empty:
         return "-", 0
-    daily_df["weekday"] = pd.to_datetime(daily_df["date"]).dt.day_name()
-    week = daily_df.groupby("weekday")["value"].sum()
-    return week.idxmax(), int(week.max())
+    # days since 1970-01-01 (a Thursday) -> 0 = Monday ... 6 = Sunday
+    weekday = (daily["date"].to_numpy().astype("datetime64[D]").astype(np.int64) + 3) % 7
+    week = np.bincount(weekday, weights=daily["value"].to_numpy(), minlength=7)
+    week[np.bincount(weekday, minlength=7) == 0] = -np.inf
+    best = int(week.argmax())
+    return calendar.day_name[best], int(week[best])
 
 
 
@@ -4,7 +4,9 @@ import logging
 import os
 import platform
 import time
+from contextlib import nullcontext
 from pathlib import Path
+from typing import Dict
 
 import helpers.sidebar
 import pandas as pd
@@ -13,11 +15,16 @@ from sqlalchemy import select
 from streamlit.delta_generator import DeltaGenerator  
 
 import src.scripts.data_warehouse.etl as etl
-from src.scripts.data_warehouse.models.warehouse import Metrics, SessionLocal
+from src.scripts.data_warehouse.derived import evaluate_derived_metric, get_derived_metrics
+from src.scripts.data_warehouse.journal import STAGE_DERIVED, STAGE_ETL, STAGE_ROLLUP, HydrationJournal, file_sha256
+from src.scripts.data_warehouse.load_db import reload_dimensions
+from src.scripts.data_warehouse.models.warehouse import Metrics, SessionLocal, bulk_load_mode, deferred_fact_indexes
 from src.scripts.data_warehouse.utils import (
-    aggregate_metric_by_group_hierachy,
-    aggregate_metric_by_time_period,
+    SQL_AGGREGATES,
+    apply_metric_cube,
+    build_metric_cubes_parallel,
     insert_facts_from_df,
+    rollup_metric_in_sql,
 )
 from src.scripts.utils import construct_path_from_project_root
 from src.utils.logging import LOGGER, StreamlitLogHandler
@@ -76,18 +83,26 @@ def get_etl_methods_for_pattern(pattern: str):
         ids = mapping[key]
         methods = []
         for metric_id in ids:
-            name, etl_method, agg_method = db.execute(
+            name, etl_method, agg_method, formula = db.execute(
                 select(Metrics.metric_name, Metrics.etl_method,
-                       Metrics.agg_method).where(Metrics.id == metric_id)
+                       Metrics.agg_method, Metrics.formula).where(Metrics.id == metric_id)
             ).fetchone()
+            if formula:
+                # derived from other metrics after their rollups, not read from the file
+                continue
             methods.append((name, etl_method, agg_method, metric_id))
         return methods
     finally:
         db.close()
 
 
-def run_hydration_pipeline(uploaded_file, selected_pattern: str, output_container: DeltaGenerator):
-    """Runs the ETL + aggregation pipeline and streams logs to *output_container*."""
+def run_hydration_pipeline(
+    uploaded_file, selected_pattern: str, output_container: DeltaGenerator, force: bool = False
+):
+    """
+    Runs the ETL + aggregation pipeline and streams logs to *output_container*.
+    With *force*, stages journaled for this file in earlier runs are redone.
+    """
     _reset_logs()
     st.session_state.pipeline_running = True
     st.session_state.last_uploaded = uploaded_file.name
@@ -111,7 +126,27 @@ def run_hydration_pipeline(uploaded_file, selected_pattern: str, output_containe
         LOGGER.info("File saved to %s", destination)
 
         destination_path = str(destination)
-        if selected_pattern.startswith("CustomerSurveyResponses"):
+        etl_steps = get_etl_methods_for_pattern(selected_pattern)
+        if not etl_steps:
+            output_container.warning(
+                "No ETL steps found for this pattern – stopping.")
+            return
+        LOGGER.info("%d metric(s) to process: %s", len(
+            etl_steps), [s[0] for s in etl_steps])
+
+        # Pick up edits to the static metrics / camps / sites files; sites
+        # that moved camp or store format get their hierarchy re-rolled.
+        with st.spinner("Syncing metrics, camps and sites …"):
+            reload_dimensions()
+
+        # Journal keyed by the uploaded file's content: a re-run of the same
+        # file skips every stage that already completed.
+        journal = HydrationJournal(file_sha256(destination_path))
+        if force:
+            journal.reset()
+        metric_ids = [s[3] for s in etl_steps]
+
+        if selected_pattern.startswith("CustomerSurveyResponses") and not journal.all_done(STAGE_ETL, metric_ids):
             if torch_installed and survey_nlp_preprocess and survey_nlp_pipeline:
                 json_data = survey_nlp_preprocess(destination_path)
                 enhanced = survey_nlp_pipeline(json_data)
@@ -123,49 +158,76 @@ def run_hydration_pipeline(uploaded_file, selected_pattern: str, output_containe
             else:
                 st.warning("Torch missing – skipping survey NLP step.")
 
-        etl_steps = get_etl_methods_for_pattern(selected_pattern)
-        if not etl_steps:
-            output_container.warning(
-                "No ETL steps found for this pattern – stopping.")
-            return
-        LOGGER.info("%d metric(s) to process: %s", len(
-            etl_steps), [s[0] for s in etl_steps])
-
-        for metric_name, etl_fn_str, agg_method, metric_id in etl_steps:
-            etl_fn = getattr(etl, etl_fn_str)
-            with st.spinner(f"ETL → {metric_name} …"):
-                lowest_df: pd.DataFrame = etl_fn(destination_path)
-            if lowest_df is None or lowest_df.empty:
-                output_container.warning(
-                    f"ETL for {metric_name} yielded no data – skipping.")
-                continue
-            inserted = insert_facts_from_df(lowest_df)
-            LOGGER.info("Inserted %s raw rows for %s", inserted, metric_name)
-
-        for metric_name, _, agg_method, metric_id in etl_steps:
-            with st.spinner(f"Time aggregation ({agg_method}) → {metric_name} …"):
-                time_df = aggregate_metric_by_time_period(
-                    metric_id, agg_method)
-            if time_df.empty:
-                output_container.warning(
-                    f"No time aggregates for {metric_name}")
-                continue
-            inserted = insert_facts_from_df(time_df)
-            LOGGER.info("Inserted %s time‑agg rows for %s",
-                        inserted, metric_name)
-
-        for metric_name, _, agg_method, metric_id in etl_steps:
-            if metric_id == 9:
-                continue
-            with st.spinner(f"Hierarchy aggregation → {metric_name} …"):
-                hier_df = aggregate_metric_by_group_hierachy(
-                    metric_id, agg_method)
-            if hier_df.empty:
-                continue
-            inserted = insert_facts_from_df(hier_df)
-            LOGGER.info("Inserted %s hierarchy rows for %s",
-                        inserted, metric_name)
-            output_container.success(f"Metric {metric_name} processed ✔️")
+        # (group_name, date) keys each ETL stage wrote; metrics whose ETL was
+        # skipped by the journal get a full rollup instead.
+        changed_keys: Dict[int, pd.DataFrame] = {}
+
+        # Bulk-load mode: WAL, relaxed fsync, big cache
+        with bulk_load_mode() as throughput:
+            # Secondary facts indexes are deferred for the raw inserts only and
+            # rebuilt before the rollups, which read through them.
+            etl_pending = not journal.all_done(STAGE_ETL, metric_ids)
+            with deferred_fact_indexes() if etl_pending else nullcontext():
+                for metric_name, etl_fn_str, agg_method, metric_id in etl_steps:
+                    if journal.is_done(STAGE_ETL, metric_id):
+                        LOGGER.info("ETL for %s already journaled – skipping", metric_name)
+                        continue
+                    with journal.stage(STAGE_ETL, metric_id) as entry:
+                        etl_fn = getattr(etl, etl_fn_str)
+                        with st.spinner(f"ETL → {metric_name} …"):
+                            lowest_df: pd.DataFrame = etl_fn(destination_path)
+                        if lowest_df is None or lowest_df.empty:
+                            output_container.warning(
+                                f"ETL for {metric_name} yielded no data – skipping.")
+                            entry.skip()
+                            continue
+                        entry.rows = insert_facts_from_df(lowest_df)
+                        changed_keys[metric_id] = lowest_df[["group_name", "date"]]
+                        LOGGER.info("Inserted %s raw rows for %s", entry.rows, metric_name)
+
+            metric_names = {metric_id: name for name, _, _, metric_id in etl_steps}
+            sql_rollups, cube_specs = [], []
+            for _, _, agg_method, metric_id in etl_steps:
+                # nothing to roll up until the metric's ETL has completed
+                if journal.is_done(STAGE_ROLLUP, metric_id) or not journal.is_done(STAGE_ETL, metric_id):
+                    continue
+                keys = changed_keys.get(metric_id)
+                if keys is None and agg_method in SQL_AGGREGATES:
+                    # ETL was journaled in an earlier run: full rebuild inside SQLite
+                    sql_rollups.append((metric_id, agg_method))
+                else:
+                    cube_specs.append((metric_id, agg_method, keys))
+
+            def _report_rollup(metric_id: int, rows: int):
+                if not rows:
+                    output_container.warning(f"No aggregates for {metric_names[metric_id]}")
+                    return
+                LOGGER.info("Inserted %s rollup rows for %s", rows, metric_names[metric_id])
+                output_container.success(f"Metric {metric_names[metric_id]} processed ✔️")
+
+            for metric_id, agg_method in sql_rollups:
+                with journal.stage(STAGE_ROLLUP, metric_id) as entry:
+                    with st.spinner(f"Rollups ({agg_method}) → {metric_names[metric_id]} …"):
+                        entry.rows = rollup_metric_in_sql(metric_id, agg_method)
+                _report_rollup(metric_id, entry.rows)
+
+            # Cubes are computed concurrently in worker processes; this
+            # process is the only writer and applies them as they finish.
+            with st.spinner(f"Rollups → {len(cube_specs)} metric(s) in parallel …"):
+                for metric_id, future in build_metric_cubes_parallel(cube_specs):
+                    with journal.stage(STAGE_ROLLUP, metric_id) as entry:
+                        entry.rows = apply_metric_cube(future.result())
+                    _report_rollup(metric_id, entry.rows)
+
+            for derived in get_derived_metrics(depends_on=metric_ids):
+                if journal.is_done(STAGE_DERIVED, derived.id):
+                    continue
+                with journal.stage(STAGE_DERIVED, derived.id) as entry:
+                    with st.spinner(f"Derived → {derived.metric_name} = {derived.formula} …"):
+                        entry.rows = evaluate_derived_metric(derived)
+                output_container.success(f"Derived metric {derived.metric_name} processed ✔️")
+        LOGGER.info("Hydration wrote %d fact rows at %.0f rows/s",
+                    throughput.rows, throughput.rows_per_sec)
 
         try:
             destination.unlink(missing_ok=True)
@@ -227,9 +289,15 @@ with selector_col:
         st.warning(
             f"{uploaded_file.name} ≠ pattern {selected_pattern}. Please rename or pick correct pattern.")
 
+    force_rerun = st.checkbox(
+        "Re-hydrate from scratch",
+        help="Redo every stage even if this exact file was hydrated before, "
+        "e.g. after an ETL fix, a metrics change or a manual facts cleanup.",
+    )
+
     if st.button("Upload & Run", type="primary", disabled=not valid_name):
         with results_col:
-            run_hydration_pipeline(uploaded_file, selected_pattern, st)
+            run_hydration_pipeline(uploaded_file, selected_pattern, st, force=force_rerun)
             st.toast("Pipeline completed – see logs above.")
 
 with results_col: